@@ -0,0 +1,261 @@
+"""
+Descarga de PDFs de bases y condiciones compartida por los scripts de scraping.
+
+`DownloadQueue` separa la recolección de URLs (Selenium) de la descarga: cada URL se
+encola con `submit(url, ruta)` y la sirve un pool de hilos, así el navegador pasa a la
+página siguiente sin esperar. Cada hilo reutiliza su propia `requests.Session`
+(conexiones keep-alive al mismo CDN, reintentos ante 502/503/504) y el cuerpo se
+escribe a disco por bloques en un archivo `.part` propio de cada descarga que se
+renombra al terminar, de modo que nunca queda un PDF a medio escribir con el nombre
+final (y dos hilos que bajan el mismo PDF no se pisan el temporal).
+
+Con un `DownloadManifest` (SQLite, URL → ruta, ETag, Last-Modified, tamaño, sha256,
+fecha de descarga) cada descarga es un GET condicional (`If-None-Match` /
+`If-Modified-Since`): un PDF sin cambios cuesta un 304 y no se vuelve a escribir. El
+manifiesto guarda además el estado de la última consulta de cada archivo ("new",
+"changed", "unchanged") para las estadísticas de la corrida; el OCR decide qué saltear
+con su propio estado por sha256 del PDF (`ocr_state.py`). Si el servidor no soporta
+pedidos condicionales, el sha256 del contenido descargado decide si el archivo cambió.
+
+Configuración por entorno:
+
+- DOWNLOAD_WORKERS        (descargas simultáneas, por defecto 6)
+- DOWNLOAD_TIMEOUT        (segundos de espera por conexión/lectura, por defecto 30)
+- DOWNLOAD_MANIFEST_PATH  (archivo SQLite, por defecto .cache/downloads.sqlite3)
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DOWNLOAD_WORKERS = max(1, int(os.getenv("DOWNLOAD_WORKERS", "6")))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "30"))
+DOWNLOAD_MANIFEST_PATH = os.getenv("DOWNLOAD_MANIFEST_PATH", os.path.join(".cache", "downloads.sqlite3"))
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadManifest:
+    """
+    Registro de descargas por URL: ruta local, ETag, Last-Modified, tamaño, sha256,
+    `fetched_at` (última vez que se bajó el contenido), `checked_at` (última consulta)
+    y `status` de esa consulta: "new", "changed" o "unchanged".
+    """
+
+    FIELDS = ("url", "path", "etag", "last_modified", "size", "sha256", "fetched_at", "checked_at", "status")
+
+    def __init__(self, path=DOWNLOAD_MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            " url TEXT PRIMARY KEY, path TEXT NOT NULL, etag TEXT, last_modified TEXT,"
+            " size INTEGER, sha256 TEXT, fetched_at REAL, checked_at REAL, status TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS downloads_path ON downloads (path)")
+        self._conn.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM downloads WHERE url = ?", (url,)
+            ).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def record(self, entry):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO downloads ({', '.join(self.FIELDS)}) VALUES ({', '.join('?' * len(self.FIELDS))})",
+                tuple(entry.get(f) for f in self.FIELDS),
+            )
+            self._conn.commit()
+
+
+_MANIFEST = None
+_MANIFEST_LOCK = threading.Lock()
+
+
+def get_download_manifest():
+    """Manifiesto de descargas compartido del proceso."""
+    global _MANIFEST
+    with _MANIFEST_LOCK:
+        if _MANIFEST is None:
+            _MANIFEST = DownloadManifest()
+    return _MANIFEST
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_session(verify=True, pool_size=DOWNLOAD_WORKERS):
+    """Session con pool de conexiones keep-alive y reintentos ante errores transitorios del servidor."""
+    session = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET", "HEAD"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.verify = verify
+    return session
+
+
+def fetch_to_file(session, url, path, manifest=None, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Descarga `url` en `path` escribiendo por bloques (archivo .part único + rename).
+    Con `manifest` el pedido es condicional y se registra el resultado.
+    Devuelve (estado, bytes descargados); estado es "new", "changed" o "unchanged".
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    key = os.path.normpath(str(path))
+    entry = manifest.get(url) if manifest is not None else None
+    exists = path.exists()
+    headers = {}
+    if entry and exists and entry["path"] == key:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    now = time.time()
+    tmp = None
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with session.get(url, stream=True, timeout=timeout, headers=headers) as resp:
+            if resp.status_code == 304:
+                entry.update(checked_at=now, status="unchanged")
+                manifest.record(entry)
+                return "unchanged", 0
+            resp.raise_for_status()
+            with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".part",
+                                             delete=False) as f:
+                tmp = Path(f.name)
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+
+        sha = digest.hexdigest()
+        if not exists:
+            status = "new"
+        else:
+            previous = entry["sha256"] if entry and entry["path"] == key else _file_sha256(path)
+            status = "unchanged" if previous == sha else "changed"
+        os.replace(tmp, path)
+    finally:
+        # Descarga cortada (error de red, HTTP o de disco): no dejar el .part a medias
+        if tmp is not None and tmp.exists():
+            tmp.unlink()
+    if manifest is not None:
+        manifest.record({
+            "url": url, "path": key, "etag": etag, "last_modified": last_modified, "size": size,
+            "sha256": sha, "fetched_at": now, "checked_at": now, "status": status,
+        })
+    return status, size
+
+
+_SESSIONS = threading.local()
+
+
+def download_pdf(url, path, verify=True, manifest=None, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Descarga sincrónica (GET condicional contra el manifiesto compartido) para los scrapers
+    que bajan un PDF por vez. Reutiliza la Session del hilo. Devuelve el estado
+    ("new"/"changed"/"unchanged"); los errores de red o HTTP se propagan.
+    """
+    sessions = getattr(_SESSIONS, "by_verify", None)
+    if sessions is None:
+        sessions = _SESSIONS.by_verify = {}
+    if verify not in sessions:
+        sessions[verify] = make_session(verify, pool_size=1)
+    status, _ = fetch_to_file(sessions[verify], url, path, manifest or get_download_manifest(), timeout)
+    return status
+
+
+class DownloadQueue:
+    """
+    Cola de descargas servida por un pool de hilos.
+
+    - `submit(url, ruta)` encola sin bloquear (una ruta se descarga una sola vez por cola)
+    - `wait()` espera a que terminen todas y cierra el pool
+    - `summary()` resumen para el log
+
+    Con `manifest` cada archivo se consulta con un GET condicional (ver `fetch_to_file`).
+    Sin manifiesto y con `skip_existing=True` un archivo que ya existe en disco no se
+    vuelve a descargar.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, verify=True, skip_existing=True, manifest=None):
+        self.verify = verify
+        self.skip_existing = skip_existing
+        self.manifest = manifest
+        self.stats = {"new": 0, "changed": 0, "unchanged": 0, "skipped": 0, "failed": 0, "bytes": 0}
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="descarga")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._futures = []
+        self._submitted = set()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = make_session(self.verify)
+        return session
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _download(self, url, path):
+        if self.manifest is None and self.skip_existing and os.path.exists(path):
+            self._count("skipped")
+            return path
+        try:
+            status, size = fetch_to_file(self._session(), url, path, self.manifest)
+        except Exception as e:
+            print(f"⚠ No se pudo descargar {url}: {e}")
+            self._count("failed")
+            return None
+        self._count(status)
+        self._count("bytes", size)
+        return path
+
+    def submit(self, url, path):
+        """Encola la descarga de `url` en `path`; devuelve el Future (None si la ruta ya estaba encolada)."""
+        key = str(path)
+        if key in self._submitted:
+            return None
+        self._submitted.add(key)
+        future = self._pool.submit(self._download, url, path)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        for future in self._futures:
+            future.result()
+        self._pool.shutdown(wait=True)
+        return dict(self.stats)
+
+    def summary(self):
+        s = dict(self.stats)
+        return (f"📥 Descargas: {s['new']} nuevas, {s['changed']} actualizadas, {s['unchanged']} sin cambios, "
+                f"{s['skipped']} ya existentes, {s['failed']} con error ({s['bytes'] / (1024 * 1024):.1f} MB bajados)")
@@ -0,0 +1,335 @@
+"""
+Cliente compartido para las llamadas a Gemini de los scripts OCR/scraping.
+
+Todas las llamadas `generate_content` pasan por `generate_text(modelo, prompt)`,
+que antes de ir a la API consulta una caché en disco (SQLite) direccionada por
+contenido: la clave es el SHA-256 de modelo + prompt. Los PDFs de bases y
+condiciones casi no cambian entre corridas nocturnas, así que un documento sin
+cambios no consume cuota ni agrega latencia.
+
+Solo las consultas que no están en caché van a la API, y cada una pasa antes por
+un limitador de ventana deslizante por modelo: se espera exactamente lo que falta
+para el próximo turno libre en lugar de dormir un intervalo fijo tras N llamadas.
+
+La caché expira entradas por antigüedad (TTL) y, si supera el tamaño máximo,
+elimina primero las menos usadas recientemente. Configuración por entorno:
+
+- GEMINI_CACHE_ENABLED   ("1" por defecto; "0" desactiva la caché)
+- GEMINI_CACHE_PATH      (archivo SQLite, por defecto .cache/gemini_responses.sqlite3)
+- GEMINI_CACHE_TTL_DAYS  (días de validez de una respuesta, por defecto 30)
+- GEMINI_CACHE_MAX_MB    (tamaño máximo de las respuestas guardadas, por defecto 200)
+- GEMINI_RATE_LIMITS     (requests por minuto por modelo, p. ej.
+                          "gemini-2.5-flash=10,gemini-2.5-flash-lite=15")
+- GEMINI_CONCURRENCY     (documentos procesados en paralelo por `map_concurrent` /
+                          `iter_concurrent`, por defecto 4; 1 = procesamiento secuencial)
+
+`genai.configure(...)` lo sigue haciendo cada script al inicio.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "1") != "0"
+GEMINI_CACHE_PATH = os.getenv("GEMINI_CACHE_PATH", os.path.join(".cache", "gemini_responses.sqlite3"))
+GEMINI_CACHE_TTL_DAYS = float(os.getenv("GEMINI_CACHE_TTL_DAYS", "30"))
+GEMINI_CACHE_MAX_MB = float(os.getenv("GEMINI_CACHE_MAX_MB", "200"))
+
+# Cuotas por minuto de cada modelo (plan gratuito); se pueden sobrescribir con GEMINI_RATE_LIMITS
+GEMINI_DEFAULT_RPM = 10
+GEMINI_RATE_LIMITS = {
+    "gemini-2.5-flash": 10,
+    "gemini-2.5-flash-lite": 15,
+}
+for _item in os.getenv("GEMINI_RATE_LIMITS", "").split(","):
+    if "=" in _item:
+        _model, _rpm = _item.split("=", 1)
+        GEMINI_RATE_LIMITS[_model.strip()] = float(_rpm)
+
+GEMINI_CONCURRENCY = max(1, int(os.getenv("GEMINI_CONCURRENCY", "4")))
+
+
+def prompt_key(model_name, prompt):
+    """Clave de caché: SHA-256 del nombre del modelo y el texto del prompt."""
+    digest = hashlib.sha256()
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Caché en disco de respuestas de Gemini (texto plano) sobre SQLite.
+
+    - `get(modelo, prompt)` devuelve el texto guardado o None (faltante o vencido).
+    - `put(modelo, prompt, texto)` guarda la respuesta y aplica la expulsión.
+    - `forget(modelo, prompt)` elimina una respuesta (p. ej. si no se pudo parsear),
+      para que el reintento vuelva a consultar a la API.
+
+    Lleva los contadores `hits`, `misses` y `expired` de la corrida.
+    """
+
+    def __init__(self, path=GEMINI_CACHE_PATH, ttl_days=GEMINI_CACHE_TTL_DAYS, max_mb=GEMINI_CACHE_MAX_MB):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+
+    def get(self, model_name, prompt):
+        key = prompt_key(model_name, prompt)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            response, created_at = row
+            if self.ttl > 0 and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return response
+
+    def put(self, model_name, prompt, response):
+        key = prompt_key(model_name, prompt)
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, size, now, now),
+            )
+            self.stored += 1
+            self._evict(now)
+            self._conn.commit()
+
+    def forget(self, model_name, prompt):
+        key = prompt_key(model_name, prompt)
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _evict(self, now):
+        """Borra lo vencido y, si se supera el tamaño máximo, lo menos usado recientemente."""
+        if self.ttl > 0:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        if self.max_bytes <= 0:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "stored": self.stored,
+            "entries": entries,
+            "bytes": total,
+        }
+
+
+class RateLimiter:
+    """
+    Limitador de ventana deslizante: como máximo `rate_per_min` llamadas en
+    cualquier intervalo de 60 segundos (la forma en que Gemini mide la cuota).
+
+    `reserve()` asigna a quien llama el próximo turno libre y devuelve cuántos
+    segundos faltan para él (0 si puede llamar ya): el turno es el momento actual o,
+    si ya hubo `rate_per_min` llamadas, 60 s después de la más antigua de ellas. El
+    turno queda reservado aunque haya que esperar, así varios hilos o corrutinas se
+    reparten los turnos sin competir; quien llama duerme el tiempo devuelto
+    (`acquire` lo hace por él).
+    """
+
+    def __init__(self, rate_per_min, window=60.0):
+        self.rate_per_min = rate_per_min
+        self.window = window
+        self.slots = deque(maxlen=max(1, int(rate_per_min)))
+        self.waits = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = now
+            if len(self.slots) == self.slots.maxlen:
+                slot = max(now, self.slots[0] + self.window)
+            self.slots.append(slot)
+            delay = slot - now
+            if delay > 0:
+                self.waits += 1
+                self.waited += delay
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(model_name):
+    """Limitador compartido del modelo (uno por proceso y por modelo)."""
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(model_name)
+        if limiter is None:
+            rpm = GEMINI_RATE_LIMITS.get(model_name, GEMINI_DEFAULT_RPM)
+            limiter = _LIMITERS[model_name] = RateLimiter(rpm)
+        return limiter
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_response_cache():
+    """Caché compartida del proceso (None si GEMINI_CACHE_ENABLED=0)."""
+    global _CACHE
+    if not GEMINI_CACHE_ENABLED:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ResponseCache()
+    return _CACHE
+
+
+def generate_text(model_name, prompt, use_cache=True):
+    """
+    Envía `prompt` al modelo `model_name` y devuelve `response.text`.
+    Si la misma combinación modelo + prompt ya fue respondida (y no venció),
+    devuelve la respuesta guardada sin llamar a la API; si no, espera turno en el
+    limitador del modelo antes de llamar.
+    """
+    cache = get_response_cache() if use_cache else None
+    if cache is not None:
+        cached = cache.get(model_name, prompt)
+        if cached is not None:
+            return cached
+
+    get_rate_limiter(model_name).acquire()
+    model = genai.GenerativeModel(model_name)
+    response = model.generate_content(prompt)
+    text = response.text
+
+    if cache is not None and text:
+        cache.put(model_name, prompt, text)
+    return text
+
+
+def forget_response(model_name, prompt):
+    """Quita de la caché una respuesta que resultó inservible (JSON inválido, etc.)."""
+    cache = get_response_cache()
+    if cache is not None:
+        cache.forget(model_name, prompt)
+
+
+def cache_summary():
+    """Resumen de la caché para el log de fin de corrida."""
+    cache = get_response_cache()
+    if cache is None:
+        return "🗄️ Caché Gemini desactivada (GEMINI_CACHE_ENABLED=0)"
+    s = cache.stats()
+    total = s["hits"] + s["misses"]
+    ratio = (100.0 * s["hits"] / total) if total else 0.0
+    return (f"🗄️ Caché Gemini: {s['hits']} aciertos, {s['misses']} fallos ({ratio:.0f}% aciertos, "
+            f"{s['expired']} vencidas), {s['entries']} entradas, {s['bytes'] / (1024 * 1024):.1f} MB")
+
+
+def map_concurrent(func, items, workers=GEMINI_CONCURRENCY):
+    """
+    Aplica `func` a cada elemento de `items` con hasta `workers` ejecuciones en vuelo
+    y devuelve los resultados en el orden de entrada (como `map`).
+
+    Pensado para el procesamiento por documento de cada banco (leer el PDF, llamar a
+    Gemini, parsear): mientras una llamada espera la respuesta de la API, las demás
+    avanzan. El ritmo real lo sigue marcando el limitador por modelo, que es seguro
+    entre hilos. Con `workers=1` se procesa en secuencia, igual que antes.
+
+    Una excepción en un elemento se registra y su resultado queda en None: no corta
+    el lote ni descarta los resultados de los demás.
+    """
+    return list(iter_concurrent(func, items, workers))
+
+
+def iter_concurrent(func, items, workers=GEMINI_CONCURRENCY):
+    """
+    Igual que `map_concurrent`, pero entrega cada resultado apenas están listos él y los
+    anteriores, mientras los siguientes siguen en vuelo: quien consume puede ir
+    escribiendo en la BD sin esperar a que termine todo el lote.
+    """
+    items = list(items)
+    func = _guarded(func)
+    if workers <= 1 or len(items) <= 1:
+        yield from (func(item) for item in items)
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemini") as pool:
+        yield from pool.map(func, items)
+
+
+def _guarded(func):
+    """Envuelve `func` para que un error de un elemento devuelva None en lugar de propagarse."""
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            print(f"⚠ Error procesando {str(item)[:120]}: {type(e).__name__}: {e}")
+            return None
+    return call
+
+
+def rate_limit_summary():
+    """Resumen de las esperas del limitador para el log de fin de corrida."""
+    if not _LIMITERS:
+        return "⏱️ Limitador Gemini: sin llamadas a la API"
+    parts = []
+    for model_name, limiter in sorted(_LIMITERS.items()):
+        parts.append(f"{model_name} ({limiter.rate_per_min:g}/min): {limiter.waits} esperas, {limiter.waited:.0f}s")
+    return "⏱️ Limitador Gemini: " + "; ".join(parts)
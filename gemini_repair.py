@@ -0,0 +1,217 @@
+"""
+Validación de la forma de las respuestas de Gemini y reparación barata.
+
+Cuando una respuesta no es JSON válido o le faltan las fechas, los flujos volvían a
+procesar el PDF completo (prompt largo y, en GNB, también Camelot). Antes de llegar a
+ese reintento se intenta, en orden:
+
+1. `parse_json_response`: reparación local del texto, sin llamadas. Quita los bloques
+   ```json, recorta el texto que rodea al JSON, elimina comas finales y cierra las
+   llaves/corchetes que quedaron abiertos cuando la respuesta vino cortada.
+2. `ResponseSchema.missing`: campos obligatorios vacíos o fechas fuera de formato
+   YYYY-MM-DD en cada registro.
+3. `fill_missing_fields`: una sola consulta corta (modelo liviano, GEMINI_REPAIR_MODEL)
+   con el tramo de VIGENCIA del texto ya extraído, que pide únicamente los campos
+   faltantes (valid_from / valid_to / offer_day) y los completa en los registros.
+
+Una respuesta que no se pudo usar (JSON inválido o campos obligatorios que siguen
+faltando) se quita de la caché con `forget_response`, y los reintentos de cada flujo
+pasan `use_cache=False`: si no, el reintento recibiría la misma respuesta guardada.
+
+Los contadores de la corrida se informan con `repair_summary()`.
+"""
+import json
+import os
+import re
+import threading
+
+from gemini_client import generate_text, forget_response
+
+GEMINI_REPAIR_MODEL = os.getenv("GEMINI_REPAIR_MODEL", "gemini-2.5-flash-lite")
+REASK_TEXT_BUDGET = 4000  # caracteres del tramo de VIGENCIA que se envían en la consulta corta
+DATE_FIELDS = {"valid_from", "valid_to"}
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+VIGENCIA_RE = re.compile(r"(?i)vigencia")
+FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+TRAILING_COMMA_RE = re.compile(r",\s*([\]}])")
+
+_STATS = {"repaired": 0, "unrepairable": 0, "reasks": 0, "reask_filled": 0}
+_STATS_LOCK = threading.Lock()
+
+
+def _count(key):
+    with _STATS_LOCK:
+        _STATS[key] += 1
+
+
+def _close_brackets(text):
+    """Cierra la cadena, las llaves y los corchetes que quedaron abiertos al final del texto."""
+    stack = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "[{":
+            stack.append("]" if ch == "[" else "}")
+        elif ch in "]}" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r",\s*$", "", text)
+    return text + "".join(reversed(stack))
+
+
+def parse_json_response(text):
+    """
+    JSON de la respuesta de Gemini, reparado localmente si hace falta; None si no se pudo.
+    """
+    text = FENCE_RE.sub("", text or "").strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        _count("unrepairable")
+        return None
+    body = TRAILING_COMMA_RE.sub(r"\1", text[min(starts):])
+    last_close = max(body.rfind("]"), body.rfind("}"))
+    last_object = body.rfind("}")
+    candidates = [
+        body,
+        body[:last_close + 1],                       # texto sobrante después del JSON
+        _close_brackets(body),                       # respuesta cortada
+        _close_brackets(body[:last_object + 1]),     # cortada a mitad de un registro
+    ]
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        _count("repaired")
+        return data
+    _count("unrepairable")
+    return None
+
+
+class ResponseSchema:
+    """
+    Forma esperada de un tipo de respuesta.
+
+    - `container`: clave del objeto que contiene la lista de registros (None si la
+      respuesta ya es la lista o un único registro).
+    - `required`: campos que no pueden quedar vacíos; los de DATE_FIELDS además
+      deben tener formato YYYY-MM-DD.
+    - `optional`: campos que se piden de paso cuando igual hay que consultar.
+    """
+
+    def __init__(self, required=("valid_from", "valid_to"), optional=("offer_day",), container=None):
+        self.required = tuple(required)
+        self.optional = tuple(optional)
+        self.container = container
+
+    def records(self, data):
+        if isinstance(data, dict) and self.container:
+            data = data.get(self.container, [])
+        if isinstance(data, dict):
+            data = [data]
+        return [r for r in data if isinstance(r, dict)] if isinstance(data, list) else []
+
+    @staticmethod
+    def _invalid(record, field):
+        value = str(record.get(field) or "").strip()
+        return not value or (field in DATE_FIELDS and not DATE_RE.match(value))
+
+    def missing(self, record):
+        """Campos obligatorios vacíos o con formato inválido en el registro."""
+        return [f for f in self.required if self._invalid(record, f)]
+
+
+def vigencia_excerpt(text, budget=REASK_TEXT_BUDGET):
+    """Tramo del texto alrededor de la primera mención de VIGENCIA (el inicio si no aparece)."""
+    text = text or ""
+    match = VIGENCIA_RE.search(text)
+    start = max(0, match.start() - 200) if match else 0
+    return text[start:start + budget]
+
+
+def ask_missing_fields(text, fields, context="", required=None, use_cache=True):
+    """
+    Consulta corta que pide solo `fields` a partir del tramo de VIGENCIA de `text`.
+    Devuelve {campo: valor} con los que vinieron con un valor válido ({} si ninguno).
+    Si falta alguno de `required` (por defecto, todos los pedidos) la respuesta no
+    queda en la caché.
+    """
+    pedidos = ", ".join(f'"{f}"' for f in fields)
+    prompt = f"""
+    Del siguiente fragmento de las bases y condiciones de una promoción bancaria{f" ({context})" if context else ""},
+    extrae únicamente estos campos: {pedidos}.
+    - valid_from / valid_to: fechas de inicio y fin de la VIGENCIA en formato YYYY-MM-DD.
+    - offer_day: días de la semana en que aplica, en singular y separados por coma
+      (ej: "Lunes, Martes"); si aplica todos los días: "Lunes, Martes, Miércoles, Jueves, Viernes, Sábado, Domingo".
+    Si un campo no aparece en el fragmento, devuélvelo como cadena vacía.
+    Devuelve SOLO un objeto JSON con esas claves, sin texto adicional.
+
+    FRAGMENTO:
+    {vigencia_excerpt(text)}
+    """
+    _count("reasks")
+    try:
+        raw = generate_text(GEMINI_REPAIR_MODEL, prompt, use_cache=use_cache)
+    except Exception as e:
+        print(f"⚠ Error en la consulta de campos faltantes: {e}")
+        return {}
+    data = parse_json_response(raw)
+    if not isinstance(data, dict):
+        forget_response(GEMINI_REPAIR_MODEL, prompt)
+        return {}
+    found = {}
+    for field in fields:
+        value = str(data.get(field) or "").strip()
+        if value and not (field in DATE_FIELDS and not DATE_RE.match(value)):
+            found[field] = value
+    if found:
+        _count("reask_filled")
+    if any(field not in found for field in (fields if required is None else required)):
+        forget_response(GEMINI_REPAIR_MODEL, prompt)
+    return found
+
+
+def fill_missing_fields(records, text, schema, context="", use_cache=True):
+    """
+    Completa en `records` los campos obligatorios de `schema` que falten (y, de paso, los
+    opcionales vacíos) con una sola consulta corta para todos los registros. Devuelve
+    los campos obligatorios que siguen faltando en algún registro.
+    """
+    missing = []
+    for record in records:
+        for field in schema.missing(record):
+            if field not in missing:
+                missing.append(field)
+    if not missing or not text:
+        return missing
+
+    fields = missing + [f for f in schema.optional
+                        if f not in missing and any(ResponseSchema._invalid(r, f) for r in records)]
+    found = ask_missing_fields(text, fields, context, required=missing, use_cache=use_cache)
+    for record in records:
+        for field, value in found.items():
+            if ResponseSchema._invalid(record, field):
+                record[field] = value
+    return [f for f in missing if any(f in schema.missing(r) for r in records)]
+
+
+def repair_summary():
+    """Resumen de reparaciones de respuestas para el log de fin de corrida."""
+    with _STATS_LOCK:
+        s = dict(_STATS)
+    return (f"🩹 Respuestas de Gemini: {s['repaired']} JSON reparados localmente, {s['unrepairable']} sin reparar, "
+            f"{s['reasks']} consultas cortas de campos faltantes ({s['reask_filled']} completaron datos)")
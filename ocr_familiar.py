@@ -1,17 +1,29 @@
 import os
 import re
 import pandas as pd
-import requests
 import pdfplumber
 import json
-import time
 import google.generativeai as genai
 from datetime import datetime
 import csv
 import  mysql.connector
 from difflib import SequenceMatcher
-from rapidfuzz import fuzz
 import unicodedata
+from collections import defaultdict
+from offers_db import (
+    get_offer_index, BatchInserter, UpdateAccumulator, apply_offer_update, touch_offers, commit_pending,
+    COMMIT_EVERY, COMMIT_EVERY_DOCS,
+)
+from offers_match import get_batch_scorer, best_position
+from gemini_client import (
+    generate_text, forget_response, cache_summary, rate_limit_summary, map_concurrent, iter_concurrent,
+    GEMINI_CONCURRENCY,
+)
+from pdf_text import ParsedPdf, page_cache_summary, read_section_text
+from prompt_compact import CompactProfile, PromptCompactor, compaction_summary
+from gemini_repair import ResponseSchema, parse_json_response, fill_missing_fields, repair_summary
+from downloads import download_pdf
+from ocr_state import OcrState
 
 DB_CONFIG = {
     "host" : "192.168.0.11",
@@ -25,9 +37,22 @@ LOG_FILE = "data/procesamiento.log"
 PDFS_CSV = "data/pdfs_totales.csv"
 OUTPUT_CSV = "data/gemini_resultados_ok.csv"
 
-GEMINI_REQUESTS = 0  # contador de requests en el minuto
-GEMINI_MAX_PER_MIN = 10  # límite por minuto modelo gemini-flash-2.5.
-GEMINI_RESET_TIME = 120    # tiempo de espera en segundos si se alcanza el límite
+# El límite de requests por minuto de cada modelo lo aplica gemini_client (GEMINI_RATE_LIMITS)
+GEMINI_MODEL = "gemini-2.5-flash"  # extracción de promociones del PDF
+GEMINI_MERCHANT_MODEL = "gemini-2.5-flash-lite"  # limpieza del nombre de comercio
+GEMINI_MERCHANT_BATCH_SIZE = int(os.getenv("GEMINI_MERCHANT_BATCH_SIZE", "40"))  # nombres por llamada
+GEMINI_TEXT_BUDGET = 50000  # caracteres del PDF que se envían en el prompt de extracción
+# Compactación del texto del PDF: VIGENCIA y MECÁNICA se envían sin modificar
+COMPACT_PROFILE = CompactProfile(
+    protect=[
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?vigencia\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?mec[aá]nica\b",
+    ],
+    boilerplate=[r"(?i)^banco familiar( s\.?a\.?e\.?c\.?a\.?)?\.?$"],
+)
+# Registros finales por PDF: sin fechas ISO u offer_day el PDF va al reintento completo
+RECORD_SCHEMA = ResponseSchema(required=("valid_from", "valid_to", "offer_day"), optional=())
+OCR_STATE_VERSION = "1"  # subir al cambiar prompts o reglas de extracción (invalida el estado incremental)
 
 
 def log_event(message):
@@ -171,17 +196,6 @@ def normalize_branch_fragment(text):
     return re.sub(r'[\s\.\-]', '', text.strip().lower())
 
 
-#FUNCION AUXILIAR PERMITE VERIFICAR LA CANTIDAD DE CONSULTAS REALIZADAS POR SEGUNDO, HASTA 10 POR MINUTO
-def check_gemini_rate_limit():
-    global GEMINI_REQUESTS
-    GEMINI_REQUESTS += 1
-
-    if GEMINI_REQUESTS >= GEMINI_MAX_PER_MIN:
-        print(f"⚠ Límite de {GEMINI_MAX_PER_MIN} requests alcanzado, esperando {GEMINI_RESET_TIME} segundos...")
-        time.sleep(GEMINI_RESET_TIME)
-        GEMINI_REQUESTS = 0  # resetear contador después de la espera
-
-
 #nueva función para normalizar.
 def normalize_simple(text):
     """Normaliza texto sin acentos, sin paréntesis y en minúsculas para comparación."""
@@ -192,7 +206,7 @@ def normalize_simple(text):
     return text.strip().lower()
 
 
-def insert_pdf_mysql(conn, record):
+def insert_pdf_mysql(conn, record, inserter=None):
     try:
         cur = conn.cursor()
 
@@ -218,38 +232,39 @@ def insert_pdf_mysql(conn, record):
         details = (record.get("details") or "").strip()
         url_logo = record.get("merchant_logo_url") or ""
 
-        cur.execute("""
-            INSERT INTO web_offers (
-                valid_to, valid_from, terms_raw, terms_conditions, source_file,
-                source, bank_name, payment_methods, offer_url, offer_day, merchant_name,
-                merchant_logo_url, merchant_logo_downloaded, merchant_location,
-                merchant_address, details, category_name, card_brand, benefit,
-                ai_response
-            ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
-            valid_to,
-            valid_from,
-            record.get("raw_text_snippet", ""),
-            record.get("terms_conditions", ""),
-            record.get("archivo", ""),
-            record.get("source", "PDF"),
-            "BANCO FAMILIAR",  # <-- en duro
-            payment_methods,
-            record.get("url", ""),
-            record.get("offer_day", ""),
-            merchant_name,
-            url_logo,
-            int(record.get("merchant_logo_downloaded", 0) or 0),
-            merchant_location,
-            merchant_address,
-            details,
-            category_name,
-            card_brand,
-            benefic,
-            record.get("gemini_response", "")
-        ))
+        row = {
+            "valid_to": valid_to,
+            "valid_from": valid_from,
+            "terms_raw": record.get("raw_text_snippet", ""),
+            "terms_conditions": record.get("terms_conditions", ""),
+            "source_file": record.get("archivo", ""),
+            "source": record.get("source", "PDF"),
+            "bank_name": "BANCO FAMILIAR",  # <-- en duro
+            "payment_methods": payment_methods,
+            "offer_url": record.get("url", ""),
+            "offer_day": record.get("offer_day", ""),
+            "merchant_name": merchant_name,
+            "merchant_logo_url": url_logo,
+            "merchant_logo_downloaded": int(record.get("merchant_logo_downloaded", 0) or 0),
+            "merchant_location": merchant_location,
+            "merchant_address": merchant_address,
+            "details": details,
+            "category_name": category_name,
+            "card_brand": card_brand,
+            "benefit": benefic,
+            "ai_response": record.get("gemini_response", "")
+        }
+        if inserter is not None:
+            # Modo por lotes: la fila queda en el buffer con id temporal
+            return inserter.add(row)
+        cur.execute(f"""
+            INSERT INTO web_offers ({', '.join(row)})
+            VALUES ({', '.join(['%s'] * len(row))})
+        """, tuple(row.values()))
         conn.commit()
         print(f"🆕 Insert OK: {merchant_name} ({merchant_location})")
+        # Fila tal como quedó en la BD, para mantener al día el índice en memoria
+        return {"id": cur.lastrowid, **row}
 
     except mysql.connector.Error as e:
         print(f"⚠ Error insertando en MySQL: {e}")
@@ -258,12 +273,77 @@ def insert_pdf_mysql(conn, record):
         cur.close()
 
 
-def upsert_offer_mysql(conn, record, processed_ids=None):
+def normalize_familiar_merchant_name(merchant_name_raw, merchant_location):
+    """Nombre de comercio tal como se guarda y compara en web_offers (reglas STOCK, SUPERSEIS, FARMAOLIVA, PUMA)."""
+    merchant_name = normalize_merchant_city(merchant_name_raw, merchant_location)
+    merchant_name = re.sub(r'\b(STOCK|SUPERSEIS|GRAN VIA)\s*-\s*\1\b', r'\1', merchant_name, flags=re.IGNORECASE)
+    merchant_name = re.sub(r'\b(CENTRAL|ASUNCION)\b', '', merchant_name, flags=re.IGNORECASE)
+    merchant_name = re.sub(r'\s{2,}', ' ', merchant_name).strip(" -")
+
+    # --- Reglas especiales ---
+    if re.search(r'\bSTOCK\b', merchant_name, flags=re.IGNORECASE):
+        merchant_name = re.sub(r'^(SUP\.?|SUPERMERCADO)\s*\.?-?\s*', '', merchant_name, flags=re.IGNORECASE)
+        merchant_name = re.sub(r'^\s*STOCK\s*[-–]?\s*', 'STOCK - ', merchant_name, flags=re.IGNORECASE)
+        merchant_name = re.sub(r'\s{2,}', ' ', merchant_name).strip(" -")
+        merchant_name = re.sub(
+            r'^(STOCK\s*-\s*[A-Za-z0-9.°ºáéíóúÁÉÍÓÚñÑ\s]+?)\s*[-–]\s*([A-Za-z0-9.°ºáéíóúÁÉÍÓÚñÑ\s]+)$',
+            lambda m: m.group(1) if normalize_branch_fragment(m.group(1)) == normalize_branch_fragment(m.group(2)) else m.group(0),
+            merchant_name,
+            flags=re.IGNORECASE
+        )
+        if re.fullmatch(r'\s*STOCK\s*', merchant_name, flags=re.IGNORECASE):
+            merchant_name = "STOCK"
+        else:
+            merchant_name = re.sub(r'^\s*STOCK\s*[-–]?\s*', 'STOCK - ', merchant_name, flags=re.IGNORECASE)
+            merchant_name = re.sub(r'\s{2,}', ' ', merchant_name).strip(" -")
+
+    elif re.match(r'^\s*SUPERSEIS\b', merchant_name, flags=re.IGNORECASE):
+        merchant_name = re.sub(
+            r'\b(SUPERSEIS\s*-\s*)?(Express\s*)?([A-Za-z0-9.°ºáéíóúÁÉÍÓÚñÑ\s]+?)'
+            r'(\s*,?\s*(Guaira|Itapua|Cordillera|Alto\s*Parana|Paraná|Central|Caaguazu|San\s*Pedro))?$',
+            lambda m: f"SUPERSEIS - {m.group(3).strip()}" if m.group(3).strip() else "SUPERSEIS",
+            merchant_name,
+            flags=re.IGNORECASE
+        )
+
+    elif re.match(r'^\s*FARMAOLIVA\b', merchant_name, flags=re.IGNORECASE):
+        merchant_name = re.sub(r'^\s*(FARMAOLIVA)\s*[-–]?\s*', 'FARMAOLIVA - ', merchant_name, flags=re.IGNORECASE)
+
+    elif re.match(r'^\s*PUMA\s+ENERGY\b', merchant_name, flags=re.IGNORECASE):
+        parts = [p.strip() for p in re.split(r'-', merchant_name)]
+        if len(parts) == 2 and parts[1].lower() == "estaciones de servicio":
+            # Solo "PUMA ENERGY"
+            merchant_name = "PUMA ENERGY"
+        elif len(parts) > 2 and parts[1].lower() == "estaciones de servicio":
+            # "PUMA ENERGY - ESTADO/CIUDAD"
+            merchant_name = f"PUMA ENERGY - {parts[2]}"
+
+    return merchant_name
+
+
+def familiar_match_query(record):
+    """Clave de nombre con la que upsert_offer_mysql compara un registro (para precalcular el scoring)."""
+    merchant_name_raw = (record.get("merchant_name") or record.get("merchant") or "").strip()
+    merchant_location = (record.get("location") or record.get("merchant_location") or "").strip()
+    return familiar_name_key(normalize_familiar_merchant_name(merchant_name_raw, merchant_location))
+
+
+def familiar_name_key(name):
+    """Clave de nombre del índice: nombre de sucursal simplificado y en casefold."""
+    return simplify_branch_name(name).casefold()
+
+
+def upsert_offer_mysql(conn, record, processed_ids=None, indices=None, inserter=None, updates=None):
+    if inserter is not None:
+        inserter.track_ids(processed_ids)
     if processed_ids is None:
         processed_ids = set()
 
     cur = conn.cursor(dictionary=True)
     bank_name = "BANCO FAMILIAR"
+    index = get_offer_index(conn, bank_name, indices, name_key=familiar_name_key)
+    if inserter is not None:
+        inserter.track_index(index)
 
     variable_fields = [
         "offer_url","merchant_logo_url", "valid_from", "valid_to", "terms_conditions",
@@ -292,74 +372,29 @@ def upsert_offer_mysql(conn, record, processed_ids=None):
             record["merchant_logo_url"] = record["merchant_logo_url"]
 
         # --- Normalización de merchant_name ---
-        merchant_name = normalize_merchant_city(merchant_name_raw, merchant_location)
-        merchant_name = re.sub(r'\b(STOCK|SUPERSEIS|GRAN VIA)\s*-\s*\1\b', r'\1', merchant_name, flags=re.IGNORECASE)
-        merchant_name = re.sub(r'\b(CENTRAL|ASUNCION)\b', '', merchant_name, flags=re.IGNORECASE)
-        merchant_name = re.sub(r'\s{2,}', ' ', merchant_name).strip(" -")
-
-        # --- Reglas especiales ---
-        if re.search(r'\bSTOCK\b', merchant_name, flags=re.IGNORECASE):
-            merchant_name = re.sub(r'^(SUP\.?|SUPERMERCADO)\s*\.?-?\s*', '', merchant_name, flags=re.IGNORECASE)
-            merchant_name = re.sub(r'^\s*STOCK\s*[-–]?\s*', 'STOCK - ', merchant_name, flags=re.IGNORECASE)
-            merchant_name = re.sub(r'\s{2,}', ' ', merchant_name).strip(" -")
-            merchant_name = re.sub(
-                r'^(STOCK\s*-\s*[A-Za-z0-9.°ºáéíóúÁÉÍÓÚñÑ\s]+?)\s*[-–]\s*([A-Za-z0-9.°ºáéíóúÁÉÍÓÚñÑ\s]+)$',
-                lambda m: m.group(1) if normalize_branch_fragment(m.group(1)) == normalize_branch_fragment(m.group(2)) else m.group(0),
-                merchant_name,
-                flags=re.IGNORECASE
-            )
-            if re.fullmatch(r'\s*STOCK\s*', merchant_name, flags=re.IGNORECASE):
-                merchant_name = "STOCK"
-            else:
-                merchant_name = re.sub(r'^\s*STOCK\s*[-–]?\s*', 'STOCK - ', merchant_name, flags=re.IGNORECASE)
-                merchant_name = re.sub(r'\s{2,}', ' ', merchant_name).strip(" -")
-
-        elif re.match(r'^\s*SUPERSEIS\b', merchant_name, flags=re.IGNORECASE):
-            merchant_name = re.sub(
-                r'\b(SUPERSEIS\s*-\s*)?(Express\s*)?([A-Za-z0-9.°ºáéíóúÁÉÍÓÚñÑ\s]+?)'
-                r'(\s*,?\s*(Guaira|Itapua|Cordillera|Alto\s*Parana|Paraná|Central|Caaguazu|San\s*Pedro))?$',
-                lambda m: f"SUPERSEIS - {m.group(3).strip()}" if m.group(3).strip() else "SUPERSEIS",
-                merchant_name,
-                flags=re.IGNORECASE
-            )
-
-        elif re.match(r'^\s*FARMAOLIVA\b', merchant_name, flags=re.IGNORECASE):
-            merchant_name = re.sub(r'^\s*(FARMAOLIVA)\s*[-–]?\s*', 'FARMAOLIVA - ', merchant_name, flags=re.IGNORECASE)
-            cur.execute("""
-                SELECT * FROM web_offers
-                WHERE bank_name=%s
-                AND merchant_address=%s
-                AND (merchant_location IS NULL OR TRIM(merchant_location) = '')
-                AND merchant_name LIKE 'FARMAOLIVA%%'
-                LIMIT 1
-            """, (bank_name, merchant_address))
-            farma_existing = cur.fetchone()
+        merchant_name = normalize_familiar_merchant_name(merchant_name_raw, merchant_location)
+
+        # --- FARMAOLIVA: reutilizar el registro con dirección idéntica y location vacío ---
+        if (re.match(r'^\s*FARMAOLIVA\b', merchant_name, flags=re.IGNORECASE)
+                and not re.search(r'\bSTOCK\b', merchant_name, flags=re.IGNORECASE)):
+            farma_existing = next((
+                ex for ex in index.find("address", {"merchant_address": merchant_address})
+                if not (ex.get("merchant_location") or "").strip()
+                and (ex.get("merchant_name") or "").upper().startswith("FARMAOLIVA")
+            ), None)
             if farma_existing:
                 log_event(f"💊 FARMAOLIVA existente con dirección idéntica y location vacío — se actualizará (ID={farma_existing['id']}).")
-                update_fields, update_values = [], []
+                changes = {}
                 for f in variable_fields:
                     val = record.get(f)
                     if val not in [None, "", "NaN"]:
-                        update_fields.append(f"{f}=%s")
-                        update_values.append(val)
-                update_fields += ["updated_at=NOW()", "status='A'"]
-                sql = f"UPDATE web_offers SET {', '.join(update_fields)} WHERE id=%s"
-                update_values.append(farma_existing["id"])
-                cur.execute(sql, tuple(update_values))
-                conn.commit()
+                        changes[f] = val
+                apply_offer_update(conn, cur, farma_existing["id"], changes, inserter, updates, farma_existing)
+                index.update(farma_existing["id"], {**changes, "status": "A"})
                 log_event(f"✅ FARMAOLIVA actualizado sin cambiar merchant_name (ID={farma_existing['id']})")
                 processed_ids.add(farma_existing["id"])
                 cur.close()
-                return
-
-        elif re.match(r'^\s*PUMA\s+ENERGY\b', merchant_name, flags=re.IGNORECASE):
-            parts = [p.strip() for p in re.split(r'-', merchant_name)]
-            if len(parts) == 2 and parts[1].lower() == "estaciones de servicio":
-                # Solo "PUMA ENERGY"
-                merchant_name = "PUMA ENERGY"
-            elif len(parts) > 2 and parts[1].lower() == "estaciones de servicio":
-                # "PUMA ENERGY - ESTADO/CIUDAD"
-                merchant_name = f"PUMA ENERGY - {parts[2]}"
+                return farma_existing["id"]
 
         record.update({
             "merchant_name": merchant_name,
@@ -370,69 +405,50 @@ def upsert_offer_mysql(conn, record, processed_ids=None):
             "payment_methods": payment_methods,
             "terms_conditions": terms_conditions,
         })
-        simplified_name = simplify_branch_name(merchant_name)
-
-        # --- 🔍 Buscar registros existentes ---
-        cur.execute("SELECT * FROM web_offers WHERE bank_name=%s", (bank_name,))
-        existing_records = cur.fetchall()
+        name_key = familiar_name_key(merchant_name)
 
+        # --- 🔍 Buscar candidatos en el índice en memoria ---
         best_match = None
         best_score = 0
 
-        for existing in existing_records:
-            # ⚠️ Evitar actualizar un ID ya procesado en esta sesión
-            if existing["id"] in processed_ids:
-                continue
+        if merchant_address:
+            # Solo filas con la misma dirección pueden coincidir (exacta o fuerte)
+            loc_key = index.key_for("location", record)
+            cat_key = index.key_for("category", record)
+            for existing in index.find("address", record):
+                # ⚠️ Evitar actualizar un ID ya procesado en esta sesión
+                if existing["id"] in processed_ids:
+                    continue
 
-            existing_category = (existing.get("category_name") or "").strip()
-            category_eq = category_name.casefold() == existing_category.casefold()
-            existing_addr = (existing.get("merchant_address") or "").strip()
-            existing_loc = (existing.get("merchant_location") or "").strip()
-            existing_name = (existing.get("merchant_name") or "").strip()
-
-            def normalize_case(t): return t.casefold()
-            addr_eq = normalize_case(merchant_address) == normalize_case(existing_addr)
-            loc_eq = normalize_case(merchant_location) == normalize_case(existing_loc)
-            cat_eq = normalize_case(category_name) == normalize_case(existing_category)
-
-            # --- Coincidencia exacta address + location + categoría ---
-            if merchant_address and merchant_location and addr_eq and loc_eq:
-                best_match, best_score = existing, 100
-                log_event(f"📍 Coincidencia exacta address+location ({merchant_address}, {merchant_location})")
-                break  # ✅ mejor coincidencia posible
-
-            # --- Coincidencia por address + categoría ---
-            elif merchant_address and addr_eq and cat_eq:
-                best_match, best_score = existing, 95
-                log_event(f"🏠 Coincidencia address ({merchant_address})")
-                if merchant_location and not existing_loc:
-                    existing["merchant_location"] = merchant_location
-                break  # ✅ suficientemente fuerte, no seguimos
-
-            # --- Coincidencia por location + nombre (sin address) ---
-            elif merchant_location and not merchant_address and cat_eq:
-                simplified_existing = simplify_branch_name(existing_name)
-                name_score = fuzz.ratio(simplified_name.casefold(), simplified_existing.casefold())
-                if name_score > best_score and name_score >= 70:
-                    best_match, best_score = existing, name_score
-                    log_event(
-                        f"📌 Coincidencia location+merchant_name "
-                        f"({merchant_location}, {merchant_name}) - similitud {name_score:.2f}"
-                    )
-                # ⚠️ No hacemos break, seguimos buscando mejores matches
-
-            # --- Coincidencia solo por nombre ---
-            elif not merchant_address and not merchant_location:
-                simplified_existing = simplify_branch_name(existing_name)
-                name_score = fuzz.ratio(simplified_name.casefold(), simplified_existing.casefold())
-                if name_score > best_score and name_score >= 75:
-                    best_match, best_score = existing, name_score
-                    log_event(
-                        f"🏷️ Coincidencia por merchant_name "
-                        f"({merchant_name}) - similitud {name_score:.2f}"
-                    )
-                # ⚠️ Tampoco hacemos break aquí
-     
+                # --- Coincidencia exacta address + location ---
+                if merchant_location and index.key_of(existing, "location") == loc_key:
+                    best_match, best_score = existing, 100
+                    log_event(f"📍 Coincidencia exacta address+location ({merchant_address}, {merchant_location})")
+                    break  # ✅ mejor coincidencia posible
+
+                # --- Coincidencia por address + categoría ---
+                if index.key_of(existing, "category") == cat_key:
+                    best_match, best_score = existing, 95
+                    log_event(f"🏠 Coincidencia address ({merchant_address})")
+                    break  # ✅ suficientemente fuerte, no seguimos
+        else:
+            if merchant_location:
+                # --- Coincidencia por location + nombre (sin address), misma categoría ---
+                candidates, threshold = index.find("category", record), 70
+                match_msg = f"📌 Coincidencia location+merchant_name ({merchant_location}, {merchant_name})"
+            else:
+                # --- Coincidencia solo por nombre ---
+                candidates, threshold = index.all(), 75
+                match_msg = f"🏷️ Coincidencia por merchant_name ({merchant_name})"
+            candidates = [ex for ex in candidates if ex["id"] not in processed_ids]
+
+            # Similitud de nombre contra todos los candidatos a la vez (vector de cdist);
+            # se queda con el primer máximo que alcance el umbral
+            name_scores = get_batch_scorer(index).scores("name", name_key, candidates)
+            pos = best_position(name_scores, threshold)
+            if pos is not None:
+                best_match, best_score = candidates[pos], float(name_scores[pos])
+                log_event(f"{match_msg} - similitud {best_score:.2f}")
 
         # --- 🔄 Actualizar si hay match ---
         if best_match:
@@ -457,19 +473,20 @@ def upsert_offer_mysql(conn, record, processed_ids=None):
                         changed_fields.append(f)
 
                 if changed_fields:
-                    update_fields = [f"{f}=%s" for f in changed_fields] + ["updated_at=NOW()", "status='A'"]
-                    update_values = [record[f] if f != "merchant_name" else csv_name for f in changed_fields]
-                    update_values.append(best_match["id"])
-                    sql = f"UPDATE web_offers SET {', '.join(update_fields)} WHERE id=%s"
-                    cur.execute(sql, tuple(update_values))
-                    conn.commit()
+                    changes = {f: record[f] if f != "merchant_name" else csv_name for f in changed_fields}
+                    apply_offer_update(conn, cur, best_match["id"], changes, inserter, updates, best_match)
+                    index.update(best_match["id"], {**changes, "status": "A"})
                     processed_ids.add(best_match["id"])  # ✅ evitar duplicación posterior
                     log_event(f"✅ Actualizado (ID={best_match['id']}) con campos: {', '.join(changed_fields)}")
                 else:
                     log_event(f"🟢 Registro existente sin cambios (ID={best_match['id']})")
+            return best_match["id"]
         else:
-            insert_pdf_mysql(conn, record)
+            new_row = insert_pdf_mysql(conn, record, inserter)
+            if new_row:
+                index.add(new_row)
             log_event(f"🆕 Insertado nuevo registro ({merchant_name})")
+            return new_row["id"] if new_row else None
 
     except mysql.connector.Error as e:
         conn.rollback()
@@ -477,6 +494,55 @@ def upsert_offer_mysql(conn, record, processed_ids=None):
     finally:
         cur.close()
 
+def upsert_familiar_batch(conn, records, indices):
+    """
+    Upsert de un bloque de filas: primero se puntúan juntas contra la BD (un cdist por
+    campo) y luego se aplican en orden con upsert_offer_mysql.
+    Las filas nuevas y los cambios se acumulan y se confirman cada COMMIT_EVERY registros
+    (y al final, aunque el bucle se corte).
+    Devuelve {ruta del PDF: ids de web_offers de sus registros}, sin los PDFs de un tramo
+    cuya escritura falló.
+    """
+    if not records:
+        return {}
+    index = get_offer_index(conn, "BANCO FAMILIAR", indices, name_key=familiar_name_key)
+    get_batch_scorer(index).prime({"name": [familiar_match_query(r) for r in records]})
+    log_event(f"🧮 Scoring por lotes preparado: {len(records)} registros contra {len(index)} filas de la BD")
+
+    inserter = BatchInserter(conn)
+    updates = UpdateAccumulator(conn)
+    offer_ids = defaultdict(set)  # PDF → ids (los temporales se reemplazan al volcar el inserter)
+    pending_pdfs, failed_pdfs = set(), set()  # PDFs del tramo sin confirmar / con escritura fallida
+
+    def commit_block():
+        try:
+            commit_pending(conn, inserter, updates)
+        except mysql.connector.Error as e:
+            conn.rollback()
+            log_event(f"⚠ Error MySQL en la escritura por lotes: {e}")
+            failed_pdfs.update(pending_pdfs)
+        pending_pdfs.clear()
+
+    try:
+        for n, record in enumerate(records, 1):
+            pending_pdfs.add(record.get("pdf_path"))
+            try:
+                row_id = upsert_offer_mysql(conn, record, indices=indices, inserter=inserter, updates=updates)
+                if row_id is not None:
+                    inserter.track_ids(offer_ids[record.get("pdf_path")])
+                    offer_ids[record.get("pdf_path")].add(row_id)
+            except Exception as e:
+                log_event(f"⚠ Error en MySQL: {e}")
+            if n % COMMIT_EVERY == 0:
+                commit_block()
+    finally:
+        commit_block()
+        log_event(f"💾 Inserción por lotes: {inserter.inserted} registros nuevos "
+                  f"(bloques de {inserter.chunk_size}, {inserter.failed} con error)")
+        log_event(f"💾 Actualización por lotes: {updates.updated} registros en {updates.statements} sentencias")
+    return {pdf: ids for pdf, ids in offer_ids.items() if pdf not in failed_pdfs}
+
+
 def ajustar_nombre_comercio(nombre_csv, nombre_pdf, umbral=0.7):
     """
     Devuelve el nombre del comercio ajustado combinando el nombre base (CSV)
@@ -563,24 +629,27 @@ if not GEMINI_API_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-def extract_text_with_gemini(filepath):
-    """Extrae texto del PDF usando Google Gemini"""
+def extract_text_with_gemini(filepath, use_cache=True):
+    """
+    Extrae texto del PDF usando Google Gemini.
+    Devuelve (respuesta, texto completo, prompt): el prompt sirve para quitar de la caché
+    una respuesta que después resulte incompleta.
+    """
     try:
-        # Primero extraemos el texto básico del PDF
-        text_pages = []
-        with pdfplumber.open(filepath) as pdf:
-            for p in pdf.pages:
-                tx = p.extract_text() or ""
-                text_pages.append(tx)
-
-        full_text = "\n".join(text_pages).strip()
+        # Primero extraemos el texto básico del PDF (caché de páginas por hash del archivo).
+        # full_text es el texto completo, sin compactar: lo usan el parseo, los fallbacks
+        # locales y los campos que van a la BD. Solo el prompt lleva la copia compactada y
+        # recortada a GEMINI_TEXT_BUDGET (las páginas ya están en memoria).
+        compactor = PromptCompactor(COMPACT_PROFILE)
+        with ParsedPdf(filepath) as pdf:
+            full_text = "\n".join(pdf.pages_text()).strip()
+            prompt_text = read_section_text(pdf, max_chars=GEMINI_TEXT_BUDGET, clean=compactor.page).strip()
+        compactor.record()
 
         if not full_text:
-            return None, None
+            return None, None, None
 
         # Usar Gemini para análisis
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
         prompt = f"""
         Analiza el siguiente texto de una promoción bancaria. 
         Concéntrate EXCLUSIVAMENTE en el contenido que aparece después del encabezado 
@@ -672,22 +741,25 @@ def extract_text_with_gemini(filepath):
         }}
 
         TEXTO A ANALIZAR:
-        {full_text[:50000]}
+        {prompt_text[:GEMINI_TEXT_BUDGET]}
 
         IMPORTANTE:
         - Si no se pueden extraer fechas tras una revisión completa, devuelve únicamente: {{"error": "No se pudo extraer VIGENCIA"}}.
         - Mantén estrictamente la estructura de JSON indicada.
         """
 
-        response = model.generate_content(prompt)
-        extracted_text = response.text.strip()
+        extracted_text = generate_text(GEMINI_MODEL, prompt, use_cache=use_cache).strip()
 
-        # Limpiar si viene envuelto en bloques markdown
+        # Limpiar si viene envuelto en bloques markdown (y reparar localmente JSON cortado o con texto extra)
         extracted_text = re.sub(r'^```json\s*|\s*```$', '', extracted_text)
+        data = parse_json_response(extracted_text)
 
-
-        try:
-            data = json.loads(extracted_text)
+        if data is None:
+            print("⚠ JSON inválido devuelto por Gemini")
+            forget_response(GEMINI_MODEL, prompt)  # que el reintento vuelva a consultar a la API
+        else:
+            if isinstance(data, dict) and "error" in data:
+                forget_response(GEMINI_MODEL, prompt)  # no cachear la falta de VIGENCIA: se reintenta
             data = call_gemini_two_merchant(data)
 
             for c in data.get("comercios", []):
@@ -696,17 +768,14 @@ def extract_text_with_gemini(filepath):
                 # Forzar guion entre merchant y location si existe location
                 if "FARMACIA" in name.upper():
                     c["merchant"] = f"{name} - {loc}" if loc else name
-            
+
             extracted_text = json.dumps(data, ensure_ascii=False)
-            
-        except json.JSONDecodeError:
-            print("⚠ JSON inválido devuelto por Gemini")
 
-        return extracted_text, full_text
+        return extracted_text, full_text, prompt
 
     except Exception as e:
         print(f"⚠ Error en Gemini API: {e}")
-        return None, None
+        return None, None, None
 
 
 def call_gemini_two_merchant(parsed):
@@ -719,9 +788,6 @@ def call_gemini_two_merchant(parsed):
         if not merchant_name:
             return parsed  # No hay nombre que limpiar
 
-        # Inicializa modelo Gemini
-        model = genai.GenerativeModel("gemini-2.5-flash-lite")
-
         prompt = f"""
         Tienes el siguiente nombre de comercio: "{merchant_name}".
 
@@ -737,22 +803,15 @@ def call_gemini_two_merchant(parsed):
           {{ "merchant": "NOMBRE_CORREGIDO" }}
         """
 
-
-        check_gemini_rate_limit()
-        response = model.generate_content(prompt)
-        cleaned = response.text.strip()
+        cleaned = generate_text(GEMINI_MERCHANT_MODEL, prompt).strip()
         cleaned = re.sub(r'^```json\s*|\s*```$', '', cleaned)
 
         # Intentar parsear JSON devuelto por Gemini
         data = json.loads(cleaned)
         new_merchant = data.get("merchant", "").strip()
-        loc = parsed.get("location", "").strip()
 
-        # Forzar guion entre merchant y location
-        if loc and loc not in new_merchant:
-            parsed["merchant"] = f"{new_merchant} - {loc}"
-        else:
-            parsed["merchant"] = new_merchant
+        # Forzar guion entre merchant y location (misma regla que la limpieza local y por lotes)
+        parsed["merchant"] = merchant_with_location(new_merchant, parsed.get("location", ""))
 
         # Solo reemplaza si Gemini devolvió algo diferente
 
@@ -766,6 +825,172 @@ def call_gemini_two_merchant(parsed):
         return parsed
 
 
+# Reglas de limpieza de merchant (las mismas del prompt de call_gemini_two_merchant), precompiladas
+MERCHANT_SEPARATOR_RE = re.compile(r"\s*[-–—]+\s*")
+MERCHANT_GENERIC_PREFIXES = {
+    "FARMACIAS": "FARMACIA",
+    "SUPERMERCADOS": "SUPERMERCADO",
+    "OPTICAS": "OPTICA",
+}
+# Se aplica sobre normalize_simple(nombre), así "ÓPTICAS" también coincide
+MERCHANT_GENERIC_RE = re.compile(r"^(" + "|".join(MERCHANT_GENERIC_PREFIXES) + r")\b", re.IGNORECASE)
+MERCHANT_ALLOWED_RE = re.compile(r"^[0-9A-Za-zÁÉÍÓÚÜáéíóúüÑñ.,&'°º/ -]+$")
+
+
+def merchant_with_location(name, location):
+    """Agrega " - location" al nombre si la location no figura ya en él (sin distinguir acentos ni mayúsculas)."""
+    loc = re.sub(r"\s+", " ", str(location or "")).strip()
+    if loc and normalize_simple(loc) not in normalize_simple(name):
+        return f"{name} - {loc}"
+    return name
+
+
+def _merchant_stem(token):
+    token = normalize_simple(token).upper()
+    return token[:-1] if len(token) > 4 and token.endswith("S") else token
+
+
+def clean_merchant_name_local(merchant_name, location=""):
+    """
+    Limpieza determinística de merchant_name, sin Gemini:
+    - unifica los separadores ('-', '–', '—', '--') en un solo guion medio,
+    - elimina segmentos repetidos ("STOCK - STOCK" → "STOCK"),
+    - quita la palabra genérica inicial si luego se repite el nombre
+      ("FARMACIAS - FARMACIA CENTRAL" / "FARMACIAS FARMACIA CENTRAL" → "FARMACIA CENTRAL"),
+    - agrega " - location" si la location no está ya en el nombre.
+
+    Devuelve (nombre, confiable). `confiable` es False cuando quedan señales que las
+    reglas no resuelven (caracteres raros, más de dos segmentos, palabras repetidas),
+    y en ese caso hay que escalar a Gemini.
+    """
+    name = re.sub(r"\s+", " ", str(merchant_name or "")).strip()
+    if not name:
+        return name, True
+
+    name = MERCHANT_SEPARATOR_RE.sub(" - ", name).strip(" -")
+
+    # Palabra genérica inicial seguida del mismo rubro en singular
+    m = MERCHANT_GENERIC_RE.match(normalize_simple(name))
+    if m and " " in name:
+        singular = MERCHANT_GENERIC_PREFIXES[m.group(1).upper()]
+        rest = name.split(" ", 1)[1].strip(" -")
+        if normalize_simple(rest).upper().startswith(singular):
+            name = rest
+
+    segments = []
+    for seg in name.split(" - "):
+        seg = seg.strip()
+        if seg and (not segments or normalize_simple(seg) != normalize_simple(segments[-1])):
+            segments.append(seg)
+    name = " - ".join(segments)
+
+    tokens = [_merchant_stem(t) for t in re.split(r"[\s-]+", name) if t]
+    confident = (
+        bool(MERCHANT_ALLOWED_RE.match(name))
+        and len(segments) <= 2
+        and len(tokens) == len(set(tokens))
+    )
+
+    return merchant_with_location(name, location), confident
+
+
+def clean_merchant_names(records):
+    """
+    Limpieza de merchant de todos los registros: primero las reglas locales y solo los
+    nombres dudosos van a Gemini (por lotes). Devuelve los contadores de la corrida.
+    """
+    escalated = []
+    local = 0
+    for record in records:
+        raw = str(record.get("merchant") or "").strip()
+        if not raw:
+            continue
+        cleaned, confident = clean_merchant_name_local(raw, record.get("location", ""))
+        if confident:
+            record["merchant"] = cleaned
+            local += 1
+        else:
+            escalated.append(record)
+
+    batched, fallback, retries = call_gemini_merchants_batch(escalated)
+    calls = -(-len(escalated) // GEMINI_MERCHANT_BATCH_SIZE) + retries + fallback
+    return {
+        "names": local + len(escalated),
+        "local": local,
+        "escalated": len(escalated),
+        "llm_calls": calls,
+        "llm_calls_avoided": local + len(escalated) - calls,
+    }
+
+
+def call_gemini_merchants_batch(records):
+    """
+    Variante por lotes de call_gemini_two_merchant: envía hasta GEMINI_MERCHANT_BATCH_SIZE
+    nombres de comercio (con su location) en un solo prompt, como arreglo JSON indexado,
+    y aplica los nombres corregidos por índice. Un lote que falla entero se reintenta una
+    vez; solo los registros que Gemini no devuelve se limpian con la llamada individual.
+    Modifica `records` en el lugar y devuelve
+    (corregidos_por_lote, corregidos_individualmente, lotes_reintentados).
+    """
+    pending = [r for r in records if str(r.get("merchant") or "").strip()]
+    batched = fallback = retries = 0
+
+    for start in range(0, len(pending), GEMINI_MERCHANT_BATCH_SIZE):
+        chunk = pending[start:start + GEMINI_MERCHANT_BATCH_SIZE]
+        entries = [
+            {"i": i, "merchant": str(r.get("merchant") or "").strip(), "location": str(r.get("location") or "").strip()}
+            for i, r in enumerate(chunk)
+        ]
+
+        prompt = f"""
+        Tienes la siguiente lista JSON de nombres de comercio, cada uno con su índice "i" y su "location":
+        {json.dumps(entries, ensure_ascii=False)}
+
+        Corrige y normaliza CADA "merchant" siguiendo estas reglas:
+        - Si contiene repeticiones (por ejemplo: "FARMACIAS - FARMACIA ASUNCION HORQUETA"), 
+          elimina la parte genérica y conserva solo la más específica ("FARMACIA ASUNCION HORQUETA").
+        - Si el texto tiene múltiples separadores ('-', '–', '—'), unifícalos en un solo guion medio.
+        - Si empieza con palabras genéricas como "FARMACIAS", "SUPERMERCADOS", "ÓPTICAS", 
+          elimínalas solo si luego se repite un nombre similar ("FARMACIAS FARMACIA CENTRAL" → "FARMACIA CENTRAL").
+        - No modifiques nombres válidos como "COPETROL - SAN LORENZO" ni elimines ubicaciones.
+        - No devuelvas texto adicional ni explicaciones.
+        - Devuelve EXCLUSIVAMENTE un arreglo JSON con un objeto por cada elemento recibido,
+          conservando su índice: [{{ "i": 0, "merchant": "NOMBRE_CORREGIDO" }}, ...]
+        """
+
+        # Si el lote entero falla (error de la API o JSON irreparable) se reintenta una vez
+        # antes de pasar a las llamadas individuales
+        corrected = {}
+        for attempt in range(2):
+            try:
+                data = parse_json_response(generate_text(GEMINI_MERCHANT_MODEL, prompt))
+            except Exception as e:
+                print(f"⚠ Error en call_gemini_merchants_batch: {e}")
+                data = None
+            for item in data if isinstance(data, list) else []:
+                if not isinstance(item, dict):
+                    continue
+                idx = item.get("i")
+                name = str(item.get("merchant") or "").strip()
+                if isinstance(idx, int) and 0 <= idx < len(chunk) and name:
+                    corrected[idx] = name
+            if corrected:
+                break
+            forget_response(GEMINI_MERCHANT_MODEL, prompt)
+            retries += attempt == 0
+
+        for i, record in enumerate(chunk):
+            if i not in corrected:
+                call_gemini_two_merchant(record)
+                fallback += 1
+                continue
+            # Forzar guion entre merchant y location (misma regla que la limpieza local)
+            record["merchant"] = merchant_with_location(corrected[i], entries[i]["location"])
+            batched += 1
+
+    return batched, fallback, retries
+
+
 def parse_gemini_response(gemini_response, full_text):
     """Parsea la respuesta de Gemini y cruza promociones con comercios (rellenando campos)."""
     try:
@@ -995,10 +1220,9 @@ def extract_basic_info_fallback(full_text, pdf_path=None):
             address = m.group(0).strip()
         elif pdf_path and os.path.exists(pdf_path):
             try:
-                import pdfplumber
-                with pdfplumber.open(pdf_path) as pdf:
-                    for page in pdf.pages:
-                        words = page.extract_words()
+                with ParsedPdf(pdf_path) as pdf:
+                    for page_idx in range(pdf.num_pages):
+                        words = pdf.page_words(page_idx)
                         for w in words:
                             if re.search(r"(Dirección|Direcciones|Sucursal|Ubicación)", w["text"], re.IGNORECASE):
                                 nearby = " ".join(
@@ -1235,12 +1459,16 @@ def extract_offer_days(full_text):
     return ", ".join(normalized)
 
 
-def process_pdf_file(filepath):
-    """Procesa un archivo PDF usando Google Gemini"""
+def process_pdf_file(filepath, use_cache=True):
+    """
+    Procesa un archivo PDF usando Google Gemini.
+    El reintento de VIGENCIA pasa `use_cache=False` para no recibir de la caché la misma
+    respuesta incompleta; una respuesta sin fechas u offer_day se quita de la caché.
+    """
     print(f"Procesando con Gemini: {filepath}")
 
     try:
-        gemini_response, full_text = extract_text_with_gemini(filepath)
+        gemini_response, full_text, prompt = extract_text_with_gemini(filepath, use_cache)
     except Exception as e:
         print(f"❌ Error en extract_text_with_gemini: {e}")
         return None
@@ -1274,13 +1502,20 @@ def process_pdf_file(filepath):
 
                 results.append(promo)
 
+            # Fechas/días que siguen faltando: consulta corta sobre VIGENCIA en vez de reprocesar el PDF
+            faltantes = fill_missing_fields(results, full_text, RECORD_SCHEMA,
+                                            context=os.path.basename(filepath), use_cache=use_cache)
+            if not results or faltantes:
+                forget_response(GEMINI_MODEL, prompt)  # incompleta: el reintento vuelve a consultar
             return results
 
         except Exception as e:
             print(f"⚠ Error procesando respuesta Gemini: {e}")
 
-    # Fallback a extracción básica
+    # Fallback a extracción básica (la respuesta de Gemini no sirvió: no queda en la caché)
     print("⚠ Usando extracción básica como fallback")
+    if prompt:
+        forget_response(GEMINI_MODEL, prompt)
     if full_text:
         fallback = extract_basic_info_fallback(full_text, filepath)
         # Normalizar beneficio y método de pago también
@@ -1293,10 +1528,39 @@ def process_pdf_file(filepath):
             fallback["valid_to"] = fallback.get("valid_to") or vt
         # Asegurar que terms_conditions sea exactamente lo escrito en el PDF
         fallback["terms_conditions"] = extract_terms_exact(full_text) or fallback.get("terms_conditions", "")
+        fill_missing_fields([fallback], full_text, RECORD_SCHEMA, context=os.path.basename(filepath),
+                            use_cache=use_cache)
         return [fallback]
  
     return None
 
+def write_familiar_block(conn, rows, upserts, indices, state, failed_vigencia_pdfs):
+    """
+    Escribe un bloque de PDFs ya extraídos: segunda pasada de merchant_name (reglas
+    locales y, si hace falta, Gemini por lotes), upsert en MySQL y estado incremental.
+    Los PDFs con datos incompletos no guardan estado, así se reprocesan en la próxima corrida.
+    """
+    if rows:
+        stats = clean_merchant_names(rows)
+        log_event(f"🧹 Limpieza de comercios: {stats['names']} nombres, {stats['local']} resueltos con reglas locales, "
+                  f"{stats['escalated']} escalados a Gemini en {stats['llm_calls']} llamadas "
+                  f"({stats['llm_calls_avoided']} llamadas evitadas)")
+    for parsed_row in rows:
+        # 🧩 Asegurar coherencia entre merchant y merchant_name (lo que va a MySQL)
+        merchant_final = str(parsed_row.get("merchant") or "").strip()
+        parsed_row["merchant_name"] = merchant_final
+        parsed_row["merchant"] = merchant_final
+
+    offer_ids = upsert_familiar_batch(conn, upserts, indices)
+
+    rows_by_pdf = defaultdict(list)
+    for parsed_row in rows:
+        rows_by_pdf[parsed_row["pdf_path"]].append(parsed_row)
+    for local_path, ids in offer_ids.items():
+        if local_path and local_path not in failed_vigencia_pdfs:
+            state.save(local_path, rows_by_pdf[local_path], ids)
+
+
 def main():
     if not os.path.exists(PDFS_CSV):
         print("No se encontró:", PDFS_CSV)
@@ -1318,7 +1582,13 @@ def main():
     df = pd.read_csv(PDFS_CSV)
     out_rows = []
     failed_vigencia_pdfs = {}  # Diccionario: local_path -> nombre_csv
+    indices = {}  # Índice en memoria de web_offers, se carga una sola vez por ejecución
+    pending_upserts = []  # Filas a insertar/actualizar; se puntúan juntas por bloque de PDFs
+    written = (0, 0)  # (out_rows, pending_upserts) ya escritos en MySQL
+    seen_keys = set()  # (merchant, address) antes de la limpieza de merchant_name, para los duplicados del reintento
+    state = OcrState("familiar", OCR_STATE_VERSION)  # PDFs sin cambios desde la última corrida (OCR_INCREMENTAL=1)
 
+    jobs = []  # (fila, categoria, nombre, url, url_logo, local_path) de los PDFs disponibles
     for idx, row in df.iterrows():
         categoria = row.get("categoria") or ""
         nombre = row.get("nombre") or row.get("file") or ""
@@ -1331,10 +1601,7 @@ def main():
             if url and url.startswith("http"):
                 try:
                     print("Descargando PDF desde:", url)
-                    resp = requests.get(url, timeout=15)
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    with open(local_path, "wb") as f:
-                        f.write(resp.content)
+                    download_pdf(url, local_path)  # queda registrado en el manifiesto de descargas
                     print("✅ PDF descargado correctamente")
                 except Exception as e:
                     print("⚠ No se pudo descargar:", e)
@@ -1343,70 +1610,86 @@ def main():
                 print("⚠ No existe el archivo local:", local_path)
                 continue
 
-        log_event(f"Iniciando procesamiento del PDF: {local_path}")
-        parsed_list = process_pdf_file(local_path)
-
-        if not parsed_list:
-            log_event(f"⚠ No se pudo procesar el archivo: {local_path}")
-            #failed_vigencia_pdfs[local_path] = nombre
-            failed_vigencia_pdfs[local_path] = row.get("comercio") or ""
+        if state.lookup(local_path) is not None:
+            log_event(f"♻️ Sin cambios desde la última corrida, se omite: {local_path}")
             continue
 
-        count_per_pdf = 0
+        jobs.append((row, categoria, nombre, url, url_logo, local_path))
 
-        for parsed in parsed_list:
-            
+    def write_pending():
+        nonlocal written
+        write_familiar_block(conn, out_rows[written[0]:], pending_upserts[written[1]:],
+                             indices, state, failed_vigencia_pdfs)
+        written = (len(out_rows), len(pending_upserts))
 
-            if not parsed or "error" in parsed or not parsed.get("valid_from"):
-                log_event(f"⚠ Gemini devolvió error o datos incompletos, se omite: {local_path}")
+    # Extracción con Gemini: varios PDFs en vuelo a la vez (acotado por GEMINI_CONCURRENCY
+    # y por el límite por minuto); los resultados vuelven en el orden del CSV y se escriben
+    # en MySQL cada COMMIT_EVERY_DOCS PDFs (y lo extraído hasta un corte, también)
+    log_event(f"🤖 Extrayendo {len(jobs)} PDFs con Gemini ({GEMINI_CONCURRENCY} en paralelo)")
+    extracted = iter_concurrent(process_pdf_file, [job[-1] for job in jobs])
+
+    try:
+        for n, ((row, categoria, nombre, url, url_logo, local_path), parsed_list) in enumerate(zip(jobs, extracted)):
+            if n and n % COMMIT_EVERY_DOCS == 0:
+                write_pending()
+            log_event(f"Iniciando procesamiento del PDF: {local_path}")
+
+            if not parsed_list:
+                log_event(f"⚠ No se pudo procesar el archivo: {local_path}")
                 #failed_vigencia_pdfs[local_path] = nombre
                 failed_vigencia_pdfs[local_path] = row.get("comercio") or ""
                 continue
 
-            nombre_csv = row.get("comercio") or ""
-            nombre_pdf = parsed.get("merchant", "")
-            parsed["merchant"] = ajustar_nombre_comercio(nombre_csv, nombre_pdf)
+            count_per_pdf = 0
 
-            check_gemini_rate_limit() #Controlar limite por minuto
-            # 🧠 Segunda pasada con Gemini para limpiar merchant_name
-            parsed = call_gemini_two_merchant(parsed)
+            for parsed in parsed_list:
+            
 
+                if not parsed or "error" in parsed or not parsed.get("valid_from"):
+                    log_event(f"⚠ Gemini devolvió error o datos incompletos, se omite: {local_path}")
+                    #failed_vigencia_pdfs[local_path] = nombre
+                    failed_vigencia_pdfs[local_path] = row.get("comercio") or ""
+                    continue
 
-            # 🧩 Asegurar coherencia entre parsed["merchant"] y merchant_name
-            merchant_final = parsed.get("merchant", "").strip()
-            parsed["merchant_name"] = merchant_final  # lo que va a MySQL
-            parsed["merchant"] = merchant_final       # mantener consistencia interna
+                nombre_csv = row.get("comercio") or ""
+                nombre_pdf = parsed.get("merchant", "")
+                parsed["merchant"] = ajustar_nombre_comercio(nombre_csv, nombre_pdf)
 
+                # 🧠 La segunda pasada con Gemini (limpieza de merchant_name) se hace por lotes en cada bloque
+                parsed["merchant_name"] = parsed.get("merchant", "").strip()
 
-            parsed_row = {
-                "categoria": categoria,
-                "archivo": nombre,
-                "url": url,
-                "merchant_logo_url": url_logo,
-                **parsed
-            }
 
-            out_rows.append(parsed_row)
+                parsed_row = {
+                    "categoria": categoria,
+                    "archivo": nombre,
+                    "pdf_path": local_path,
+                    "url": url,
+                    "merchant_logo_url": url_logo,
+                    **parsed
+                }
 
-            # ✅ Solo insertar si las fechas son válidas
-            if parsed_row.get("valid_from") or parsed_row.get("valid_to"):
-                try:
+                out_rows.append(parsed_row)
+                seen_keys.add((parsed_row.get("merchant", "").strip().lower(), parsed_row.get("address", "").strip().lower()))
+
+                # ✅ Solo insertar si las fechas son válidas
+                if parsed_row.get("valid_from") or parsed_row.get("valid_to"):
                     #parsed["merchant"] = ajustar_nombre_comercio(nombre_csv, nombre_pdf)
-                    upsert_offer_mysql(conn, parsed_row)
-                except Exception as e:
-                    log_event(f"⚠ Error en MySQL: {e}")
-            else:
-                log_event(f"⚠ Sin fechas válidas — no se inserta: {nombre}")
+                    pending_upserts.append(parsed_row)
+                else:
+                    log_event(f"⚠ Sin fechas válidas — no se inserta: {nombre}")
+                    #failed_vigencia_pdfs[local_path] = nombre
+                    failed_vigencia_pdfs[local_path] = row.get("comercio") or ""
+                count_per_pdf += 1
+                log_event(f"✅ Procesado: {parsed.get('merchant','')} - {parsed.get('benefic','')} "
+                          f"(Desde: {parsed.get('valid_from','')} Hasta: {parsed.get('valid_to','')})")
+
+            if any(not parsed.get("offer_day") for parsed in parsed_list):
                 #failed_vigencia_pdfs[local_path] = nombre
                 failed_vigencia_pdfs[local_path] = row.get("comercio") or ""
-            count_per_pdf += 1
-            log_event(f"✅ Procesado: {parsed.get('merchant','')} - {parsed.get('benefic','')} "
-                      f"(Desde: {parsed.get('valid_from','')} Hasta: {parsed.get('valid_to','')})")
-
-        if any(not parsed.get("offer_day") for parsed in parsed_list):
-            #failed_vigencia_pdfs[local_path] = nombre
-            failed_vigencia_pdfs[local_path] = row.get("comercio") or ""
-        log_event(f"📌 Total de registros escritos para {nombre}: {count_per_pdf}")
+            log_event(f"📌 Total de registros escritos para {nombre}: {count_per_pdf}")
+    finally:
+        # Lo extraído hasta acá se escribe aunque el bucle se corte
+        write_pending()
 
     # ------------------------------
     # Reintento de PDFs fallidos
@@ -1414,11 +1697,13 @@ def main():
     if failed_vigencia_pdfs:
         log_event(f"⚠ Reintentando {len(failed_vigencia_pdfs)} PDFs donde no se pudo extraer VIGENCIA...")
 
-        existing_keys = set((r.get("merchant", "").strip().lower(), r.get("address", "").strip().lower()) for r in out_rows)
+        retry_paths = list(failed_vigencia_pdfs)
+        # Llamadas a Gemini en el reintento, sin la caché (devolvería la misma respuesta incompleta)
+        retried = map_concurrent(lambda path: process_pdf_file(path, use_cache=False), retry_paths)
 
-        for local_path, nombre_csv in failed_vigencia_pdfs.items():
+        for local_path, parsed_list in zip(retry_paths, retried):
+            nombre_csv = failed_vigencia_pdfs[local_path]
             log_event(f"🔄 Reprocesando PDF: {local_path}")
-            parsed_list = process_pdf_file(local_path)  # Llamada a Gemini en el reintento
 
             if not parsed_list:
                 log_event(f"❌ Reintento fallido para: {local_path}")
@@ -1433,25 +1718,21 @@ def main():
                     continue
 
                 key = (parsed.get("merchant", "").strip().lower(), parsed.get("address", "").strip().lower())
-                if key in existing_keys:
+                if key in seen_keys:
                     log_event(f"⚠ Saltando duplicado: {parsed['merchant']} - {parsed.get('address', '')}")
                     continue
-                existing_keys.add(key)
+                seen_keys.add(key)
 
                 nombre_pdf = parsed.get("merchant", "")
                 parsed["merchant"] = ajustar_nombre_comercio(nombre_csv, nombre_pdf)
 
-                check_gemini_rate_limit() #Controlar limite por minuto
-                # 🧠 Segunda pasada con Gemini para limpiar merchant_name
-                parsed = call_gemini_two_merchant(parsed)
-
-                # 🧩 Coherencia de merchant_name también en reintento
-                merchant_final = parsed.get("merchant", "").strip()
-                parsed["merchant_name"] = merchant_final
+                # 🧠 La limpieza de merchant_name con Gemini se hace por lotes en write_pending
+                parsed["merchant_name"] = parsed.get("merchant", "").strip()
 
                 parsed_row = {
                     "categoria": categoria,
                     "archivo": nombre,
+                    "pdf_path": local_path,
                     "url": url,                 
                     "merchant_logo_url": url_logo,  
                     **parsed
@@ -1463,12 +1744,34 @@ def main():
 
                     parsed["merchant"] = ajustar_nombre_comercio(nombre_csv, nombre_pdf)
                     
-                    upsert_offer_mysql(conn, parsed_row)
+                    pending_upserts.append(parsed_row)
                     log_event(f"✅ Reprocesado: {parsed['merchant']} - {parsed['benefic']} "
                               f"(Desde: {parsed['valid_from']} Hasta: {parsed['valid_to']})")
                 else:
                     log_event(f"⚠ Reintento sin fechas válidas — no se inserta: {nombre}")
 
+    # ------------------------------
+    # Limpieza de merchant_name e inserción/actualización en MySQL de los reintentos
+    # ------------------------------
+    write_pending()
+
+    # Las ofertas de los PDFs sin cambios solo se marcan como vigentes
+    if state.unchanged_offer_ids:
+        try:
+            touched = touch_offers(conn, state.unchanged_offer_ids)
+            conn.commit()
+            log_event(f"♻️ {touched} ofertas de PDFs sin cambios marcadas como vigentes")
+        except mysql.connector.Error as e:
+            conn.rollback()
+            log_event(f"⚠ Error MySQL al marcar ofertas vigentes: {e}")
+
+    log_event(state.summary())
+    log_event(cache_summary())
+    log_event(rate_limit_summary())
+    log_event(page_cache_summary())
+    log_event(compaction_summary())
+    log_event(repair_summary())
+
     #conn.close()
     log_event("✅ Proceso finalizado correctamente.")
 
@@ -2,19 +2,35 @@ import os
 import re
 import camelot
 import json
-import pdfplumber
 import pandas as pd
 import google.generativeai as genai
 from datetime import datetime
 from pathlib import Path
-from PyPDF2 import PdfReader
 import threading
+import numpy as np
 import  mysql.connector
 import unicodedata
 import time
 import argparse
+from collections import defaultdict
 from rapidfuzz import fuzz
 import unicodedata
+from offers_db import (
+    get_offer_index, BatchInserter, UpdateAccumulator, apply_offer_update, touch_offers, commit_pending,
+    COMMIT_EVERY, COMMIT_EVERY_DOCS,
+)
+from offers_match import get_batch_scorer, best_position
+from gemini_client import (
+    generate_text, forget_response, cache_summary, rate_limit_summary, map_concurrent, iter_concurrent,
+    GEMINI_CONCURRENCY,
+)
+from pdf_text import (
+    ParsedPdf, page_cache_summary, table_check_summary, locate_section, ruled_table_pages, camelot_pages,
+    read_section_text,
+)
+from prompt_compact import CompactProfile, PromptCompactor, compaction_summary
+from gemini_repair import ResponseSchema, parse_json_response, fill_missing_fields, repair_summary
+from ocr_state import OcrState
 
 # Configuración de la base de datos
 
@@ -43,7 +59,7 @@ def parse_date_safe(value):
         return None
 
 
-def insert_pdf_mysql(conn, record):
+def insert_pdf_mysql(conn, record, inserter=None):
     try:
         cur = conn.cursor()
 
@@ -78,38 +94,39 @@ def insert_pdf_mysql(conn, record):
         print("--- FIN DEBUG ---\n")
 
         # --- Ejecutar INSERT ---
-        cur.execute("""
-            INSERT INTO web_offers (
-                valid_to, valid_from, terms_raw, terms_conditions, source_file,
-                source, bank_name, payment_methods, offer_url, offer_day, merchant_name,
-                merchant_logo_url, merchant_logo_downloaded, merchant_location,
-                merchant_address, details, category_name, card_brand, benefit,
-                ai_response
-            ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
-            safe_str(valid_to),
-            safe_str(valid_from),
-            safe_str(record.get("terms_raw")),
-            safe_str(record.get("terms_conditions")),
-            safe_str(record.get("source_file")),
-            "PDF",
-            safe_str(record.get("bank_name")),
-            safe_str(record.get("payment_methods")),
-            safe_str(record.get("offer_url")),
-            safe_str(record.get("offer_day")),
-            safe_str(record.get("merchant_name")),
-            safe_str(record.get("merchant_logo_url")),
-            int(record.get("merchant_logo_downloaded", 0) or 0),
-            merchant_location,  # 👈 limpio y sin NULL
-            safe_str(record.get("merchant_address")),
-            safe_str(record.get("details")),
-            safe_str(record.get("category_name")),
-            safe_str(record.get("card_brand")),
-            safe_str(record.get("benefic")),
-            safe_str(record.get("ai_response"))
-        ))
+        row = {
+            "valid_to": safe_str(valid_to),
+            "valid_from": safe_str(valid_from),
+            "terms_raw": safe_str(record.get("terms_raw")),
+            "terms_conditions": safe_str(record.get("terms_conditions")),
+            "source_file": safe_str(record.get("source_file")),
+            "source": "PDF",
+            "bank_name": safe_str(record.get("bank_name")),
+            "payment_methods": safe_str(record.get("payment_methods")),
+            "offer_url": safe_str(record.get("offer_url")),
+            "offer_day": safe_str(record.get("offer_day")),
+            "merchant_name": safe_str(record.get("merchant_name")),
+            "merchant_logo_url": safe_str(record.get("merchant_logo_url")),
+            "merchant_logo_downloaded": int(record.get("merchant_logo_downloaded", 0) or 0),
+            "merchant_location": merchant_location,  # 👈 limpio y sin NULL
+            "merchant_address": safe_str(record.get("merchant_address")),
+            "details": safe_str(record.get("details")),
+            "category_name": safe_str(record.get("category_name")),
+            "card_brand": safe_str(record.get("card_brand")),
+            "benefit": safe_str(record.get("benefic")),
+            "ai_response": safe_str(record.get("ai_response"))
+        }
+        if inserter is not None:
+            # Modo por lotes: la fila queda en el buffer con id temporal
+            return inserter.add(row)
+        cur.execute(f"""
+            INSERT INTO web_offers ({', '.join(row)})
+            VALUES ({', '.join(['%s'] * len(row))})
+        """, tuple(row.values()))
 
         conn.commit()
+        # Fila tal como quedó en la BD, para mantener al día el índice en memoria
+        return {"id": cur.lastrowid, **row}
 
     except mysql.connector.Error as e:
         print(f"⚠ Error insertando en MySQL: {e}")
@@ -118,11 +135,166 @@ def insert_pdf_mysql(conn, record):
         cur.close()
 
 
-def upsert_offer_mysql(conn, record, updated_ids=None):
+def normalize_gnb_record(record):
+    """Campos normalizados de un registro GNB, tal como se comparan y guardan en web_offers."""
+    merchant_name = safe_str(record.get("merchant_name") or record.get("merchant"))
+    merchant_address = safe_str(record.get("merchant_address") or record.get("address"))
+
+    # 🔧 Normalizar location (sin NULL ni "farmatotal")
+    raw_location = safe_str(record.get("merchant_location") or record.get("location"))
+    if not raw_location or raw_location.strip().lower() in ["none", "null", "farmatotal"]:
+        merchant_location = ""
+    else:
+        merchant_location = raw_location.strip()
+
+    # 🧩 Validar y limpiar fechas antes de actualizar el record
+    valid_to = parse_date_safe(safe_str(record.get("valid_to")))
+
+    return {
+        "merchant_name": merchant_name,
+        "merchant_address": merchant_address,
+        "merchant_location": merchant_location,
+        "category_name": safe_str(record.get("category_name") or record.get("categoria")),
+        "card_brand": safe_str(record.get("card_brand") or record.get("marca_tarjeta")),
+        "payment_methods": safe_str(record.get("payment_methods") or record.get("metodo_pago")),
+        "benefic": safe_str(record.get("benefic") or record.get("benefit")),
+        "terms_conditions": safe_str(record.get("terms_conditions")),
+        "offer_day": safe_str(record.get("offer_day")),
+        "valid_to": valid_to,
+        "ai_response": safe_str(record.get("ai_response")),
+        "source_file": safe_str(record.get("source_file")),
+        "terms_raw": safe_str(record.get("terms_raw"))
+    }
+
+
+def gnb_base_name(name):
+    """Nombre base para Supermercados/Petromax (sin 'super', 'market', número de Petromax, etc.)."""
+    name = name.lower()
+    name = re.sub(r"\b(supermercado|super|autoservice|autoservicio|mercado|mini\s?market|market)\b", "", name)
+    name = re.sub(r"petromax\s*[-–]?\s*\d*", "petromax", name)
+    return re.sub(r"[^a-záéíóúüñ0-9]", "", name.strip())
+
+
+# Largo del prefijo de marca usado como clave de bloque (ej. "petr", "farm", "stoc")
+GNB_BRAND_PREFIX_LEN = 4
+
+
+def gnb_block_key(category_name, merchant_name):
+    """
+    Clave de bloque para el matching: categoría + prefijo de marca del nombre base
+    (parte antes de " - ", sin acentos ni palabras genéricas). Solo se puntúan
+    candidatos del mismo bloque (PETROMAX nunca se compara contra FARMATOTAL).
+    """
+    base = merchant_name.split(" - ")[0]
+    base = unicodedata.normalize("NFD", base).encode("ascii", "ignore").decode("utf-8")
+    brand = gnb_base_name(base)[:GNB_BRAND_PREFIX_LEN]
+    return f"{category_name.strip().casefold()}|{brand}"
+
+
+# Ponderaciones especiales (Supermercados y Petromax)
+GNB_SPECIAL_WEIGHTS = {
+    "merchant_name": 0.30,
+    "merchant_location": 0.35,
+    "merchant_address": 0.15,
+    "terms_conditions": 0.05,
+    "source_file": 0.10,
+    "category_name": 0.05,
+}
+# Lógica normal para otras categorías
+GNB_DEFAULT_WEIGHTS = {
+    "merchant_name": 0.4,
+    "merchant_location": 0.3,
+    "merchant_address": 0.2,
+    "terms_conditions": 0.05,
+    "source_file": 0.05,
+}
+
+
+def load_gnb_index(conn, bank_name, indices=None):
+    """Índice en memoria de web_offers (claves por campo ponderado) y su motor de scoring por lotes."""
+    extra_keys = {
+        field: (lambda r, field=field: safe_str(r.get(field, "")))
+        for field in GNB_SPECIAL_WEIGHTS
+    }
+    extra_keys["base_name"] = lambda r: gnb_base_name(safe_str(r.get("merchant_name", "")))
+    extra_keys["block"] = lambda r: gnb_block_key(
+        safe_str(r.get("category_name", "")), safe_str(r.get("merchant_name", ""))
+    )
+    index = get_offer_index(conn, bank_name, indices, extra_keys=extra_keys)
+    return index, get_batch_scorer(index)
+
+
+def prime_gnb_scorer(conn, records, indices):
+    """Puntúa de una vez (cdist por campo) todos los registros de la corrida contra la BD."""
+    by_bank = {}
+    for record in records:
+        bank_name = safe_str(record.get("bank_name") or "BANCO GNB PARAGUAY")
+        by_bank.setdefault(bank_name, []).append(normalize_gnb_record(record))
+    for bank_name, normalized in by_bank.items():
+        _, scorer = load_gnb_index(conn, bank_name, indices)
+        queries = {field: [n[field] for n in normalized] for field in GNB_SPECIAL_WEIGHTS}
+        queries["base_name"] = [gnb_base_name(n["merchant_name"]) for n in normalized]
+        scorer.prime(queries)
+
+
+def gnb_weighted_scores(scorer, record, rows, special):
+    """
+    Similitud ponderada (0-100) del registro contra cada fila; solo cuentan los campos
+    presentes en ambos lados. En modo especial (Supermercados/Petromax) se descartan las
+    filas con nombre base distinto y se penalizan sucursales numeradas o ciudades diferentes.
+    """
+    weights = GNB_SPECIAL_WEIGHTS if special else GNB_DEFAULT_WEIGHTS
+    score_sum = np.zeros(len(rows))
+    weight_sum = np.zeros(len(rows))
+    for field, weight in weights.items():
+        a = safe_str(record.get(field, ""))
+        if not a:
+            continue
+        both = scorer.present(field, rows)
+        score_sum += np.where(both, weight * scorer.scores(field, a, rows), 0)
+        weight_sum += np.where(both, weight, 0)
+    scores = np.divide(score_sum, weight_sum, out=np.zeros(len(rows)), where=weight_sum > 0)
+    if not special:
+        return scores
+
+    name_new = safe_str(record.get("merchant_name", ""))
+
+    # Si los nombres base difieren demasiado, se consideran distintos
+    base_new = gnb_base_name(name_new)
+    if base_new:
+        different_base = scorer.present("base_name", rows) & (scorer.scores("base_name", base_new, rows) < 85)
+        scores[different_base] = 0
+
+    # Penalizar nombres con número o ciudad diferente (ej. Capiatá 1 vs Capiatá 2)
+    if re.search(r"\b\d+\b", name_new):
+        for i in np.flatnonzero(scorer.scores("merchant_name", name_new, rows) > 80):
+            name_old = safe_str(rows[i].get("merchant_name", ""))
+            if re.search(r"\b\d+\b", name_old) and name_new != name_old:
+                scores[i] = max(scores[i] - 25, 0)
+
+    location_new = record.get("merchant_location")
+    if "petromax" in name_new.lower() and location_new:
+        different_city = scorer.present("merchant_location", rows) & (
+            scorer.scores("merchant_location", location_new, rows) < 90
+        )
+        scores[different_city] = np.maximum(scores[different_city] - 20, 0)
+    return scores
+
+
+def upsert_offer_mysql(conn, record, updated_ids=None, indices=None, blocking_stats=None, inserter=None,
+                       updates=None):
     """Inserta o actualiza una oferta del Banco GNB Paraguay usando comparación por similitud,
-    evitando actualizar la misma ID y detectando nuevas sucursales o PDFs distintos."""
+    evitando actualizar la misma ID y detectando nuevas sucursales o PDFs distintos.
+    `indices` (dict banco → OfferIndex) evita releer web_offers en cada llamada.
+    `blocking_stats` acumula las comparaciones hechas/evitadas por el blocking.
+    `inserter` (BatchInserter) acumula las filas nuevas para insertarlas por lotes y
+    `updates` (UpdateAccumulator) los cambios, que se aplican juntos al final.
+    Devuelve el id de web_offers que representa al registro (temporal si quedó en el
+    buffer del inserter), o None si hubo error."""
     if updated_ids is None:
         updated_ids = set()
+    if inserter is not None:
+        inserter.track_ids(updated_ids)
 
     cur = conn.cursor(dictionary=True)
 
@@ -133,143 +305,43 @@ def upsert_offer_mysql(conn, record, updated_ids=None):
 
     try:
         # --- Normalizar campos ---
-        merchant_name = safe_str(record.get("merchant_name") or record.get("merchant"))
         bank_name = safe_str(record.get("bank_name") or "BANCO GNB PARAGUAY")
-        merchant_address = safe_str(record.get("merchant_address") or record.get("address"))
-
-        # 🔧 Normalizar location (sin NULL ni "farmatotal")
-        raw_location = safe_str(record.get("merchant_location") or record.get("location"))
-        if not raw_location or raw_location.strip().lower() in ["none", "null", "farmatotal"]:
-            merchant_location = ""
-        else:
-            merchant_location = raw_location.strip()
-
-        category_name = safe_str(record.get("category_name") or record.get("categoria"))
-        card_brand = safe_str(record.get("card_brand") or record.get("marca_tarjeta"))
-        payment_methods = safe_str(record.get("payment_methods") or record.get("metodo_pago"))
-        benefic = safe_str(record.get("benefic") or record.get("benefit"))
-        terms_conditions = safe_str(record.get("terms_conditions"))
-        offer_day = safe_str(record.get("offer_day"))
-
-        valid_to = safe_str(record.get("valid_to"))
-        # 🧩 Validar y limpiar fechas antes de actualizar el record
-        valid_to = parse_date_safe(valid_to)
-
-        ai_response = safe_str(record.get("ai_response"))
-        source_file = safe_str(record.get("source_file"))
-        terms_raw = safe_str(record.get("terms_raw"))
-
         current_id = record.get("id")
-
-        record.update({
-            "merchant_name": merchant_name,
-            "merchant_address": merchant_address,
-            "merchant_location": merchant_location,
-            "category_name": category_name,
-            "card_brand": card_brand,
-            "payment_methods": payment_methods,
-            "benefic": benefic,
-            "terms_conditions": terms_conditions,
-            "offer_day": offer_day,
-            "valid_to": valid_to,
-            "ai_response": ai_response,
-            "source_file": source_file,
-            "terms_raw": terms_raw
-        })
-
-        # --- Buscar candidatos del mismo banco ---
-        cur.execute("SELECT * FROM web_offers WHERE bank_name=%s", (bank_name,))
-        existing_records = cur.fetchall()
-
-        best_match = None
-        best_score = 0
-
-        # --- Comparar por similitud ponderada (incluye categoría) ---
-        # --- Comparar por similitud ponderada ---
-        for existing in existing_records:
-            if current_id and existing.get("id") == current_id:
-                continue
-
-            # --- Normalizar ---
-            name_new = safe_str(record.get("merchant_name", ""))
-            name_old = safe_str(existing.get("merchant_name", ""))
-            category_new = safe_str(record.get("category_name", ""))
-            category_old = safe_str(existing.get("category_name", ""))
-
-            # 🧠 Lógica especial para Supermercados y Petromax
-            if category_new.lower() == "supermercados" or "petromax" in name_new.lower():
-                def clean_name(name):
-                    name = name.lower()
-                    name = re.sub(r"\b(supermercado|super|autoservice|autoservicio|mercado|mini\s?market|market)\b", "", name)
-                    name = re.sub(r"petromax\s*[-–]?\s*\d*", "petromax", name)
-                    return re.sub(r"[^a-záéíóúüñ0-9]", "", name.strip())
-
-                base_new = clean_name(name_new)
-                base_old = clean_name(name_old)
-
-                # Si los nombres base difieren demasiado, se consideran distintos
-                if base_new and base_old and fuzz.ratio(base_new, base_old) < 85:
-                    continue
-
-                # --- Ponderaciones especiales ---
-                weights = {
-                    "merchant_name": 0.30,
-                    "merchant_location": 0.35,
-                    "merchant_address": 0.15,
-                    "terms_conditions": 0.05,
-                    "source_file": 0.10,
-                    "category_name": 0.05,
-                }
-
-                score_sum = 0
-                weight_sum = 0
-                for field, weight in weights.items():
-                    a = safe_str(record.get(field, ""))
-                    b = safe_str(existing.get(field, ""))
-                    if a and b:
-                        score_sum += weight * fuzz.ratio(a, b)
-                        weight_sum += weight
-                score = score_sum / weight_sum if weight_sum > 0 else 0
-
-                # Penalizar nombres con número o ciudad diferente (ej. Capiatá 1 vs Capiatá 2)
-                if (
-                    fuzz.ratio(name_new, name_old) > 80
-                    and re.search(r"\b\d+\b", name_new)
-                    and re.search(r"\b\d+\b", name_old)
-                    and name_new != name_old
-                ):
-                    score = max(score - 25, 0)
-                if (
-                    "petromax" in name_new.lower()
-                    and record.get("merchant_location")
-                    and existing.get("merchant_location")
-                    and fuzz.ratio(record["merchant_location"], existing["merchant_location"]) < 90
-                ):
-                    score = max(score - 20, 0)
-
-            else:
-                # 🔹 Lógica normal para otras categorías
-                weights = {
-                    "merchant_name": 0.4,
-                    "merchant_location": 0.3,
-                    "merchant_address": 0.2,
-                    "terms_conditions": 0.05,
-                    "source_file": 0.05,
-                }
-                score_sum = 0
-                weight_sum = 0
-                for field, weight in weights.items():
-                    a = safe_str(record.get(field, ""))
-                    b = safe_str(existing.get(field, ""))
-                    if a and b:
-                        score_sum += weight * fuzz.ratio(a, b)
-                        weight_sum += weight
-                score = score_sum / weight_sum if weight_sum > 0 else 0
-
-            # --- Guardar mejor coincidencia ---
-            if score > best_score:
-                best_score = score
-                best_match = existing
+        record.update(normalize_gnb_record(record))
+
+        merchant_name = record["merchant_name"]
+        merchant_location = record["merchant_location"]
+        category_name = record["category_name"]
+        card_brand = record["card_brand"]
+        payment_methods = record["payment_methods"]
+        benefic = record["benefic"]
+        terms_conditions = record["terms_conditions"]
+        offer_day = record["offer_day"]
+        valid_to = record["valid_to"]
+        source_file = record["source_file"]
+
+        # --- Buscar candidatos del mismo bloque: categoría + marca (índice en memoria) ---
+        index, scorer = load_gnb_index(conn, bank_name, indices)
+        if inserter is not None:
+            inserter.track_index(index)
+        candidates = index.lookup("block", gnb_block_key(category_name, merchant_name))
+        if not candidates:
+            # Marca sin filas previas (o escrita distinto): se compara contra toda la categoría
+            candidates = index.find("category", record)
+        if blocking_stats is not None:
+            blocking_stats["comparadas"] += len(candidates)
+            blocking_stats["evitadas"] += len(index) - len(candidates)
+        existing_records = [
+            ex for ex in candidates
+            if not (current_id and ex.get("id") == current_id)
+        ]
+
+        # --- Comparar por similitud ponderada (incluye categoría) contra todos a la vez ---
+        special = category_name.lower() == "supermercados" or "petromax" in merchant_name.lower()
+        scores = gnb_weighted_scores(scorer, record, existing_records, special)
+        pos = best_position(scores)
+        best_match = existing_records[pos] if pos is not None else None
+        best_score = float(scores[pos]) if pos is not None else 0
 
         log_event(f"🔍 Mejor coincidencia GNB para [{merchant_name}] = {best_score:.2f}%")
 
@@ -279,7 +351,7 @@ def upsert_offer_mysql(conn, record, updated_ids=None):
             if existing_id in updated_ids:
                 log_event(f"⏭️ ID={existing_id} ya actualizado en esta sesión. Se omite actualización repetida.")
                 cur.close()
-                return
+                return existing_id
 
             name_existing = safe_str(best_match.get("merchant_name"))
             loc_existing = safe_str(best_match.get("merchant_location"))
@@ -295,16 +367,18 @@ def upsert_offer_mysql(conn, record, updated_ids=None):
 
             if same_base and (different_city or different_pdf):
                 log_event(f"🏬 Nueva sucursal o PDF distinto → [{merchant_name}] ({merchant_location}) → {source_file}")
-                insert_pdf_mysql(conn, record)
+                new_row = insert_pdf_mysql(conn, record, inserter)
+                if new_row:
+                    index.add(new_row)
                 log_event("🆕 Insertado nuevo registro (sucursal/PDF distinta)")
                 cur.close()
-                return
+                return new_row["id"] if new_row else None
 
             # Evitar actualizar misma ID
             if current_id and existing_id == current_id:
                 log_event(f"⏩ Omitido update: misma ID detectada ({current_id})")
                 cur.close()
-                return
+                return current_id
 
             # Detectar cambios reales
             changed_fields = [
@@ -313,36 +387,28 @@ def upsert_offer_mysql(conn, record, updated_ids=None):
             ]
 
             if changed_fields:
-                cur.execute("""
-                    UPDATE web_offers SET 
-                        benefit=%s,
-                        payment_methods=%s,
-                        card_brand=%s,
-                        terms_conditions=%s,
-                        offer_day=%s,
-                        valid_to=%s,
-                        category_name=%s,
-                        updated_at=NOW(),
-                        status='A'
-                    WHERE id=%s
-                """, (
-                    benefic,
-                    payment_methods,
-                    card_brand,
-                    terms_conditions,
-                    offer_day,
-                    valid_to,
-                    category_name,
-                    existing_id
-                ))
-                conn.commit()
+                changes = {
+                    "benefit": benefic,
+                    "payment_methods": payment_methods,
+                    "card_brand": card_brand,
+                    "terms_conditions": terms_conditions,
+                    "offer_day": offer_day,
+                    "valid_to": valid_to,
+                    "category_name": category_name,
+                }
+                apply_offer_update(conn, cur, existing_id, changes, inserter, updates, best_match)
+                index.update(existing_id, {**changes, "status": "A"})
                 updated_ids.add(existing_id)
                 log_event(f"✅ Actualizado GNB (ID={existing_id}) - Similitud {best_score:.2f}% - Campos: {', '.join(changed_fields)}")
             else:
                 log_event(f"🟢 GNB sin cambios (similitud {best_score:.2f}%)")
+            return existing_id
         else:
-            insert_pdf_mysql(conn, record)
+            new_row = insert_pdf_mysql(conn, record, inserter)
+            if new_row:
+                index.add(new_row)
             log_event(f"🆕 Insertado nuevo registro GNB (similitud {best_score:.2f}%)")
+            return new_row["id"] if new_row else None
 
     except mysql.connector.Error as e:
         conn.rollback()
@@ -366,6 +432,7 @@ def configure_gemini(api_key: str):
     genai.configure(api_key=api_key)
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = "gemini-2.5-flash"
 
 
 PDFS_CSV = "data_gnbpy/beneficios.csv"
@@ -374,6 +441,21 @@ DATA_DIR.mkdir(exist_ok=True)
 LOG_FILE = DATA_DIR / "procesamiento_gnb.log"
 OUTPUT_CSV = DATA_DIR / "gemini_resultados_ok_gnb.csv"
 BANK_NAME = "BANCO GNB PARAGUAY"
+OCR_STATE_VERSION = "1"  # subir al cambiar prompts o reglas de extracción (invalida el estado incremental)
+# Encabezado de la sección de locales adheridos (las direcciones están desde ahí hasta el final)
+SECTION5_RE = re.compile(r"(?i)\b5\.\s*(locales|sucursales|direcci[oó]n|adheridas)")
+# Compactación del texto del PDF: los bloques 1 a 4 se envían sin modificar (terms_raw/terms_conditions)
+COMPACT_PROFILE = CompactProfile(
+    protect=[
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?vigencia\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?condiciones\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?beneficios?\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?mec[aá]nica\b",
+    ],
+    boilerplate=[r"(?i)^banco gnb( paraguay)?( s\.?a\.?)?\.?$"],
+)
+# Respuesta de call_gemini_api: lista de registros con vigencia en formato ISO
+RESPONSE_SCHEMA = ResponseSchema()
 
 # ========================================
 # FUNCIONES AUXILIARES
@@ -392,20 +474,12 @@ def log_periodic_processing(interval_seconds=120):
         log_event("⏳ Procesando...")  # usa tu función existente log_event
         
 
-def extract_text_from_pdf(pdf_path):
-    """Extrae texto completo del PDF"""
-    text = ""
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-    return text
-
+def extract_text_from_pdf(pdf):
+    """Extrae texto completo del PDF (ParsedPdf: cada página se lee una sola vez)"""
+    return pdf.full_text()
 
-def call_gemini_api(category_name, text, pdf_file):
-    model = genai.GenerativeModel("gemini-2.5-flash")
 
+def call_gemini_api(category_name, text, pdf_file, use_cache=True):
     prompt = f"""
 Analiza el siguiente texto del PDF y devuelve SOLO un JSON estricto (sin comentarios ni texto extra)
 con una lista de registros (un objeto por cada sucursal o local adherido).
@@ -459,36 +533,30 @@ Texto del PDF:
 ---
 """
     try:
-        response = model.generate_content(prompt)
-        content = response.text.strip()
+        content = generate_text(GEMINI_MODEL, prompt, use_cache=use_cache).strip()
         # Eliminar envoltorios tipo ```json ... ```
         content = re.sub(r"^```(?:json)?\s*", "", content)
         content = re.sub(r"\s*```$", "", content)
         # Intentar extraer un JSON puro incluso si Gemini devuelve texto extra
         log_event(f"📄 {pdf_file} - Respuesta Gemini (raw):\n{content}\n{'-'*80}")
-        # Buscar el primer bloque JSON que parezca una lista/objeto
-        m = re.search(r"(\[\s*\{.*\}\s*\])", content, re.S)
-        if m:
-            content_clean = m.group(1)
-        else:
-            # Fallback: buscar desde el primer '[' hasta el último ']' si existe
-            start = content.find('[')
-            end = content.rfind(']')
-            if start != -1 and end != -1 and end > start:
-                content_clean = content[start:end+1]
-            else:
-                content_clean = content
-
-        # Eliminar comas finales malformadas antes del cierre de listas/objetos
-        content_clean = re.sub(r",\s*\](?!\])", "]", content_clean)
-        try:
-            data = json.loads(content_clean)
-        except json.JSONDecodeError:
+        # Extraer el JSON aunque venga con texto extra, comas finales o cortado
+        data = parse_json_response(content)
+        if data is None:
             # Registro del intento fallido y fallback a lista vacía
-            log_event(f"⚠️ {pdf_file} - No se pudo decodificar JSON salvado de Gemini. Contenido parcial:\n{content_clean}")
+            log_event(f"⚠️ {pdf_file} - No se pudo decodificar ni reparar el JSON de Gemini.")
             data = []
+        data = RESPONSE_SCHEMA.records(data)
+
+        # Fechas que faltan: consulta corta sobre VIGENCIA en vez de reprocesar el PDF
+        faltantes = fill_missing_fields(data, text, RESPONSE_SCHEMA, context=pdf_file, use_cache=use_cache)
+        if faltantes:
+            log_event(f"⚠️ {pdf_file} - Sin {', '.join(faltantes)} tras la consulta corta")
+        if not data or faltantes:
+            # Respuesta vacía o incompleta: el reintento (y la próxima corrida) vuelve a consultar
+            forget_response(GEMINI_MODEL, prompt)
     except json.JSONDecodeError:
         log_event(f"⚠️ {pdf_file} - JSON inválido. No se pudo decodificar respuesta de Gemini.")
+        forget_response(GEMINI_MODEL, prompt)
         data = []
     except Exception as e:
         log_event(f"⚠️ {pdf_file} - Error al llamar a Gemini: {e}")
@@ -502,7 +570,24 @@ Texto del PDF:
     return data
 
 
-def extract_table_after_section(pdf_path):
+def camelot_candidate_pages(pdf):
+    """
+    Páginas para Camelot en formato `pages=`: las de la sección 5 (todas si no se
+    encuentra el encabezado) que tienen una tabla con bordes. Cadena vacía si
+    ninguna la tiene, en cuyo caso no vale la pena invocar Camelot.
+    """
+    section = locate_section(pdf, SECTION5_RE)
+    candidates = range(section[0], section[1] + 1) if section else range(pdf.num_pages)
+    ruled = ruled_table_pages(pdf, candidates)
+    if not ruled:
+        log_event(f"⏭️ {pdf.name}: sin tablas con bordes en {len(candidates)} página(s), se omite Camelot")
+        return ""
+    pages = camelot_pages(ruled)
+    log_event(f"📑 {pdf.name}: Camelot sobre páginas {pages} de {pdf.num_pages}")
+    return pages
+
+
+def extract_table_after_section(pdf):
     """
     Extrae todas las direcciones de un PDF:
     - Detecta cabeceras de ciudad (líneas en mayúsculas).
@@ -514,8 +599,9 @@ def extract_table_after_section(pdf_path):
     pdfplumber_count = 0
 
     try:
-        tables = camelot.read_pdf(str(pdf_path), pages="all")
-        log_event(f"{pdf_path.name}: {len(tables)} tabla(s) detectada(s) por Camelot")
+        pages = camelot_candidate_pages(pdf)
+        tables = camelot.read_pdf(str(pdf.path), pages=pages) if pages else []
+        log_event(f"{pdf.name}: {len(tables)} tabla(s) detectada(s) por Camelot")
 
         for t_idx, t in enumerate(tables, start=1):
             df = t.df
@@ -544,37 +630,66 @@ def extract_table_after_section(pdf_path):
                     })
                     camelot_count += 1
 
-        with pdfplumber.open(pdf_path) as pdf:
-            for page_idx, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text() or ""
-                lines = [l.strip() for l in text.split("\n") if l.strip()]
-                current_city = None
-
-                for line_idx, line in enumerate(lines):
-                        # Detectar cabecera de ciudad (todas mayúsculas) o con guiones
-                        if re.match(r"^[A-ZÁÉÍÓÚÑ0-9 .,-]{2,}$", line) and line.upper() == line:
-                            # Evitar líneas demasiado cortas que no sean ciudad
-                            if len(line) > 2 and len(line) < 80:
-                                current_city = line.strip()
-                                log_event(f"🟢 Página {page_idx}, línea {line_idx}: Ciudad detectada → {current_city}")
-                                continue
-
-                    # Detectar línea numerada o con guiones/puntos como separador
-                        match_num = re.match(r"^\s*(\d+)\s*[\.|\-|\)]?\s*(.+?)(?:\s{2,}|\s{0,}–\s{0,}|\||\,\s|\s-\s)(.+)$", line)
-                        if match_num:
-                            sucursal = match_num.group(2).strip()
-                            direccion = match_num.group(3).strip()
+        for page_idx, text in enumerate(pdf.pages_text(), start=1):
+            lines = [l.strip() for l in text.split("\n") if l.strip()]
+            current_city = None
+
+            for line_idx, line in enumerate(lines):
+                    # Detectar cabecera de ciudad (todas mayúsculas) o con guiones
+                    if re.match(r"^[A-ZÁÉÍÓÚÑ0-9 .,-]{2,}$", line) and line.upper() == line:
+                        # Evitar líneas demasiado cortas que no sean ciudad
+                        if len(line) > 2 and len(line) < 80:
+                            current_city = line.strip()
+                            log_event(f"🟢 Página {page_idx}, línea {line_idx}: Ciudad detectada → {current_city}")
+                            continue
+
+                # Detectar línea numerada o con guiones/puntos como separador
+                    match_num = re.match(r"^\s*(\d+)\s*[\.|\-|\)]?\s*(.+?)(?:\s{2,}|\s{0,}–\s{0,}|\||\,\s|\s-\s)(.+)$", line)
+                    if match_num:
+                        sucursal = match_num.group(2).strip()
+                        direccion = match_num.group(3).strip()
+                        direccion = direccion.strip()
+                        # Si la dirección continúa en la siguiente línea y la siguiente no es mayúscula/city, unirla
+                        # (buscamos en lines siguientes si existen)
+                        j = line_idx + 1
+                        while j < len(lines) and not re.match(r"^[A-ZÁÉÍÓÚÑ ]{2,}$", lines[j]) and not re.match(r"^\d+", lines[j]) and '|' not in lines[j]:
+                            # evitar unir si la línea siguiente parece un encabezado corto
+                            if len(lines[j]) > 0 and len(lines[j]) < 200:
+                                direccion += " " + lines[j].strip()
+                                j += 1
+                            else:
+                                break
+
+                        location = current_city or extract_location_from_address(direccion)
+                        merchant_name = sucursal
+                        results.append({
+                            "merchant_name": merchant_name,
+                            "address": direccion,
+                            "location": location
+                        })
+                        pdfplumber_count += 1
+                        continue
+
+                # Detectar línea con pipe como separador o con ' - ' o ' ; '
+                    if "|" in line or " - " in line or ";" in line:
+                        # Probar varios separadores comunes
+                        parts = None
+                        if "|" in line:
+                            parts = [p.strip() for p in line.split("|")]
+                        elif " - " in line:
+                            parts = [p.strip() for p in line.split(" - ")]
+                        else:
+                            parts = [p.strip() for p in line.split(";")]
+
+                        if parts and len(parts) >= 2:
+                            sucursal = parts[0]
+                            direccion = " ".join(parts[1:]).strip()
                             direccion = direccion.strip()
-                            # Si la dirección continúa en la siguiente línea y la siguiente no es mayúscula/city, unirla
-                            # (buscamos en lines siguientes si existen)
+                            # combinar con siguientes líneas si parecen continuidad de dirección
                             j = line_idx + 1
                             while j < len(lines) and not re.match(r"^[A-ZÁÉÍÓÚÑ ]{2,}$", lines[j]) and not re.match(r"^\d+", lines[j]) and '|' not in lines[j]:
-                                # evitar unir si la línea siguiente parece un encabezado corto
-                                if len(lines[j]) > 0 and len(lines[j]) < 200:
-                                    direccion += " " + lines[j].strip()
-                                    j += 1
-                                else:
-                                    break
+                                direccion += " " + lines[j].strip()
+                                j += 1
 
                             location = current_city or extract_location_from_address(direccion)
                             merchant_name = sucursal
@@ -584,39 +699,8 @@ def extract_table_after_section(pdf_path):
                                 "location": location
                             })
                             pdfplumber_count += 1
-                            continue
 
-                    # Detectar línea con pipe como separador o con ' - ' o ' ; '
-                        if "|" in line or " - " in line or ";" in line:
-                            # Probar varios separadores comunes
-                            parts = None
-                            if "|" in line:
-                                parts = [p.strip() for p in line.split("|")]
-                            elif " - " in line:
-                                parts = [p.strip() for p in line.split(" - ")]
-                            else:
-                                parts = [p.strip() for p in line.split(";")]
-
-                            if parts and len(parts) >= 2:
-                                sucursal = parts[0]
-                                direccion = " ".join(parts[1:]).strip()
-                                direccion = direccion.strip()
-                                # combinar con siguientes líneas si parecen continuidad de dirección
-                                j = line_idx + 1
-                                while j < len(lines) and not re.match(r"^[A-ZÁÉÍÓÚÑ ]{2,}$", lines[j]) and not re.match(r"^\d+", lines[j]) and '|' not in lines[j]:
-                                    direccion += " " + lines[j].strip()
-                                    j += 1
-
-                                location = current_city or extract_location_from_address(direccion)
-                                merchant_name = sucursal
-                                results.append({
-                                    "merchant_name": merchant_name,
-                                    "address": direccion,
-                                    "location": location
-                                })
-                                pdfplumber_count += 1
-
-        log_event(f"✅ {pdf_path.name}: {len(results)} direcciones extraídas (Camelot: {camelot_count}, pdfplumber: {pdfplumber_count})")
+        log_event(f"✅ {pdf.name}: {len(results)} direcciones extraídas (Camelot: {camelot_count}, pdfplumber: {pdfplumber_count})")
         return results
 
     except Exception as e:
@@ -626,22 +710,19 @@ def extract_table_after_section(pdf_path):
 
 
 # Extraer información de la sección 5
-def extract_text_until_section5(pdf_path):
-    """Extrae el texto de un PDF hasta antes de la sección 5."""
-    text = ""
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text() or ""
-            # Cortar cuando se detecta la sección 5
-            match = re.search(r"(?i)\b5\.\s*(locales|sucursales|direcci[oó]n|adheridas)", page_text)
-            if match:
-                text += page_text[:match.start()]
-                break
-            else:
-                text += page_text + "\n"
+def extract_prompt_text(pdf, stop=None):
+    """Texto compactado del PDF (ParsedPdf) para call_gemini_api, hasta `stop` si se indica."""
+    compactor = PromptCompactor(COMPACT_PROFILE)
+    text = read_section_text(pdf, stop=stop, clean=compactor.page)
+    compactor.record()
     return text
 
 
+def extract_text_until_section5(pdf):
+    """Extrae el texto compactado de un PDF (ParsedPdf) hasta antes de la sección 5."""
+    return extract_prompt_text(pdf, stop=SECTION5_RE)
+
+
 
 def normalize_merchant_name(name):
     """
@@ -667,7 +748,7 @@ def normalize_merchant_name(name):
         return name
 
 
-def correct_addresses_with_gemini(records, pdf_file):
+def correct_addresses_with_gemini(records, pdf_file, use_cache=True):
     """
     Envía todos los registros a Gemini, para que decida si hay que corregir address.
     Retorna lista de registros actualizados.
@@ -679,9 +760,7 @@ def correct_addresses_with_gemini(records, pdf_file):
     for r in records:
         prompt_text += f"- {r.get('merchant_name', '')} | {r.get('address','')} | {r.get('location','')}\n"
 
-    try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(f"""
+    prompt = f"""
 Analiza estas entradas y devuelve un JSON con los campos:
 [
   {{
@@ -692,13 +771,15 @@ Analiza estas entradas y devuelve un JSON con los campos:
 ]
 Texto a corregir/confirmar:
 {prompt_text}
-""")
-        content = response.text.strip()
+"""
+    try:
+        content = generate_text(GEMINI_MODEL, prompt, use_cache=use_cache).strip()
         content = re.sub(r"^```(?:json)?\s*", "", content)
         content = re.sub(r"\s*```$", "", content)
         corrected = json.loads(content)
     except Exception as e:
         log_event(f"⚠️ {pdf_file} - Error corrigiendo direcciones con Gemini: {e}")
+        forget_response(GEMINI_MODEL, prompt)
         return records
 
     # Reemplazar los registros originales por los corregidos
@@ -746,7 +827,7 @@ def parse_line_preserve_merchant(line, current_city=None):
 
 #Extraer información con camelot    
 
-def extract_addresses_with_camelot(pdf_path):
+def extract_addresses_with_camelot(pdf):
     """
     Extrae direcciones de TODAS las páginas del PDF usando únicamente Camelot.
     - Usa correctamente la segunda columna como merchant_name, conservando texto original.
@@ -759,9 +840,13 @@ def extract_addresses_with_camelot(pdf_path):
     current_city = None
 
     try:
-        log_event(f"🔍 Iniciando extracción de direcciones en {pdf_path.name}")
+        log_event(f"🔍 Iniciando extracción de direcciones en {pdf.name}")
 
-        tables = camelot.read_pdf(str(pdf_path), pages="all")
+        # Camelot solo sobre las páginas de la sección 5 que tienen una tabla con bordes
+        pages = camelot_candidate_pages(pdf)
+        if not pages:
+            return []
+        tables = camelot.read_pdf(str(pdf.path), pages=pages)
 
         for table_idx, table in enumerate(tables, start=1):
             # Detectar columnas numéricas (índices)
@@ -824,8 +909,8 @@ def extract_addresses_with_camelot(pdf_path):
                 seen.add(key)
                 unique.append(r)
 
-        log_event(f"📄 {pdf_path.name}: Ciudades detectadas → {', '.join(sorted(detected_cities)) if detected_cities else 'Ninguna'}")
-        log_event(f"✅ {pdf_path.name}: {len(unique)} direcciones finales extraídas en total")
+        log_event(f"📄 {pdf.name}: Ciudades detectadas → {', '.join(sorted(detected_cities)) if detected_cities else 'Ninguna'}")
+        log_event(f"✅ {pdf.name}: {len(unique)} direcciones finales extraídas en total")
 
         return unique
 
@@ -885,27 +970,36 @@ def clean_and_deduplicate_data(data_list):
     return df.to_dict(orient="records")
 
 
-def process_pdf(pdf_path, category_name):
-    log_event(f"🔍 Procesando PDF: {pdf_path.name}")
+def process_pdf(pdf_path, category_name, use_cache=True):
+    """
+    Abre el PDF una sola vez (ParsedPdf) y lo procesa con todas las pasadas de extracción.
+    El reintento de PDFs con error pasa `use_cache=False` para no recibir de la caché la
+    misma respuesta de Gemini que falló.
+    """
+    with ParsedPdf(pdf_path) as pdf:
+        return process_parsed_pdf(pdf, category_name, use_cache)
+
+
+def process_parsed_pdf(pdf, category_name, use_cache=True):
+    log_event(f"🔍 Procesando PDF: {pdf.name}")
 
     # Contar páginas primero
-    reader = PdfReader(str(pdf_path))
-    num_pages = len(reader.pages)
-    log_event(f"📘 {pdf_path.name}: {num_pages} páginas detectadas")
+    num_pages = pdf.num_pages
+    log_event(f"📘 {pdf.name}: {num_pages} páginas detectadas")
 
     # Extraer texto base
-    full_text = extract_text_from_pdf(pdf_path)
+    full_text = extract_text_from_pdf(pdf)
 
     # 1️⃣ Caso especial Farmatotal
     if "Bases y Condiciones “Farmatotal”" in full_text or "Bases y Condiciones \"Farmatotal\"" in full_text:
         log_event(f"🏪 PDF detectado como Farmatotal → usando flujo especial")
-        return process_farmatotal_pdf(pdf_path, category_name)
+        return process_farmatotal_pdf(pdf, category_name, use_cache)
 
     # 2️⃣ Caso especial Drugstore Asismed
     if ("Bases y Condiciones “Drugstore Asismed”" in full_text) or ("Bases y Condiciones \"Drugstore Asismed\"" in full_text):
         log_event(f"💊 PDF detectado como Drugstore Asismed → ajustando merchant_name dinámicamente según la location extraída")
 
-        general_data = call_gemini_api(category_name, full_text, pdf_path.name)
+        general_data = call_gemini_api(category_name, extract_prompt_text(pdf), pdf.name, use_cache)
 
         # Forzar merchant_name dinámico basado en location
         for item in general_data:
@@ -918,22 +1012,22 @@ def process_pdf(pdf_path, category_name):
 
     # 2️⃣ PDFs cortos (≤2 páginas)
     if num_pages <= 2:
-        log_event(f"⚡ {pdf_path.name}: PDF corto (≤2 páginas) → llamando a call_gemini_api")
-        general_data = call_gemini_api(category_name, full_text, pdf_path.name)
-        log_event(f"✅ {pdf_path.name}: Datos obtenidos con Gemini ({len(general_data)} registros)")
+        log_event(f"⚡ {pdf.name}: PDF corto (≤2 páginas) → llamando a call_gemini_api")
+        general_data = call_gemini_api(category_name, extract_prompt_text(pdf), pdf.name, use_cache)
+        log_event(f"✅ {pdf.name}: Datos obtenidos con Gemini ({len(general_data)} registros)")
         return general_data
 
     # 3️⃣ PDFs largos (>2 páginas)
-    log_event(f"📊 {pdf_path.name}: PDF largo (>2 páginas) → flujo extendido")
-    text_without_section5 = extract_text_until_section5(pdf_path)
-    general_data = call_gemini_api(category_name, text_without_section5, pdf_path.name)
-    log_event(f"✅ {pdf_path.name}: Datos generales obtenidos con Gemini ({len(general_data)} registros)")
+    log_event(f"📊 {pdf.name}: PDF largo (>2 páginas) → flujo extendido")
+    text_without_section5 = extract_text_until_section5(pdf)
+    general_data = call_gemini_api(category_name, text_without_section5, pdf.name, use_cache)
+    log_event(f"✅ {pdf.name}: Datos generales obtenidos con Gemini ({len(general_data)} registros)")
 
     # Extraer direcciones con Camelot/pdfplumber
-    address_records = extract_addresses_with_camelot(pdf_path)
+    address_records = extract_addresses_with_camelot(pdf)
     if address_records:
-        log_event(f"⚠️ {pdf_path.name}: Enviando {len(address_records)} direcciones a Gemini para corrección")
-        corrected_records = correct_addresses_with_gemini(address_records, pdf_path.name)
+        log_event(f"⚠️ {pdf.name}: Enviando {len(address_records)} direcciones a Gemini para corrección")
+        corrected_records = correct_addresses_with_gemini(address_records, pdf.name, use_cache)
 
         # Combinar datos generales con direcciones corregidas
         merged_data = []
@@ -944,29 +1038,28 @@ def process_pdf(pdf_path, category_name):
                 item["location"] = sanitize_location_value(addr.get('location'))
                 item["address"] = addr.get('address', '')
                 merged_data.append(item)
-        log_event(f"📦 {pdf_path.name}: Datos combinados ({len(merged_data)} registros finales)")
+        log_event(f"📦 {pdf.name}: Datos combinados ({len(merged_data)} registros finales)")
         return merged_data
     else:
-        log_event(f"⚠️ {pdf_path.name}: No se detectaron direcciones, devolviendo solo datos generales")
+        log_event(f"⚠️ {pdf.name}: No se detectaron direcciones, devolviendo solo datos generales")
         return general_data
 
 
-def process_farmatotal_pdf(pdf_path, category_name):
+def process_farmatotal_pdf(pdf, category_name, use_cache=True):
     """
     Procesa PDF Farmatotal:
     - Usa el merchant_name que devuelve Gemini, anteponiendo 'Farmatotal - ' (solo si no lo incluye).
     - Si Gemini no devuelve merchant_name, asigna 'Farmatotal' por defecto.
     - Registra en logs el merchant_name final y la dirección.
     """
-    log_event(f"🏪 Procesando Farmatotal PDF: {pdf_path.name}")
+    log_event(f"🏪 Procesando Farmatotal PDF: {pdf.name}")
 
     # 1️⃣ Obtener datos desde Gemini
-    full_text = extract_text_from_pdf(pdf_path)
-    gemini_data = call_gemini_api(category_name, full_text, pdf_path.name)
+    gemini_data = call_gemini_api(category_name, extract_prompt_text(pdf), pdf.name, use_cache)
 
     if not gemini_data:
-        log_event(f"⚠️ {pdf_path.name}: Gemini no devolvió datos, usando fallback de direcciones.")
-        farmatotal_addresses = extract_farmatotal_addresses(pdf_path)
+        log_event(f"⚠️ {pdf.name}: Gemini no devolvió datos, usando fallback de direcciones.")
+        farmatotal_addresses = extract_farmatotal_addresses(pdf)
         fallback_records = []
 
         for _, addr_pdf in farmatotal_addresses:
@@ -984,16 +1077,16 @@ def process_farmatotal_pdf(pdf_path, category_name):
                 "merchant_name": "Farmatotal",
                 "location": "Farmatotal",
                 "address": addr_pdf or "",
-                "pdf_file": pdf_path.name
+                "pdf_file": pdf.name
             }
             fallback_records.append(rec)
             log_event(f"📍 Registro creado: {rec['merchant_name']} | Dirección: {rec['address']}")
 
-        log_event(f"✅ {pdf_path.name}: {len(fallback_records)} registros creados con fallback.")
+        log_event(f"✅ {pdf.name}: {len(fallback_records)} registros creados con fallback.")
         return fallback_records
 
     # 2️⃣ Extraer direcciones desde PDF
-    farmatotal_addresses = extract_farmatotal_addresses(pdf_path)
+    farmatotal_addresses = extract_farmatotal_addresses(pdf)
     final_records = []
 
     # 3️⃣ Construir registros finales
@@ -1043,17 +1136,17 @@ def process_farmatotal_pdf(pdf_path, category_name):
             final_records.append(item)
             log_event(f"📍 Registro creado: {item['merchant_name']} | Dirección: {item['address']}")
 
-    log_event(f"✅ {pdf_path.name}: {len(final_records)} registros finales combinados (Farmatotal).")
+    log_event(f"✅ {pdf.name}: {len(final_records)} registros finales combinados (Farmatotal).")
     return final_records
 
 
-def detect_farmatotal_branch(pdf_path):
+def detect_farmatotal_branch(pdf):
     """
     Detecta la sucursal de Farmatotal desde el texto del PDF.
     Busca palabras como 'Sucursal Central', 'Farmatotal San Lorenzo', etc.
     """
     try:
-        text = extract_text_from_pdf(pdf_path)
+        text = extract_text_from_pdf(pdf)
         # Buscar patrones típicos de sucursal y devolver solo si parecen nombres (no direcciones)
         match = re.search(r"Sucursal\s+([A-Za-zÁÉÍÓÚÑáéíóú\s]+)", text)
         if match:
@@ -1166,7 +1259,7 @@ def extract_location_from_address(address):
 
 
 
-def extract_farmatotal_addresses(pdf_path):
+def extract_farmatotal_addresses(pdf):
     """
     Extrae direcciones del PDF Farmatotal.
     Retorna una lista de pares [location, direccion], sin número.
@@ -1175,47 +1268,45 @@ def extract_farmatotal_addresses(pdf_path):
     """
     results = []
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page_idx, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text() or ""
-                lines = [l.strip() for l in text.split("\n") if l.strip()]
-
-                for line in lines:
-                    # 🔹 Saltar encabezados o textos no relevantes (secciones)
-                    if re.search(r"(?i)\b(vigencia|beneficio|beneficios|mecanic|mecánica|sucursal|direcci[oó]n|farmatotal|bases|condiciones)\b", line):
-                        continue
+        for page_idx, text in enumerate(pdf.pages_text(), start=1):
+            lines = [l.strip() for l in text.split("\n") if l.strip()]
 
-                    location = ""
-                    direccion = ""
+            for line in lines:
+                # 🔹 Saltar encabezados o textos no relevantes (secciones)
+                if re.search(r"(?i)\b(vigencia|beneficio|beneficios|mecanic|mecánica|sucursal|direcci[oó]n|farmatotal|bases|condiciones)\b", line):
+                    continue
 
-                    # 1️⃣ Línea numerada tipo "1) Asunción R.I. 2 Ytororo esq..."
-                    match_num = re.match(r"^\s*\d+\s*[.)-]?\s*(.+?)\s{1,}(.+)$", line)
-                    if match_num:
-                        candidate_loc = match_num.group(1).strip()
-                        candidate_addr = match_num.group(2).strip()
-                        # Validar que el candidato de sucursal no sea un token inválido
-                        if candidate_loc and len(re.sub(r"[^A-Za-zÁÉÍÓÚÑáéíóú ]", "", candidate_loc)) >= 2:
-                            location = candidate_loc
-                            direccion = candidate_addr
+                location = ""
+                direccion = ""
+
+                # 1️⃣ Línea numerada tipo "1) Asunción R.I. 2 Ytororo esq..."
+                match_num = re.match(r"^\s*\d+\s*[.)-]?\s*(.+?)\s{1,}(.+)$", line)
+                if match_num:
+                    candidate_loc = match_num.group(1).strip()
+                    candidate_addr = match_num.group(2).strip()
+                    # Validar que el candidato de sucursal no sea un token inválido
+                    if candidate_loc and len(re.sub(r"[^A-Za-zÁÉÍÓÚÑáéíóú ]", "", candidate_loc)) >= 2:
+                        location = candidate_loc
+                        direccion = candidate_addr
+                        results.append([location, direccion])
+                        continue
+
+                # 2️⃣ Línea con separadores comunes: "|", " - ", " – ", ";"
+                if "|" in line or " – " in line or " - " in line or ";" in line:
+                    parts = re.split(r"[|–\-;]", line)
+                    parts = [p.strip() for p in parts if p.strip()]
+                    if len(parts) >= 2:
+                        location = parts[0]
+                        direccion = " ".join(parts[1:]).strip()
+                        # Validar location
+                        if location and len(re.sub(r"[^A-Za-zÁÉÍÓÚÑáéíóú ]", "", location)) >= 2:
                             results.append([location, direccion])
                             continue
 
-                    # 2️⃣ Línea con separadores comunes: "|", " - ", " – ", ";"
-                    if "|" in line or " – " in line or " - " in line or ";" in line:
-                        parts = re.split(r"[|–\-;]", line)
-                        parts = [p.strip() for p in parts if p.strip()]
-                        if len(parts) >= 2:
-                            location = parts[0]
-                            direccion = " ".join(parts[1:]).strip()
-                            # Validar location
-                            if location and len(re.sub(r"[^A-Za-zÁÉÍÓÚÑáéíóú ]", "", location)) >= 2:
-                                results.append([location, direccion])
-                                continue
-
-                    # 3️⃣ Si la línea parece una dirección completa, añadir con location vacío
-                    if is_likely_address(line):
-                        results.append(["", line.strip()])
-                        continue
+                # 3️⃣ Si la línea parece una dirección completa, añadir con location vacío
+                if is_likely_address(line):
+                    results.append(["", line.strip()])
+                    continue
 
         # 🔹 Eliminar duplicados y filtrar entradas basura
         unique_results = []
@@ -1235,7 +1326,7 @@ def extract_farmatotal_addresses(pdf_path):
                 seen.add(key)
                 unique_results.append([loc_norm, addr_norm])
 
-        log_event(f"✅ {pdf_path.name}: {len(unique_results)} direcciones extraídas (Farmatotal)")
+        log_event(f"✅ {pdf.name}: {len(unique_results)} direcciones extraídas (Farmatotal)")
         return unique_results
 
     except Exception as e:
@@ -1324,6 +1415,62 @@ def safe_str(val):
     else:
         return str(val)
     
+def upsert_gnb_batch(conn, pending, updated_ids, indices):
+    """
+    Upsert de un bloque de registros: primero se puntúan juntos contra la BD (un cdist
+    por campo) y luego se aplican en orden. `pending` es una lista de (registro, PDF).
+    Las filas nuevas y los cambios se acumulan y se confirman cada COMMIT_EVERY registros
+    (y al final, aunque el bucle se corte).
+    Devuelve {PDF: ids de web_offers de sus registros}, sin los PDFs de un tramo cuya
+    escritura falló.
+    """
+    if not pending:
+        return {}
+    prime_gnb_scorer(conn, [record for record, _ in pending], indices)
+    log_event(f"🧮 Scoring por lotes preparado: {len(pending)} registros")
+
+    blocking_stats = {"comparadas": 0, "evitadas": 0}
+    inserter = BatchInserter(conn)
+    updates = UpdateAccumulator(conn)
+    offer_ids = defaultdict(set)  # PDF → ids (los temporales se reemplazan al volcar el inserter)
+    pending_pdfs, failed_pdfs = set(), set()  # PDFs del tramo sin confirmar / con escritura fallida
+
+    def commit_block():
+        try:
+            commit_pending(conn, inserter, updates)
+        except mysql.connector.Error as e:
+            conn.rollback()
+            log_event(f"⚠ Error MySQL en la escritura por lotes: {e}")
+            failed_pdfs.update(pending_pdfs)
+        pending_pdfs.clear()
+
+    try:
+        for n, (record, pdf_name) in enumerate(pending, 1):
+            pending_pdfs.add(pdf_name)
+            try:
+                # 👇 Se pasa el set de IDs actualizados
+                row_id = upsert_offer_mysql(conn, record, updated_ids, indices, blocking_stats, inserter, updates)
+                if row_id is not None:
+                    inserter.track_ids(offer_ids[pdf_name])
+                    offer_ids[pdf_name].add(row_id)
+                log_event("Modo Online: Se insertó o actualizó en MySQL.")
+            except Exception as e:
+                log_event(f"⚠ Error insertando {pdf_name} en MySQL: {e}")
+            if n % COMMIT_EVERY == 0:
+                commit_block()
+    finally:
+        commit_block()
+        log_event(f"💾 Inserción por lotes: {inserter.inserted} registros nuevos "
+                  f"(bloques de {inserter.chunk_size}, {inserter.failed} con error)")
+        log_event(f"💾 Actualización por lotes: {updates.updated} registros en {updates.statements} sentencias")
+
+    total = blocking_stats["comparadas"] + blocking_stats["evitadas"]
+    pct = 100 * blocking_stats["evitadas"] / total if total else 0
+    log_event(f"🧱 Blocking categoría+marca: {blocking_stats['comparadas']} comparaciones realizadas, "
+              f"{blocking_stats['evitadas']} evitadas ({pct:.1f}%)")
+    return {pdf: ids for pdf, ids in offer_ids.items() if pdf not in failed_pdfs}
+
+
 def clean_terms(text):
     if not text:
         return ""
@@ -1339,6 +1486,11 @@ def main():
     all_data = []
     errores_gemini = set()
     updated_ids = set()  # 👈 Nuevo: control de IDs ya actualizados
+    indices = {}  # Índice en memoria de web_offers por banco (una carga por ejecución)
+    pending_upserts = []  # (registro, PDF) a insertar/actualizar; se puntúan juntos por bloque de PDFs
+    written = 0  # registros de pending_upserts ya escritos en MySQL
+    state = OcrState("gnb", OCR_STATE_VERSION)  # PDFs sin cambios desde la última corrida (OCR_INCREMENTAL=1)
+    pdf_paths = {}  # nombre del PDF → ruta, para guardar el estado después del upsert
 
     # ===============================
     # CONEXIÓN A MYSQL
@@ -1353,6 +1505,7 @@ def main():
     # PROCESAR CSV DE PDFs
     # ===============================
     df_pdfs = pd.read_csv(PDFS_CSV)
+    jobs = []  # (pdf_path, categoría, offer_url, banco) de las filas con PDF disponible
     for idx, row in df_pdfs.iterrows():
         pdf_path_str = str(row.get("Ruta PDF")).strip()
         category_name_csv = str(row.get("Categoria", "SinCategoria")).strip() or "SinCategoria"
@@ -1368,57 +1521,80 @@ def main():
             log_event(f"⚠️ PDF no encontrado: {pdf_path_str}")
             continue
 
-        # --- Procesar PDF ---
-        records = process_pdf(pdf_path, category_name_csv)
-        if records:
-            all_data.extend(records)
-            log_event(f"✅ PDF procesado: {pdf_path.name} ({len(records)} registros)")
-
-            # --- Insertar/actualizar en MySQL ---
-            for rec in records:
-                raw_merchant = rec.get("merchant_name", "") or ""
-                final_merchant_name = ""
-
-                if (
-                    raw_merchant
-                    and isinstance(raw_merchant, str)
-                    and raw_merchant.strip()
-                    and not is_likely_address(raw_merchant)
-                    and raw_merchant.strip().lower() not in ["farmatotal", "dirección"]
-                ):
-                    final_merchant_name = clean_merchant_name(raw_merchant)
-
-                if not final_merchant_name:
-                    final_merchant_name = clean_merchant_name(raw_merchant) if raw_merchant else "Sin nombre"
+        if state.lookup(pdf_path) is not None:
+            log_event(f"♻️ Sin cambios desde la última corrida, se omite: {pdf_path.name}")
+            continue
 
-                insert_record = {
-                    "category_name": category_name_csv,
-                    "bank_name": rec.get("bank_name", bank_name),
-                    "valid_from": rec.get("valid_from"),
-                    "valid_to": rec.get("valid_to"),
-                    "offer_day": normalize_offer_day(rec.get("offer_day", "")),
-                    "benefic": rec.get("benefit", ""),
-                    "payment_methods": rec.get("payment_method", ""),
-                    "card_brand": rec.get("card_brand", ""),
-                    "terms_raw": rec.get("terms_raw", ""),
-                    "terms_conditions": clean_terms(rec.get("terms_conditions", "")),
-                    "merchant_name": final_merchant_name,
-                    "merchant_location": rec.get("location", ""),
-                    "merchant_address": rec.get("address", ""),
-                    "source_file": rec.get("pdf_file", pdf_path.name),
-                    "ai_response": rec.get("gemini_response", ""),
-                    "offer_url": offer_url
-                }
+        pdf_paths.setdefault(pdf_path.name, pdf_path)
+        jobs.append((pdf_path, category_name_csv, offer_url, bank_name))
+
+    def write_pending():
+        """Upsert de los registros aún no escritos y estado incremental de sus PDFs."""
+        nonlocal written
+        block, written = pending_upserts[written:], len(pending_upserts)
+        offer_ids = upsert_gnb_batch(conn, block, updated_ids, indices)
+        records_by_pdf = defaultdict(list)
+        for record, pdf_name in block:
+            records_by_pdf[pdf_name].append(record)
+        for pdf_name, ids in offer_ids.items():
+            state.save(pdf_paths.get(pdf_name, pdf_name), records_by_pdf[pdf_name], ids)
+
+    # --- Procesar PDFs: varios en vuelo a la vez, resultados en el orden del CSV; se
+    # escriben en MySQL cada COMMIT_EVERY_DOCS PDFs (y lo procesado hasta un corte, también) ---
+    log_event(f"🤖 Procesando {len(jobs)} PDFs con Gemini ({GEMINI_CONCURRENCY} en paralelo)")
+    processed = iter_concurrent(lambda job: process_pdf(job[0], job[1]), jobs)
 
-                try:
-                    # 👇 Se pasa el set de IDs actualizados
-                    upsert_offer_mysql(conn, insert_record, updated_ids)
-                    log_event("Modo Online: Se insertó o actualizó en MySQL.")
-                except Exception as e:
-                    log_event(f"⚠ Error insertando {pdf_path.name} en MySQL: {e}")
-        else:
-            errores_gemini.add(pdf_path.name)
-            log_event(f"⚠️ No se extrajeron registros de {pdf_path.name}")
+    try:
+        for n, ((pdf_path, category_name_csv, offer_url, bank_name), records) in enumerate(zip(jobs, processed)):
+            if n and n % COMMIT_EVERY_DOCS == 0:
+                write_pending()
+            if records:
+                all_data.extend(records)
+                log_event(f"✅ PDF procesado: {pdf_path.name} ({len(records)} registros)")
+
+                # --- Insertar/actualizar en MySQL ---
+                for rec in records:
+                    raw_merchant = rec.get("merchant_name", "") or ""
+                    final_merchant_name = ""
+
+                    if (
+                        raw_merchant
+                        and isinstance(raw_merchant, str)
+                        and raw_merchant.strip()
+                        and not is_likely_address(raw_merchant)
+                        and raw_merchant.strip().lower() not in ["farmatotal", "dirección"]
+                    ):
+                        final_merchant_name = clean_merchant_name(raw_merchant)
+
+                    if not final_merchant_name:
+                        final_merchant_name = clean_merchant_name(raw_merchant) if raw_merchant else "Sin nombre"
+
+                    insert_record = {
+                        "category_name": category_name_csv,
+                        "bank_name": rec.get("bank_name", bank_name),
+                        "valid_from": rec.get("valid_from"),
+                        "valid_to": rec.get("valid_to"),
+                        "offer_day": normalize_offer_day(rec.get("offer_day", "")),
+                        "benefic": rec.get("benefit", ""),
+                        "payment_methods": rec.get("payment_method", ""),
+                        "card_brand": rec.get("card_brand", ""),
+                        "terms_raw": rec.get("terms_raw", ""),
+                        "terms_conditions": clean_terms(rec.get("terms_conditions", "")),
+                        "merchant_name": final_merchant_name,
+                        "merchant_location": rec.get("location", ""),
+                        "merchant_address": rec.get("address", ""),
+                        "source_file": rec.get("pdf_file", pdf_path.name),
+                        "ai_response": rec.get("gemini_response", ""),
+                        "offer_url": offer_url
+                    }
+
+                    pending_upserts.append((insert_record, pdf_path.name))
+            else:
+                errores_gemini.add(pdf_path.name)
+                log_event(f"⚠️ No se extrajeron registros de {pdf_path.name}")
+    finally:
+        # Lo procesado hasta acá se escribe aunque el bucle se corte
+        write_pending()
 
     # ===============================
     # GUARDAR RESULTADOS
@@ -1436,15 +1612,19 @@ def main():
         time.sleep(5)
 
         reintento_data = []
+        retry_jobs = []
         for pdf_name in sorted(list(errores_gemini)):
             pdf_path = next(Path(".").rglob(pdf_name), None)
             if not pdf_path:
                 log_event(f"⚠️ No se encontró {pdf_name} para reintento.")
                 continue
+            retry_jobs.append((pdf_name, pdf_path))
 
+        retried = map_concurrent(lambda job: process_pdf(job[1], job[1].parent.name, use_cache=False), retry_jobs)
+
+        for (pdf_name, pdf_path), records in zip(retry_jobs, retried):
             log_event(f"🔄 Reintentando: {pdf_name}")
             category_name = pdf_path.parent.name
-            records = process_pdf(pdf_path, category_name)
             if not records:
                 log_event(f"❌ Reintento fallido: {pdf_name}")
                 continue
@@ -1487,12 +1667,7 @@ def main():
                     "offer_url": offer_url
                 }
 
-                try:
-                    # 👇 También se pasa el set en los reintentos
-                    upsert_offer_mysql(conn, insert_record, updated_ids)
-                    log_event("Modo Online: Se insertó o actualizó en MySQL (reintento).")
-                except Exception as e:
-                    log_event(f"⚠ Error insertando {pdf_name} en MySQL: {e}")
+                pending_upserts.append((insert_record, pdf_name))
 
         # Guardar reintentos a CSV
         if reintento_data:
@@ -1500,6 +1675,29 @@ def main():
             save_to_csv(reintento_data)
             log_event(f"💾 {len(reintento_data)} registros de reintentos guardados en {OUTPUT_CSV}")
 
+    # ===============================
+    # INSERTAR/ACTUALIZAR EN MYSQL LOS REINTENTOS
+    # ===============================
+    write_pending()
+
+    # Las ofertas de los PDFs sin cambios solo se marcan como vigentes
+    if state.unchanged_offer_ids:
+        try:
+            touched = touch_offers(conn, state.unchanged_offer_ids)
+            conn.commit()
+            log_event(f"♻️ {touched} ofertas de PDFs sin cambios marcadas como vigentes")
+        except mysql.connector.Error as e:
+            conn.rollback()
+            log_event(f"⚠ Error MySQL al marcar ofertas vigentes: {e}")
+
+    log_event(state.summary())
+    log_event(cache_summary())
+    log_event(rate_limit_summary())
+    log_event(page_cache_summary())
+    log_event(table_check_summary())
+    log_event(compaction_summary())
+    log_event(repair_summary())
+
     conn.close()
     log_event("✅ Proceso finalizado correctamente.")
 
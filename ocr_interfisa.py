@@ -1,18 +1,23 @@
 import os
 import re
 import json
-import pdfplumber
 import pandas as pd
 import google.generativeai as genai
 from datetime import datetime
 from pathlib import Path
 from PyPDF2 import PdfReader
 import unicodedata
-import time
 import logging
 import mysql.connector
 import unicodedata
-from fuzzywuzzy import fuzz
+from collections import defaultdict
+from offers_db import get_offer_index, BatchInserter, UpdateAccumulator, apply_offer_update, touch_offers
+from offers_match import get_batch_scorer, best_position
+from gemini_client import generate_text, forget_response, cache_summary, rate_limit_summary, map_concurrent, GEMINI_CONCURRENCY
+from pdf_text import ParsedPdf, page_cache_summary, read_section_text
+from prompt_compact import CompactProfile, PromptCompactor, compaction_summary
+from gemini_repair import ResponseSchema, parse_json_response, fill_missing_fields, repair_summary
+from ocr_state import OcrState
 
 #Configuración de la BD
 DB_CONFIG = {
@@ -23,7 +28,7 @@ DB_CONFIG = {
 }
 
 #Funciones para insertar datos en la BD
-def insert_pdf_mysql(conn, record):
+def insert_pdf_mysql(conn, record, inserter=None):
     """Inserta un registro en la tabla 'web_offers', manejando fechas vacías y evitando errores."""
     try:
         cur = conn.cursor()
@@ -66,40 +71,41 @@ def insert_pdf_mysql(conn, record):
         print("--- FIN DEBUG ---\n")
 
         # --- Ejecutar INSERT ---
-        cur.execute("""
-            INSERT INTO web_offers (
-                valid_to, valid_from, terms_raw, terms_conditions, source_file,
-                source, bank_name, payment_methods, offer_url, offer_day, merchant_name,
-                merchant_logo_url, merchant_logo_downloaded, merchant_location,
-                merchant_address, details, category_name, card_brand, benefit,
-                ai_response, status
-            ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
-            valid_to,
-            valid_from,
-            record.get("terms_raw"),
-            record.get("terms_conditions"),
-            record.get("source_file"),
-            "PDF",  # <-- source fijo
-            record.get("bank_name"),
-            record.get("payment_methods"),
-            record.get("offer_url") or "",
-            record.get("offer_day"),
-            record.get("merchant_name") or "",
-            record.get("merchant_logo_url"),
-            int(record.get("merchant_logo_downloaded", 0) or 0),
-            record.get("merchant_location") or "",
-            record.get("merchant_address") or "",
-            record.get("details"),
-            record.get("category_name"),
-            record.get("card_brand"),
-            record.get("benefic"),
-            record.get("ai_response"),
-            "P" #-- estado 'Pendiente'
-        ))
+        row = {
+            "valid_to": valid_to,
+            "valid_from": valid_from,
+            "terms_raw": record.get("terms_raw"),
+            "terms_conditions": record.get("terms_conditions"),
+            "source_file": record.get("source_file"),
+            "source": "PDF",  # <-- source fijo
+            "bank_name": record.get("bank_name"),
+            "payment_methods": record.get("payment_methods"),
+            "offer_url": record.get("offer_url") or "",
+            "offer_day": record.get("offer_day"),
+            "merchant_name": record.get("merchant_name") or "",
+            "merchant_logo_url": record.get("merchant_logo_url"),
+            "merchant_logo_downloaded": int(record.get("merchant_logo_downloaded", 0) or 0),
+            "merchant_location": record.get("merchant_location") or "",
+            "merchant_address": record.get("merchant_address") or "",
+            "details": record.get("details"),
+            "category_name": record.get("category_name"),
+            "card_brand": record.get("card_brand"),
+            "benefit": record.get("benefic"),
+            "ai_response": record.get("ai_response"),
+            "status": "P"  #-- estado 'Pendiente'
+        }
+        if inserter is not None:
+            # Modo por lotes: la fila queda en el buffer con id temporal
+            return inserter.add(row)
+        cur.execute(f"""
+            INSERT INTO web_offers ({', '.join(row)})
+            VALUES ({', '.join(['%s'] * len(row))})
+        """, tuple(row.values()))
 
 
         conn.commit()
+        # Fila tal como quedó en la BD, para mantener al día el índice en memoria
+        return {"id": cur.lastrowid, **row}
 
     except mysql.connector.Error as e:
         print(f"⚠ Error insertando en MySQL: {e}")
@@ -109,7 +115,59 @@ def insert_pdf_mysql(conn, record):
 
 #Actualización de registros en la BD
 
-def upsert_offer_mysql(conn, record):
+def normalize_offer_text(value):
+    """Normaliza texto para comparar ofertas: sin acentos, guiones unificados y en formato título."""
+    if value is None:
+        return ""
+    value = str(value).strip()
+    if value.lower() in ["nan", "none", "null", ""]:
+        return ""
+    value = unicodedata.normalize("NFD", value)
+    value = value.encode("ascii", "ignore").decode("utf-8")
+    value = re.sub(r"[-–]+", "-", value)
+    value = re.sub(r"\s{2,}", " ", value)
+    return value.strip().title()
+
+
+def interfisa_match_keys(record):
+    """Claves normalizadas (name, address, location, benefit) con las que se compara un registro."""
+    merchant_name_norm = normalize_offer_text(record.get("merchant_name"))
+    merchant_location_norm = normalize_offer_text(record.get("merchant_location"))
+
+    # --- Combinar location con nombre si no está incluido ---
+    if merchant_location_norm and not re.search(
+        rf"\b{re.escape(merchant_location_norm)}\b", merchant_name_norm, flags=re.IGNORECASE
+    ):
+        merchant_name_norm = f"{merchant_name_norm} - {merchant_location_norm}"
+    return {
+        "name": merchant_name_norm,
+        "address": normalize_offer_text(record.get("merchant_address")),
+        "location": merchant_location_norm,
+        "benefit": normalize_offer_text(record.get("benefit")),
+    }
+
+
+def load_interfisa_index(conn, bank_name, indices=None):
+    """Índice en memoria de web_offers (claves ya normalizadas) y su motor de scoring por lotes."""
+    index = get_offer_index(
+        conn, bank_name, indices,
+        normalize=normalize_offer_text,
+        extra_keys={"benefit": lambda r: normalize_offer_text(r.get("benefit"))},
+    )
+    return index, get_batch_scorer(index, fuzzywuzzy_compat=True)
+
+
+def prime_interfisa_scorer(conn, records, indices):
+    """Puntúa de una vez (cdist por campo) todos los registros de la corrida contra la BD."""
+    by_bank = {}
+    for record in records:
+        by_bank.setdefault(str(record.get("bank_name") or "").strip(), []).append(interfisa_match_keys(record))
+    for bank_name, keys in by_bank.items():
+        _, scorer = load_interfisa_index(conn, bank_name, indices)
+        scorer.prime({field: [k[field] for k in keys] for field in ("name", "address", "location", "benefit")})
+
+
+def upsert_offer_mysql(conn, record, indices=None, inserter=None, updates=None):
     """
     Inserta o actualiza una oferta en MySQL para INTERFISA BANCO.
 
@@ -118,63 +176,47 @@ def upsert_offer_mysql(conn, record):
     2️⃣ Si solo hay merchant_name, o merchant_name + location:
        - Comparación campo por campo para actualizar los campos que hayan cambiado.
        - Si el benefit cambia significativamente (fuzzy <90%), se inserta un nuevo registro.
+    `indices` (dict banco → OfferIndex) evita releer web_offers en cada llamada.
+    `inserter` (BatchInserter) acumula las filas nuevas para insertarlas por lotes y
+    `updates` (UpdateAccumulator) los cambios, que se aplican juntos al final.
+    Devuelve el id de web_offers que representa al registro (temporal si quedó en el
+    buffer del inserter), o None si hubo error.
     """
     cur = conn.cursor(dictionary=True)
     bank_name = str(record.get("bank_name") or "").strip()
 
     try:
-        # --- Función de normalización ---
-        def normalize_text(value):
-            if value is None:
-                return ""
-            value = str(value).strip()
-            if value.lower() in ["nan", "none", "null", ""]:
-                return ""
-            value = unicodedata.normalize("NFD", value)
-            value = value.encode("ascii", "ignore").decode("utf-8")
-            value = re.sub(r"[-–]+", "-", value)
-            value = re.sub(r"\s{2,}", " ", value)
-            return value.strip().title()
-
         # --- Normalizar campos ---
-        merchant_name_norm = normalize_text(record.get("merchant_name"))
-        merchant_address_norm = normalize_text(record.get("merchant_address"))
-        merchant_location_norm = normalize_text(record.get("merchant_location"))
-        benefit_norm = normalize_text(record.get("benefit"))
-
-        # --- Combinar location con nombre si no está incluido ---
-        if merchant_location_norm and not re.search(
-            rf"\b{re.escape(merchant_location_norm)}\b", merchant_name_norm, flags=re.IGNORECASE
-        ):
-            merchant_name_norm = f"{merchant_name_norm} - {merchant_location_norm}"
-
-        # --- Obtener registros existentes ---
-        cur.execute("""
-            SELECT *
-            FROM web_offers
-            WHERE bank_name = %s
-        """, (bank_name,))
-        existing = cur.fetchall()
+        keys = interfisa_match_keys(record)
+        merchant_name_norm = keys["name"]
+        merchant_address_norm = keys["address"]
+
+        # --- Obtener registros existentes (índice en memoria, claves ya normalizadas) ---
+        index, scorer = load_interfisa_index(conn, bank_name, indices)
+        if inserter is not None:
+            inserter.track_index(index)
+        existing = index.all()
 
         best_match = None
         best_score = 0
+        campos_cambio_match = []
+
+        # --- Comparación fuzzy contra todas las filas a la vez (vectores de cdist) ---
+        score_name = scorer.scores("name", keys["name"], existing)
+
+        if merchant_address_norm:
+            score_addr = scorer.scores("address", keys["address"], existing)
+            score_loc = scorer.scores("location", keys["location"], existing)
+            combined = (score_name * 2 + score_addr + score_loc) / 4
+            pos = best_position(combined)
+            if pos is not None:
+                best_match, best_score = existing[pos], float(combined[pos])
+        else:
+            # Casos especiales: solo merchant_name o merchant_name + location (sin address)
+            score_benefit = scorer.scores("benefit", keys["benefit"], existing)
+            new_benefit = (score_name >= 90) & (score_benefit < 90)
 
-        for ex in existing:
-            ex_name = normalize_text(ex.get("merchant_name", ""))
-            ex_address = normalize_text(ex.get("merchant_address", ""))
-            ex_location = normalize_text(ex.get("merchant_location", ""))
-            ex_benefit = normalize_text(ex.get("benefit", ""))
-
-            # Comparación fuzzy
-            score_name = fuzz.ratio(merchant_name_norm, ex_name)
-            score_addr = fuzz.ratio(merchant_address_norm, ex_address)
-            score_loc = fuzz.ratio(merchant_location_norm, ex_location)
-            combined_score = (score_name * 2 + score_addr + score_loc) / 4
-
-            # Casos especiales: solo merchant_name o merchant_name + location
-            if not merchant_address_norm:  # sin address
-                combined_score = score_name if not merchant_location_norm else (score_name*2 + score_loc)/3
-
+            for i, ex in enumerate(existing):
                 # Comparar campo por campo para detectar cambios
                 campos_cambio = []
                 for campo in ["offer_day", "payment_methods", "card_brand", "offer_url",
@@ -183,63 +225,55 @@ def upsert_offer_mysql(conn, record):
                         campos_cambio.append(campo)
 
                 # Verificar beneficio
-                score_benefit = fuzz.ratio(benefit_norm, ex_benefit)
-                if score_name >= 90 and score_benefit < 90:
-                    logging.info(f"🆕 Beneficio diferente detectado (score {score_benefit:.1f}%) "
+                if new_benefit[i]:
+                    logging.info(f"🆕 Beneficio diferente detectado (score {score_benefit[i]:.1f}%) "
                                  f"para '{merchant_name_norm}' — insertando nuevo registro.")
-                    insert_pdf_mysql(conn, record)
-                    return
+                    new_row = insert_pdf_mysql(conn, record, inserter)
+                    if new_row:
+                        index.add(new_row)
+                    return new_row["id"] if new_row else None
 
                 # Si hay otros campos modificados, actualizar
                 if campos_cambio:
                     best_match = ex
                     best_score = 100  # suficiente para update
-                    best_match["campos_cambio"] = campos_cambio
+                    campos_cambio_match = campos_cambio
                     break
 
-            elif combined_score > best_score:
-                best_score = combined_score
-                best_match = ex
-
         # --- Actualizar si se encontró coincidencia ---
         if best_match and best_score >= 50:
             logging.info(f"🟢 Coincidencia detectada — actualizando ID={best_match['id']}")
-            update_fields = []
-            update_values = []
+            changes = {}
 
             # Campos a actualizar según cambios detectados
-            campos_para_actualizar = best_match.get("campos_cambio", [])
+            campos_para_actualizar = campos_cambio_match
             for field in campos_para_actualizar:
                 val = record.get(field)
                 if val is not None:
-                    update_fields.append(f"{field}=%s")
-                    update_values.append(val)
+                    changes[field] = val
 
             # Siempre actualizar benefit si difiere
-            score_benefit = fuzz.ratio(benefit_norm, normalize_text(best_match.get("benefit", "")))
+            score_benefit = scorer.scores("benefit", keys["benefit"], [best_match])[0]
             if score_benefit < 90:
-                update_fields.append("benefit=%s")
-                update_values.append(record.get("benefit"))
+                changes["benefit"] = record.get("benefit")
 
             # Otros campos base que se actualizan siempre
             for field in ["offer_day", "payment_methods", "card_brand", "offer_url",
                           "terms_raw", "terms_conditions", "valid_from", "valid_to", "source_file"]:
                 if field not in campos_para_actualizar and field != "benefit":
-                    update_fields.append(f"{field}=%s")
-                    update_values.append(record.get(field) or "")
+                    changes[field] = record.get(field) or ""
 
-            update_fields += ["updated_at=NOW()", "status='A'"]
-
-            sql = f"UPDATE web_offers SET {', '.join(update_fields)} WHERE id=%s"
-            update_values.append(best_match["id"])
-            cur.execute(sql, tuple(update_values))
-            conn.commit()
+            apply_offer_update(conn, cur, best_match["id"], changes, inserter, updates, best_match)
+            index.update(best_match["id"], {**changes, "status": "A"})
             logging.info(f"✅ Registro actualizado correctamente (ID={best_match['id']})")
-            return
+            return best_match["id"]
 
         # --- Insertar nuevo registro si no hay coincidencia ---
         logging.info(f"🆕 No se encontró coincidencia suficiente — insertando nuevo registro.")
-        insert_pdf_mysql(conn, record)
+        new_row = insert_pdf_mysql(conn, record, inserter)
+        if new_row:
+            index.add(new_row)
+        return new_row["id"] if new_row else None
 
     except mysql.connector.Error as e:
         logging.info(f"⚠ Error en MySQL: {e}")
@@ -265,6 +299,21 @@ if not GEMINI_API_KEY:
     raise ValueError("❌ No se encontró la variable de entorno GEMINI_API_KEY")
 
 genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_TEXT_BUDGET = 100000  # caracteres del PDF que se envían en el prompt
+# Compactación del texto del PDF: las secciones que se vuelcan en el JSON van sin modificar
+COMPACT_PROFILE = CompactProfile(
+    protect=[
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?vigencia\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?condiciones\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?beneficios?\b",
+        r"(?i)^\s*(\d{1,2}\s*[\.\)-]\s*)?participaci[oó]n\b",
+    ],
+    boilerplate=[r"(?i)tus compras generan autom[aá]ticamente interpuntos"],
+)
+# Respuesta de analyze_with_gemini: lista (u objeto) de registros con vigencia en formato ISO
+RESPONSE_SCHEMA = ResponseSchema()
+OCR_STATE_VERSION = "2"  # subir al cambiar prompts o reglas de extracción (invalida el estado incremental)
 
 logging.basicConfig(
     filename=LOG_FILE,
@@ -282,20 +331,30 @@ def normalize_text(text: str) -> str:
     return text.strip()
 
 
-def extract_text_from_pdf(pdf_path: Path) -> str:
+def extract_text_from_pdf(pdf_path: Path) -> tuple:
+    """
+    (texto completo, texto para el prompt). El completo, sin compactar, es el que usan
+    los fallbacks locales y el reintento de campos faltantes; el del prompt está
+    compactado y cortado a GEMINI_TEXT_BUDGET.
+    """
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            text = " ".join([page.extract_text() or "" for page in pdf.pages])
-        return normalize_text(text)
+        with ParsedPdf(pdf_path) as pdf:
+            text = " ".join(pdf.pages_text())
+            compactor = PromptCompactor(COMPACT_PROFILE)
+            prompt_text = read_section_text(
+                pdf, max_chars=GEMINI_TEXT_BUDGET, sep=" ", clean=lambda page: normalize_text(compactor.page(page))
+            )
+            compactor.record()
+        return normalize_text(text), normalize_text(prompt_text)
     except Exception as e:
         logging.warning(f"Fallo pdfplumber en {pdf_path}: {e}")
         try:
             reader = PdfReader(str(pdf_path))
-            text = " ".join([p.extract_text() or "" for p in reader.pages])
-            return normalize_text(text)
+            text = normalize_text(" ".join([p.extract_text() or "" for p in reader.pages]))
+            return text, text
         except Exception as e2:
             logging.error(f"Fallo total lectura PDF {pdf_path}: {e2}")
-            return ""
+            return "", ""
 
 
 def clean_benefits(benefits):
@@ -377,17 +436,22 @@ def normalize_benefit_text(benefits):
     
     return result
 
+def unify_key(r):
+    """Clave con la que unify_similar_records agrupa registros (comercio, día, medio de pago, vigencia)."""
+    return (
+        r.get("merchant_name", "").strip().lower(),
+        r.get("offer_day", "").strip().lower(),
+        r.get("payment_method", "").strip().lower(),
+        r.get("valid_from", "").strip(),
+        r.get("valid_to", "").strip(),
+    )
+
+
 def unify_similar_records(resultados):
     """Une registros del mismo comercio y día, combinando beneficios y tarjetas."""
     merged = {}
     for r in resultados:
-        key = (
-            r.get("merchant_name", "").strip().lower(),
-            r.get("offer_day", "").strip().lower(),
-            r.get("payment_method", "").strip().lower(),
-            r.get("valid_from", "").strip(),
-            r.get("valid_to", "").strip(),
-        )
+        key = unify_key(r)
 
         if key not in merged:
             # Clonar registro base
@@ -441,14 +505,16 @@ def unify_similar_records(resultados):
     return final_list
 
 
-def analyze_with_gemini(text: str, context: dict) -> dict:
-    """Envía el texto del PDF al modelo Gemini y devuelve un resumen estructurado y limpio."""
-    import re, json
+def analyze_with_gemini(text: str, context: dict, prompt_text: str = None) -> dict:
+    """
+    Envía el texto del PDF al modelo Gemini y devuelve un resumen estructurado y limpio.
+    `prompt_text` (compactado) es lo que va en el prompt; `text` completo se usa para
+    completar campos faltantes.
+    """
+    import re
     from datetime import datetime
 
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-
         prompt = f"""
             Eres un analista experto en interpretar textos de promociones bancarias del Paraguay, 
             especialmente de INTERFISA BANCO. 
@@ -558,33 +624,29 @@ def analyze_with_gemini(text: str, context: dict) -> dict:
             ---
 
             TEXTO A ANALIZAR:
-            {text[:100000]}
+            {(prompt_text or text)[:GEMINI_TEXT_BUDGET]}
             """
 
-        response = model.generate_content(f"{prompt}\n\nTexto del PDF:\n{text}")
-
-        raw_output = response.text.strip()
+        raw_output = generate_text(GEMINI_MODEL, prompt).strip()
         logging.info(f"🔹 Gemini raw output para {context.get('merchant_name')}: {raw_output}")
 
-        # Intentar extraer JSON puro
-        json_match = re.search(r'\[\s*\{.*?\}\s*\]', raw_output, re.DOTALL)
-        if not json_match:
-            json_match = re.search(r'\{.*?\}', raw_output, re.DOTALL)
-
-        if not json_match:
+        # Extraer JSON puro (con reparación local si viene con texto extra o cortado)
+        data = parse_json_response(raw_output)
+        if data is None:
             logging.error(f"❌ No se encontró JSON válido para {context.get('merchant_name')}")
+            forget_response(GEMINI_MODEL, prompt)  # que el reintento vuelva a consultar a la API
             return {"error": "No se encontró JSON válido", "raw_output": raw_output}
 
-        json_str = json_match.group(0)
-        try:
-            data = json.loads(json_str)
-        except json.JSONDecodeError as e:
-            logging.error(f"Error decodificando JSON: {e}")
-            return {"error": f"JSON malformado ({e})", "raw_output": raw_output}
+        # {"error": "No se pudo extraer VIGENCIA"}: sin datos que completar, va al reintento
+        if isinstance(data, dict) and data.get("error"):
+            forget_response(GEMINI_MODEL, prompt)
+            return data
 
         # Asegurar formato lista
-        if isinstance(data, dict):
-            data = [data]
+        data = RESPONSE_SCHEMA.records(data)
+
+        # Fechas que faltan: consulta corta sobre VIGENCIA antes de caer en los valores por defecto
+        fill_missing_fields(data, text, RESPONSE_SCHEMA, context=context.get("merchant_name", ""))
 
         # 🔧 Post-procesamiento: limpiar beneficios y fechas
         for item in data:
@@ -616,11 +678,6 @@ def analyze_with_gemini(text: str, context: dict) -> dict:
 # MAIN
 # -----------------------------
 def main():
-    # Control de peticiones por minuto, rate limited
-    MAX_REQUESTS_PER_MIN = 10
-    SLEEP_SECONDS = 120
-    request_counter = 0
-
     logging.info("🚀 Iniciando procesamiento con Gemini...")
     if not CSV_INPUT.exists():
         raise FileNotFoundError(f"No se encuentra el CSV: {CSV_INPUT}")
@@ -644,7 +701,7 @@ def main():
         logging.info(f"📄 Procesando {pdf_path.name} (intento {intento})...")
 
         # 1️⃣ Extraer texto
-        text = extract_text_from_pdf(pdf_path)
+        text, prompt_text = extract_text_from_pdf(pdf_path)
         if not text:
             logging.warning(f"⚠️ Sin texto extraído de {pdf_path}")
             return None
@@ -658,7 +715,7 @@ def main():
         }
 
         # 3️⃣ Análisis con Gemini
-        result = analyze_with_gemini(text, context)
+        result = analyze_with_gemini(text, context, prompt_text)
 
         # 4️⃣ Validar salida
         if not result or (isinstance(result, dict) and result.get("error")):
@@ -695,28 +752,45 @@ def main():
         return registros
 
     # 🔁 Procesamiento de PDFs
+    # Varios PDFs en vuelo a la vez (GEMINI_CONCURRENCY); el límite de peticiones por
+    # minuto lo aplica gemini_client antes de cada llamada. Resultados en el orden del CSV.
+    # PDFs sin cambios desde la última corrida (OCR_INCREMENTAL=1): no pasan por Gemini; sus
+    # registros guardados (previos a la unificación) entran a la unificación con los nuevos,
+    # así el resultado es el mismo que en una corrida completa
+    state = OcrState("interfisa", OCR_STATE_VERSION)
+    rows = []
+    extracted = {}  # PDF → registros antes de unificar (guardados o de esta corrida), en el orden del CSV
     for _, row in df.iterrows():
-        request_counter += 1
-        if request_counter >= MAX_REQUESTS_PER_MIN:
-            logging.info(f"⏸️ Límite de {MAX_REQUESTS_PER_MIN} peticiones alcanzado. Esperando {SLEEP_SECONDS}s...")
-            time.sleep(SLEEP_SECONDS)
-            request_counter = 0
-
-        registros = procesar_pdf(row)
+        pdf_path = Path(row["pdf_filename"])
+        entry = state.lookup(pdf_path) if pdf_path.exists() else None
+        if entry is not None:
+            logging.info(f"♻️ Sin cambios desde la última corrida, se omite: {pdf_path.name}")
+            extracted[str(pdf_path)] = entry["records"]
+            continue
+        extracted[str(pdf_path)] = []
+        rows.append(row)
+    logging.info(f"🤖 Procesando {len(rows)} PDFs con Gemini ({GEMINI_CONCURRENCY} en paralelo)")
+    for row, registros in zip(rows, map_concurrent(procesar_pdf, rows)):
         if registros:
-            resultados.extend(registros)
+            extracted[str(Path(row["pdf_filename"]))] = registros
         else:
             fallidos.append(row)
-        time.sleep(2)
+    resultados = [r for registros in extracted.values() for r in registros]
 
     # 🔄 Reintento en caso de fallos
     if fallidos:
         logging.warning(f"🔁 Reprocesando {len(fallidos)} PDFs fallidos (1 intento más)...")
-        for _, row in enumerate(fallidos):
-            registros = procesar_pdf(row, intento=2)
+        for registros in map_concurrent(lambda row: procesar_pdf(row, intento=2), fallidos):
             if registros:
                 resultados.extend(registros)
-            time.sleep(3)
+
+    # Registros de cada PDF antes de unificar (lo que guarda el estado incremental) y PDFs
+    # que aportan a cada registro unificado
+    records_by_pdf = defaultdict(list)
+    pdfs_by_key = defaultdict(set)
+    for r in resultados:
+        records_by_pdf[r["pdf_filename"]].append(r)
+        pdfs_by_key[unify_key(r)].add(r["pdf_filename"])
 
     # 🧩 Unificar registros similares
     resultados = unify_similar_records(resultados)
@@ -735,7 +809,7 @@ def main():
             # 🧾 Log de auditoría: mostrar el beneficio final
             logging.info(f"💰 Beneficio final para '{item.get('merchant_name', 'Desconocido')}': {item['benefit']}")
 
-        # Guardar CSV
+        # Guardar CSV (incluye los registros de los PDFs sin cambios)
         df_out = pd.DataFrame(resultados)
         df_out.to_csv(OUTPUT_CSV, index=False)
         logging.info(f"✅ Resultados guardados en {OUTPUT_CSV}")
@@ -743,8 +817,10 @@ def main():
 
         # 💾 Insertar todos los registros en MySQL
         logging.info("💾 Insertando todos los registros nuevos en MySQL (INTERFISA BANCO)...")
+        indices = {}  # Índice en memoria de web_offers, se carga una sola vez
+        records = []
         for entry in resultados:
-            record = {
+            records.append({
                 "valid_to": entry.get("valid_to", ""),
                 "valid_from": entry.get("valid_from", ""),
                 "terms_raw": entry.get("terms_raw", ""),
@@ -764,15 +840,57 @@ def main():
                 "card_brand": entry.get("card_brand", ""),
                 "benefit": entry.get("benefit", ""),
                 "ai_response": json.dumps(entry, ensure_ascii=False)
-            }
+            })
 
-            upsert_offer_mysql(conn, record)
+        # Matriz de similitudes de toda la corrida en una sola pasada
+        prime_interfisa_scorer(conn, records, indices)
+        # Filas nuevas y cambios se acumulan y se escriben al final en una sola transacción
+        inserter = BatchInserter(conn)
+        updates = UpdateAccumulator(conn)
+        offer_ids = defaultdict(set)  # PDF → ids (los temporales se reemplazan al volcar el inserter)
+        for entry, record in zip(resultados, records):
+            row_id = upsert_offer_mysql(conn, record, indices, inserter, updates)
+            if row_id is not None:
+                # El id cuenta para todos los PDFs unificados en el registro
+                for pdf_filename in pdfs_by_key[unify_key(entry)]:
+                    inserter.track_ids(offer_ids[pdf_filename])
+                    offer_ids[pdf_filename].add(row_id)
+        try:
+            inserter.flush()
+            updates.apply()
+            conn.commit()
+            logging.info(f"💾 Inserción por lotes: {inserter.inserted} registros nuevos "
+                         f"(bloques de {inserter.chunk_size}, {inserter.failed} con error)")
+            logging.info(f"💾 Actualización por lotes: {updates.updated} registros en {updates.statements} sentencias")
+        except mysql.connector.Error as e:
+            conn.rollback()
+            logging.info(f"⚠ Error MySQL en la escritura por lotes: {e}")
+            offer_ids = {}
+
+        # Estado incremental (registros previos a la unificación) y ofertas de los PDFs sin
+        # cambios marcadas vigentes
+        for pdf_filename, ids in offer_ids.items():
+            state.save(pdf_filename, records_by_pdf[pdf_filename], ids)
+        if state.unchanged_offer_ids:
+            try:
+                touched = touch_offers(conn, state.unchanged_offer_ids)
+                conn.commit()
+                logging.info(f"♻️ {touched} ofertas de PDFs sin cambios marcadas como vigentes")
+            except mysql.connector.Error as e:
+                conn.rollback()
+                logging.info(f"⚠ Error MySQL al marcar ofertas vigentes: {e}")
 
         logging.info("🎯 Inserción masiva en MySQL finalizada correctamente.")
 
     else:
         logging.warning("⚠️ No se generaron resultados.")
 
+    logging.info(state.summary())
+    logging.info(cache_summary())
+    logging.info(rate_limit_summary())
+    logging.info(page_cache_summary())
+    logging.info(compaction_summary())
+    logging.info(repair_summary())
     conn.close()
 
 
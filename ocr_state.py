@@ -0,0 +1,120 @@
+"""
+Modo incremental del OCR: estado por banco de los PDFs ya procesados.
+
+Cada banco guarda en `OCR_STATE_DIR/<banco>.sqlite3` una fila por PDF (`source_file`,
+la ruta local): el SHA-256 del contenido, los registros extraídos (JSON) y los ids de
+web_offers que dejó el upsert. Con OCR_INCREMENTAL=1, un PDF cuyo SHA-256 coincide con
+el guardado no vuelve a pasar por Gemini ni por el upsert: `lookup` devuelve lo
+guardado y acumula sus ids en `unchanged_offer_ids`, que el script solo "toca" en la BD
+(`offers_db.touch_offers`: updated_at=NOW(), status='A'). Interfisa guarda los registros
+previos a `unify_similar_records` y los vuelve a unificar (y a pasar por el upsert, sin
+Gemini) junto con los de los PDFs nuevos, porque la unificación mezcla varios PDFs.
+
+El estado se guarda siempre (también en corridas completas), después de la escritura
+en la BD y solo para los PDFs que terminaron con al menos un id de web_offers, así un
+PDF que falló se vuelve a procesar en la corrida siguiente. Cada banco pasa su
+`version` de extracción: al cambiar prompts o reglas se sube y el estado anterior deja
+de coincidir.
+
+Configuración por entorno:
+
+- OCR_INCREMENTAL  ("0" por defecto; "1" saltea los PDFs sin cambios)
+- OCR_STATE_DIR    (directorio de los archivos SQLite, por defecto .cache/ocr_state)
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pdf_text import file_sha256
+
+OCR_INCREMENTAL = os.getenv("OCR_INCREMENTAL", "0") == "1"
+OCR_STATE_DIR = os.getenv("OCR_STATE_DIR", os.path.join(".cache", "ocr_state"))
+
+
+class OcrState:
+    """
+    Estado incremental de un banco.
+
+    - `lookup(ruta)`: registros e ids guardados si el PDF no cambió (None si hay que procesarlo)
+    - `save(ruta, registros, ids)`: guarda el resultado de un PDF procesado
+    - `summary()`: resumen para el log
+    """
+
+    def __init__(self, bank, version="1", directory=OCR_STATE_DIR, enabled=OCR_INCREMENTAL):
+        self.bank = bank
+        self.version = str(version)
+        self.enabled = enabled
+        self.unchanged_offer_ids = set()
+        self.stats = {"unchanged": 0, "processed": 0, "saved": 0}
+        self._shas = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, f"{bank}.sqlite3"), timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pdfs ("
+            " source_file TEXT PRIMARY KEY, sha256 TEXT NOT NULL, version TEXT NOT NULL,"
+            " records TEXT NOT NULL, offer_ids TEXT NOT NULL, processed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _key(path):
+        return os.path.normpath(str(path))
+
+    def fingerprint(self, path):
+        """SHA-256 del PDF (se calcula una vez por corrida)."""
+        key = self._key(path)
+        if key not in self._shas:
+            self._shas[key] = file_sha256(key)
+        return self._shas[key]
+
+    def lookup(self, path):
+        """
+        {"records": [...], "offer_ids": [...]} si el PDF es idéntico al de la última corrida
+        (misma versión de extracción y con ofertas en la BD); None si hay que procesarlo.
+        """
+        if not self.enabled:
+            self.stats["processed"] += 1
+            return None
+        key = self._key(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sha256, version, records, offer_ids FROM pdfs WHERE source_file = ?", (key,)
+            ).fetchone()
+        if not row or row[0] != self.fingerprint(key) or row[1] != self.version:
+            self.stats["processed"] += 1
+            return None
+        offer_ids = json.loads(row[3])
+        if not offer_ids:
+            self.stats["processed"] += 1
+            return None
+        self.stats["unchanged"] += 1
+        self.unchanged_offer_ids.update(offer_ids)
+        return {"records": json.loads(row[2]), "offer_ids": offer_ids}
+
+    def save(self, path, records, offer_ids):
+        """Guarda los registros y los ids de web_offers de un PDF ya escrito en la BD."""
+        offer_ids = sorted(i for i in offer_ids if i is not None and i > 0)
+        if not offer_ids:
+            return
+        key = self._key(path)
+        sha = self.fingerprint(key)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pdfs (source_file, sha256, version, records, offer_ids, processed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, sha, self.version, json.dumps(records, ensure_ascii=False, default=str),
+                 json.dumps(offer_ids), time.time()),
+            )
+            self._conn.commit()
+        self.stats["saved"] += 1
+
+    def summary(self):
+        s = self.stats
+        if not self.enabled:
+            return f"♻️ OCR incremental desactivado (OCR_INCREMENTAL=0); estado guardado de {s['saved']} PDFs"
+        return (f"♻️ OCR incremental: {s['unchanged']} PDFs sin cambios salteados "
+                f"({len(self.unchanged_offer_ids)} ofertas marcadas como vigentes), "
+                f"{s['processed']} procesados, estado guardado de {s['saved']}")
@@ -0,0 +1,396 @@
+"""
+Utilidades compartidas para trabajar con la tabla web_offers desde los
+scripts OCR/scraping de cada banco.
+"""
+import os
+from collections import defaultdict
+
+# Filas por executemany al volcar el buffer de inserciones (configurable por entorno)
+INSERT_CHUNK_SIZE = int(os.getenv("WEB_OFFERS_INSERT_CHUNK", "200"))
+# Registros procesados entre commits de la escritura por lotes (lo ya confirmado
+# sobrevive a un corte de la corrida)
+COMMIT_EVERY = max(1, int(os.getenv("WEB_OFFERS_COMMIT_EVERY", "200")))
+# Documentos extraídos entre escrituras en la BD (los scripts no esperan al final de la corrida)
+COMMIT_EVERY_DOCS = max(1, int(os.getenv("WEB_OFFERS_COMMIT_EVERY_DOCS", "20")))
+
+
+def normalize_key(value):
+    """Normaliza un valor para usarlo como clave de índice (sin espacios extremos, casefold)."""
+    if value is None:
+        return ""
+    return str(value).strip().casefold()
+
+
+class OfferIndex:
+    """
+    Índice en memoria de los registros de web_offers de un banco.
+
+    Se carga una sola vez por ejecución (un único SELECT) y se mantiene al día a
+    medida que el upsert inserta o actualiza filas. Cada búsqueda cuesta una
+    consulta a diccionario más un recorrido corto de candidatos, en lugar de
+    releer toda la tabla por cada registro.
+
+    Claves por defecto:
+      - address  → merchant_address normalizado
+      - location → merchant_location normalizado
+      - category → category_name normalizado
+      - name     → merchant_name simplificado (name_key)
+    Se pueden agregar claves propias de cada banco con `extra_keys`.
+    """
+
+    def __init__(self, bank_name, rows=(), normalize=normalize_key, name_key=None, extra_keys=None):
+        self.bank_name = bank_name
+        name_key = name_key or normalize
+        self._key_funcs = {
+            "address": lambda r: normalize(r.get("merchant_address")),
+            "location": lambda r: normalize(r.get("merchant_location")),
+            "category": lambda r: normalize(r.get("category_name")),
+            "name": lambda r: name_key(r.get("merchant_name") or ""),
+        }
+        self._key_funcs.update(extra_keys or {})
+        self._buckets = {k: defaultdict(set) for k in self._key_funcs}
+        self._row_keys = {}   # id -> {clave: valor}
+        self._order = {}      # id -> posición (orden de carga / inserción)
+        self.rows = {}        # id -> fila
+        self._listeners = []  # callbacks(id) ante cada alta o modificación
+
+        for row in rows:
+            self.add(row)
+
+    @classmethod
+    def load(cls, conn, bank_name, **kwargs):
+        """Carga todas las filas del banco con un único SELECT."""
+        cur = conn.cursor(dictionary=True)
+        try:
+            cur.execute("SELECT * FROM web_offers WHERE bank_name=%s", (bank_name,))
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+        return cls(bank_name, rows, **kwargs)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def subscribe(self, callback):
+        """Registra `callback(row_id)`, invocado cada vez que se agrega o modifica una fila."""
+        self._listeners.append(callback)
+
+    def _notify(self, row_id):
+        for callback in self._listeners:
+            callback(row_id)
+
+    def _index_row(self, row_id):
+        row = self.rows[row_id]
+        keys = {name: func(row) for name, func in self._key_funcs.items()}
+        for name, key in keys.items():
+            self._buckets[name][key].add(row_id)
+        self._row_keys[row_id] = keys
+
+    def _unindex_row(self, row_id):
+        for name, key in self._row_keys.pop(row_id, {}).items():
+            bucket = self._buckets[name].get(key)
+            if bucket is not None:
+                bucket.discard(row_id)
+                if not bucket:
+                    del self._buckets[name][key]
+
+    def add(self, row):
+        """Agrega (o reindexa) una fila; debe traer su 'id'."""
+        row_id = row["id"]
+        if row_id in self.rows:
+            self._unindex_row(row_id)
+        else:
+            self._order[row_id] = len(self._order)
+        self.rows[row_id] = row
+        self._index_row(row_id)
+        self._notify(row_id)
+        return row
+
+    def update(self, row_id, changes):
+        """Aplica en memoria los cambios de un UPDATE y reindexa la fila."""
+        row = self.rows.get(row_id)
+        if row is None:
+            return None
+        self._unindex_row(row_id)
+        row.update(changes)
+        self._index_row(row_id)
+        self._notify(row_id)
+        return row
+
+    def discard(self, row_id):
+        """Quita una fila del índice (ej. una inserción en buffer que no llegó a la BD)."""
+        if row_id in self.rows:
+            self._unindex_row(row_id)
+            del self.rows[row_id]
+            del self._order[row_id]
+
+    def rekey(self, mapping):
+        """Reemplaza ids (temporal → definitivo) conservando el orden de carga de las filas."""
+        mapping = {old: new for old, new in mapping.items() if old in self.rows}
+        if not mapping:
+            return
+        for old in mapping:
+            self._unindex_row(old)
+        self.rows = {mapping.get(i, i): row for i, row in self.rows.items()}
+        self._order = {mapping.get(i, i): pos for i, pos in self._order.items()}
+        for new in mapping.values():
+            self.rows[new]["id"] = new
+            self._index_row(new)
+            self._notify(new)
+
+    def get(self, row_id):
+        return self.rows.get(row_id)
+
+    def all(self):
+        """Todas las filas en el orden en que fueron cargadas/insertadas."""
+        return list(self.rows.values())
+
+    def key_for(self, key_name, record):
+        """Calcula la clave `key_name` de un registro con nombres de columna de web_offers."""
+        return self._key_funcs[key_name](record)
+
+    def key_of(self, row, key_name):
+        """Clave ya calculada de una fila indexada (evita volver a normalizarla)."""
+        return self._row_keys[row["id"]][key_name]
+
+    def lookup(self, key_name, key):
+        """Filas cuya clave `key_name` es exactamente `key`, en orden de carga."""
+        ids = self._buckets[key_name].get(key)
+        if not ids:
+            return []
+        return [self.rows[i] for i in sorted(ids, key=self._order.__getitem__)]
+
+    def find(self, key_name, record):
+        """Filas cuya clave `key_name` coincide con la del registro dado."""
+        return self.lookup(key_name, self.key_for(key_name, record))
+
+
+def get_offer_index(conn, bank_name, indices=None, **kwargs):
+    """
+    Devuelve el índice del banco, cargándolo solo la primera vez por ejecución.
+    `indices` es un dict banco → OfferIndex que vive durante toda la corrida;
+    si no se pasa, se carga un índice nuevo (comportamiento anterior).
+    """
+    if indices is None:
+        return OfferIndex.load(conn, bank_name, **kwargs)
+    index = indices.get(bank_name)
+    if index is None:
+        index = indices[bank_name] = OfferIndex.load(conn, bank_name, **kwargs)
+    return index
+
+
+class BatchInserter:
+    """
+    Buffer de inserciones nuevas en web_offers.
+
+    Las filas se acumulan con un id temporal negativo y `commit()` las vuelca con `executemany` (un INSERT multi-fila por
+    bloque de `chunk_size`) dentro de una sola transacción y confirma una vez.
+    Una actualización sobre una fila aún pendiente se aplica sobre el buffer
+    (ver `is_pending`), porque el dict de la fila es el mismo que guarda el índice.
+
+    Tras el volcado se recuperan los ids reales (LAST_INSERT_ID + incremento
+    del auto_increment, consecutivos dentro de un INSERT multi-fila) y se
+    reemplazan en los índices y sets de ids registrados con `track_index` /
+    `track_ids`, para que el control de duplicados de la corrida siga
+    funcionando.
+    """
+
+    def __init__(self, conn, chunk_size=INSERT_CHUNK_SIZE, table="web_offers"):
+        self.conn = conn
+        self.chunk_size = max(1, chunk_size)
+        self.table = table
+        self.inserted = 0
+        self.failed = 0
+        self.flushes = 0
+        self._pending = {}      # id temporal -> fila (mismo dict que guarda el índice)
+        self._next_temp = -1
+        self._increment = None
+        self._indices = []
+        self._id_sets = []
+
+    def track_index(self, index):
+        if not any(index is ix for ix in self._indices):
+            self._indices.append(index)
+
+    def track_ids(self, id_set):
+        if id_set is not None and not any(id_set is s for s in self._id_sets):
+            self._id_sets.append(id_set)
+
+    def is_pending(self, row_id):
+        return row_id in self._pending
+
+    def add(self, row):
+        """Encola una fila (columnas de web_offers) y la devuelve con su id temporal."""
+        row = {"id": self._next_temp, **row}
+        self._pending[self._next_temp] = row
+        self._next_temp -= 1
+        return row
+
+    def _auto_increment_step(self, cur):
+        if self._increment is None:
+            cur.execute("SELECT @@auto_increment_increment")
+            self._increment = int(cur.fetchone()[0] or 1)
+        return self._increment
+
+    def flush(self):
+        """Vuelca el buffer con executemany (sin commit) y devuelve el mapa id temporal → id real."""
+        if not self._pending:
+            return {}
+        pending, self._pending = self._pending, {}
+        remap, failed = {}, []
+        cur = self.conn.cursor()
+        try:
+            # Agrupar por columnas: cada grupo es un INSERT multi-fila
+            groups = defaultdict(list)
+            for temp_id, row in pending.items():
+                groups[tuple(k for k in row if k != "id")].append(temp_id)
+
+            for columns, temp_ids in groups.items():
+                sql = (f"INSERT INTO {self.table} ({', '.join(columns)}) "
+                       f"VALUES ({', '.join(['%s'] * len(columns))})")
+                for start in range(0, len(temp_ids), self.chunk_size):
+                    chunk = temp_ids[start:start + self.chunk_size]
+                    values = [tuple(pending[t][c] for c in columns) for t in chunk]
+                    try:
+                        cur.executemany(sql, values)
+                        first_id = cur.lastrowid
+                        step = self._auto_increment_step(cur)
+                        for offset, temp_id in enumerate(chunk):
+                            remap[temp_id] = first_id + offset * step
+                    except Exception:
+                        # El INSERT multi-fila falla completo: se reintenta fila por fila
+                        for temp_id, row_values in zip(chunk, values):
+                            try:
+                                cur.execute(sql, row_values)
+                                remap[temp_id] = cur.lastrowid
+                            except Exception as e:
+                                print(f"⚠ Error insertando en MySQL: {e}")
+                                failed.append(temp_id)
+        finally:
+            cur.close()
+
+        self.flushes += 1
+        self.inserted += len(remap)
+        self.failed += len(failed)
+        for index in self._indices:
+            for temp_id in failed:
+                index.discard(temp_id)
+            index.rekey(remap)
+        for id_set in self._id_sets:
+            for temp_id in [t for t in id_set if t in remap or t in failed]:
+                id_set.discard(temp_id)
+                if temp_id in remap:
+                    id_set.add(remap[temp_id])
+        return remap
+
+    def commit(self):
+        """Vuelca lo pendiente y confirma la transacción una sola vez."""
+        self.flush()
+        self.conn.commit()
+
+
+class UpdateAccumulator:
+    """
+    Acumula los UPDATE de web_offers (id → columnas cambiadas) y los aplica
+    agrupados, dentro de la misma transacción que las inserciones del bloque.
+
+    Las filas con el mismo conjunto de columnas se actualizan con un único
+    `UPDATE ... SET col = CASE id WHEN ... END ... WHERE id IN (...)` por bloque,
+    en lugar de un UPDATE + commit por fila. Todas reciben además
+    `updated_at=NOW()` y `status='A'`, igual que los UPDATE individuales.
+    """
+
+    def __init__(self, conn, chunk_size=INSERT_CHUNK_SIZE, table="web_offers"):
+        self.conn = conn
+        self.chunk_size = max(1, chunk_size)
+        self.table = table
+        self.updated = 0
+        self.statements = 0
+        self._pending = {}   # id -> {columna: valor}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, row_id, changes, current=None):
+        """Registra los cambios de una fila; con `current` solo se guardan los valores que difieren."""
+        if current is not None:
+            changes = {c: v for c, v in changes.items() if current.get(c) != v}
+        self._pending.setdefault(row_id, {}).update(changes)
+
+    def apply(self):
+        """Ejecuta los UPDATE agrupados (sin commit). Devuelve la cantidad de filas actualizadas."""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+
+        groups = defaultdict(list)
+        for row_id, changes in pending.items():
+            groups[tuple(sorted(changes))].append(row_id)
+
+        cur = self.conn.cursor()
+        try:
+            for columns, ids in groups.items():
+                for start in range(0, len(ids), self.chunk_size):
+                    chunk = ids[start:start + self.chunk_size]
+                    sets, params = [], []
+                    for column in columns:
+                        sets.append(f"{column} = CASE id {' '.join(['WHEN %s THEN %s'] * len(chunk))} END")
+                        for row_id in chunk:
+                            params += [row_id, pending[row_id][column]]
+                    sets += ["updated_at=NOW()", "status='A'"]
+                    sql = (f"UPDATE {self.table} SET {', '.join(sets)} "
+                           f"WHERE id IN ({', '.join(['%s'] * len(chunk))})")
+                    cur.execute(sql, (*params, *chunk))
+                    self.statements += 1
+        finally:
+            cur.close()
+
+        self.updated += len(pending)
+        return len(pending)
+
+
+def commit_pending(conn, inserter=None, updates=None):
+    """Vuelca las inserciones y actualizaciones acumuladas y confirma la transacción."""
+    if inserter is not None:
+        inserter.flush()
+    if updates is not None:
+        updates.apply()
+    conn.commit()
+
+
+def apply_offer_update(conn, cur, row_id, changes, inserter=None, updates=None, current=None):
+    """
+    UPDATE de una oferta (más updated_at=NOW() y status='A').
+    - Si la fila sigue en el buffer del BatchInserter, alcanza con el cambio en memoria.
+    - Si hay UpdateAccumulator, se acumula para aplicarlo en el próximo commit del bloque.
+    - Si no, se ejecuta y confirma en el momento (comportamiento anterior).
+    """
+    if inserter is not None and inserter.is_pending(row_id):
+        return
+    if updates is not None:
+        updates.add(row_id, changes, current)
+        return
+    update_fields = [f"{c}=%s" for c in changes] + ["updated_at=NOW()", "status='A'"]
+    cur.execute(f"UPDATE web_offers SET {', '.join(update_fields)} WHERE id=%s", (*changes.values(), row_id))
+    conn.commit()
+
+
+def touch_offers(conn, ids, chunk_size=INSERT_CHUNK_SIZE, table="web_offers"):
+    """
+    Marca como vigentes (updated_at=NOW(), status='A') las ofertas de los PDFs sin
+    cambios del modo incremental, sin reescribir sus columnas. No hace commit.
+    Devuelve la cantidad de filas afectadas.
+    """
+    ids = sorted({i for i in ids if i is not None and i > 0})
+    step = max(1, chunk_size)
+    touched = 0
+    cur = conn.cursor()
+    try:
+        for start in range(0, len(ids), step):
+            chunk = ids[start:start + step]
+            cur.execute(f"UPDATE {table} SET updated_at=NOW(), status='A' "
+                        f"WHERE id IN ({', '.join(['%s'] * len(chunk))})", tuple(chunk))
+            touched += cur.rowcount
+    finally:
+        cur.close()
+    return touched
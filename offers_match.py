@@ -0,0 +1,114 @@
+"""
+Scoring fuzzy por lotes para el matching de ofertas contra web_offers.
+
+En lugar de llamar a `fuzz.ratio` registro por registro dentro de un bucle de
+Python, se calcula de una vez la matriz de similitudes (consultas × filas del
+banco) con `rapidfuzz.process.cdist` por cada campo, usando todos los núcleos
+(`workers=-1`). Cada banco aplica después sus propias ponderaciones y umbrales
+sobre los vectores resultantes.
+"""
+import weakref
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+
+class BatchScorer:
+    """
+    Motor de scoring por lotes asociado a un OfferIndex.
+
+    - `prime({campo: [consultas]})` calcula la matriz consultas × filas del índice
+      para cada campo (clave del índice) con un único `cdist`.
+    - `scores(campo, consulta, filas)` devuelve el vector de similitudes de una
+      consulta contra las filas dadas, leyendo de la matriz. Las filas agregadas o
+      modificadas después del `prime` (o consultas no precalculadas) se puntúan al
+      vuelo, también con `cdist`.
+
+    `fuzzywuzzy_compat=True` reproduce la semántica de `fuzzywuzzy.fuzz.ratio`:
+    puntajes enteros redondeados y 0 cuando alguno de los textos está vacío.
+    """
+
+    def __init__(self, index, scorer=fuzz.ratio, fuzzywuzzy_compat=False, workers=-1):
+        self.index = index
+        self.scorer = scorer
+        self.fuzzywuzzy_compat = fuzzywuzzy_compat
+        self.workers = workers
+        self._matrices = {}   # campo -> {"queries": {consulta: fila}, "cols": {id: columna}, "matrix": ndarray}
+        self._stale = set()   # ids modificados después del último prime
+        index.subscribe(self._stale.add)
+
+    def _cdist(self, queries, choices):
+        matrix = process.cdist(queries, choices, scorer=self.scorer, dtype=np.float32, workers=self.workers)
+        if self.fuzzywuzzy_compat:
+            matrix = np.rint(matrix)
+            matrix[[not q for q in queries], :] = 0
+            matrix[:, [not c for c in choices]] = 0
+        return matrix
+
+    def prime(self, queries_by_field):
+        """Precalcula, por campo, la matriz de similitud de todas las consultas contra todas las filas."""
+        rows = self.index.all()
+        ids = [row["id"] for row in rows]
+        for field, queries in queries_by_field.items():
+            unique = list(dict.fromkeys(queries))
+            choices = [self.index.key_of(row, field) for row in rows]
+            self._matrices[field] = {
+                "queries": {q: i for i, q in enumerate(unique)},
+                "cols": {row_id: j for j, row_id in enumerate(ids)},
+                "matrix": self._cdist(unique, choices) if unique and choices else None,
+            }
+        self._stale.clear()
+
+    def scores(self, field, query, rows):
+        """Vector de similitud (0-100) de `query` contra la clave `field` de cada fila de `rows`."""
+        if not rows:
+            return np.zeros(0, dtype=np.float32)
+
+        entry = self._matrices.get(field)
+        qi = entry["queries"].get(query) if entry else None
+        if qi is None or entry["matrix"] is None:
+            return self._score_direct(field, query, rows)
+
+        cols = np.fromiter((entry["cols"].get(row["id"], -1) for row in rows), dtype=np.int64, count=len(rows))
+        out = entry["matrix"][qi, np.maximum(cols, 0)]
+        redo = cols < 0
+        if self._stale:
+            redo |= np.fromiter((row["id"] in self._stale for row in rows), dtype=bool, count=len(rows))
+        if redo.any():
+            pos = np.flatnonzero(redo)
+            out[pos] = self._score_direct(field, query, [rows[i] for i in pos])
+        return out
+
+    def _score_direct(self, field, query, rows):
+        choices = [self.index.key_of(row, field) for row in rows]
+        return self._cdist([query], choices)[0]
+
+    def present(self, field, rows):
+        """Máscara booleana: filas cuya clave `field` no está vacía."""
+        return np.fromiter((bool(self.index.key_of(row, field)) for row in rows), dtype=bool, count=len(rows))
+
+
+_SCORERS = weakref.WeakKeyDictionary()
+
+
+def get_batch_scorer(index, **kwargs):
+    """Devuelve el BatchScorer del índice, creándolo la primera vez."""
+    scorer = _SCORERS.get(index)
+    if scorer is None:
+        scorer = _SCORERS[index] = BatchScorer(index, **kwargs)
+    return scorer
+
+
+def best_position(scores, threshold=0):
+    """
+    Posición del mejor puntaje (el primero en caso de empate) si supera estrictamente 0
+    y alcanza `threshold`; None si no hay candidato. Equivale al bucle clásico
+    `if score > best_score: best = ...` partiendo de best_score = 0.
+    """
+    if len(scores) == 0:
+        return None
+    pos = int(np.argmax(scores))
+    best = scores[pos]
+    if best <= 0 or best < threshold:
+        return None
+    return pos
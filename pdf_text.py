@@ -0,0 +1,493 @@
+"""
+Lectura de PDFs de bases y condiciones compartida por los scripts OCR.
+
+`ParsedPdf` abre el archivo una sola vez (pdfplumber) y guarda por página, de forma
+perezosa, el texto, las palabras y las tablas. Todas las pasadas sobre un mismo PDF
+(conteo de páginas, texto completo, texto hasta la sección 5, direcciones) consumen
+el mismo objeto, así cada página se analiza como máximo una vez por corrida.
+
+Además, el texto y las palabras de cada página se guardan en una caché en disco
+(SQLite) direccionada por el SHA-256 del contenido del archivo: un PDF idéntico al
+de la corrida anterior (o al del reintento) no vuelve a pasar por el análisis de
+layout de pdfplumber. La caché expulsa los documentos menos usados recientemente
+cuando supera el tamaño máximo. Configuración por entorno:
+
+- PDF_CACHE_ENABLED   ("1" por defecto; "0" desactiva la caché)
+- PDF_CACHE_PATH      (archivo SQLite, por defecto .cache/pdf_pages.sqlite3)
+- PDF_CACHE_MAX_MB    (tamaño máximo del texto guardado, por defecto 500)
+- PDF_WORKERS         (procesos para extraer páginas en paralelo, por defecto la
+                       cantidad de núcleos; 1 = siempre en serie)
+
+Los PDFs largos (listados de sucursales de varias páginas) se extraen repartiendo
+las páginas entre procesos de un ProcessPoolExecutor compartido; los de 2 páginas
+o menos se extraen en serie, porque el arranque del pool dominaría el tiempo.
+
+Cuando solo se necesita una parte del documento (hasta la sección 5, o los primeros
+N caracteres que se envían a Gemini), `iter_section_text` / `read_section_text`
+recorren las páginas como un generador con marcadores de inicio/fin y presupuesto de
+caracteres: las páginas posteriores (anexos, listados) no llegan a extraerse.
+
+Antes de invocar Camelot (modo lattice, el que usa GNB) se puede consultar
+`ruled_table_pages`: detecta con los objetos vectoriales de pdfplumber (líneas y
+rectángulos) qué páginas tienen una tabla con bordes, sin rasterizar con Ghostscript.
+El resultado por página también queda en la caché. `PDF_TABLE_PRECHECK=0` desactiva
+el filtro (todas las páginas se consideran candidatas).
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pdfplumber
+
+PDF_CACHE_ENABLED = os.getenv("PDF_CACHE_ENABLED", "1") != "0"
+PDF_CACHE_PATH = os.getenv("PDF_CACHE_PATH", os.path.join(".cache", "pdf_pages.sqlite3"))
+PDF_CACHE_MAX_MB = float(os.getenv("PDF_CACHE_MAX_MB", "500"))
+PDF_WORKERS = max(1, int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = 3  # con 2 páginas o menos no conviene levantar el pool
+PDF_TABLE_PRECHECK = os.getenv("PDF_TABLE_PRECHECK", "1") != "0"
+JSON_KINDS = {"words", "ruled"}  # tipos de la caché guardados como JSON (el texto va tal cual)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 del contenido del archivo."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PageCache:
+    """
+    Caché en disco de texto y palabras por página, indexada por el SHA-256 del PDF.
+
+    - `num_pages(sha)` / `put_num_pages(sha, n)`
+    - `get(sha, página, tipo)` / `put(sha, página, tipo, valor)` con tipo "text"
+      (str), "words" (lista de dicts de `extract_words`) o "ruled" (bool, hay tabla
+      con bordes); los dos últimos se guardan como JSON.
+
+    La expulsión es LRU por documento: cuando el total supera `max_mb` se borran
+    completos los PDFs accedidos hace más tiempo. Lleva los contadores `hits` y
+    `misses` (por página) de la corrida.
+    """
+
+    def __init__(self, path=PDF_CACHE_PATH, max_mb=PDF_CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " sha TEXT PRIMARY KEY, num_pages INTEGER, size INTEGER NOT NULL DEFAULT 0,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " sha TEXT NOT NULL, page INTEGER NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (sha, page, kind))"
+        )
+        self._conn.commit()
+
+    def _touch(self, sha, now):
+        self._conn.execute(
+            "INSERT INTO documents (sha, accessed_at) VALUES (?, ?)"
+            " ON CONFLICT(sha) DO UPDATE SET accessed_at = excluded.accessed_at",
+            (sha, now),
+        )
+
+    def num_pages(self, sha):
+        with self._lock:
+            row = self._conn.execute("SELECT num_pages FROM documents WHERE sha = ?", (sha,)).fetchone()
+        return row[0] if row else None
+
+    def put_num_pages(self, sha, num_pages):
+        with self._lock:
+            self._touch(sha, time.time())
+            self._conn.execute("UPDATE documents SET num_pages = ? WHERE sha = ?", (num_pages, sha))
+            self._conn.commit()
+
+    def get(self, sha, page, kind):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM pages WHERE sha = ? AND page = ? AND kind = ?", (sha, page, kind)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(sha, time.time())
+            self._conn.commit()
+        return json.loads(row[0]) if kind in JSON_KINDS else row[0]
+
+    def put(self, sha, page, kind, value):
+        data = json.dumps(value, ensure_ascii=False) if kind in JSON_KINDS else value
+        size = len(data.encode("utf-8"))
+        with self._lock:
+            self._touch(sha, time.time())
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO pages (sha, page, kind, data) VALUES (?, ?, ?, ?)",
+                (sha, page, kind, data),
+            ).rowcount
+            if inserted:
+                self._conn.execute("UPDATE documents SET size = size + ? WHERE sha = ?", (size, sha))
+            self._evict(keep=sha)
+            self._conn.commit()
+
+    def _evict(self, keep):
+        """Borra documentos completos, del menos usado recientemente, hasta volver bajo el máximo."""
+        if self.max_bytes <= 0:
+            return
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for sha, size in self._conn.execute("SELECT sha, size FROM documents ORDER BY accessed_at"):
+            if sha == keep:
+                continue
+            victims.append((sha,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self._conn.executemany("DELETE FROM pages WHERE sha = ?", victims)
+        self._conn.executemany("DELETE FROM documents WHERE sha = ?", victims)
+
+    def stats(self):
+        with self._lock:
+            documents, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "documents": documents, "bytes": total}
+
+
+_PAGE_CACHE = None
+_PAGE_CACHE_LOCK = threading.Lock()
+
+
+def get_page_cache():
+    """Caché de páginas compartida del proceso (None si PDF_CACHE_ENABLED=0)."""
+    global _PAGE_CACHE
+    if not PDF_CACHE_ENABLED:
+        return None
+    with _PAGE_CACHE_LOCK:
+        if _PAGE_CACHE is None:
+            _PAGE_CACHE = PageCache()
+    return _PAGE_CACHE
+
+
+def page_cache_summary():
+    """Resumen de la caché de páginas para el log de fin de corrida."""
+    cache = get_page_cache()
+    if cache is None:
+        return "📄 Caché de páginas PDF desactivada (PDF_CACHE_ENABLED=0)"
+    s = cache.stats()
+    return (f"📄 Caché de páginas PDF: {s['hits']} páginas desde caché, {s['misses']} extraídas, "
+            f"{s['documents']} documentos, {s['bytes'] / (1024 * 1024):.1f} MB")
+
+
+_TABLE_CHECK = {"pages": 0, "ruled": 0, "skipped": 0, "documents_skipped": 0}
+_TABLE_CHECK_LOCK = threading.Lock()
+
+
+def has_ruled_table(page):
+    """
+    ¿La página de pdfplumber tiene una tabla con bordes? Sin trazos vectoriales se
+    descarta al instante; si los hay, `find_tables` con estrategia de líneas confirma
+    que se cruzan formando celdas (lo mismo que busca Camelot lattice).
+    """
+    if not page.edges:
+        return False
+    return bool(page.find_tables({"vertical_strategy": "lines", "horizontal_strategy": "lines"}))
+
+
+def ruled_table_pages(pdf, pages=None):
+    """
+    Índices (base 0) de `pages` (todas por defecto) que tienen una tabla con bordes.
+    Actualiza los contadores del resumen de fin de corrida.
+    """
+    pages = list(range(pdf.num_pages) if pages is None else pages)
+    if not PDF_TABLE_PRECHECK:
+        return pages
+    ruled = [i for i in pages if pdf.page_has_ruled_table(i)]
+    with _TABLE_CHECK_LOCK:
+        _TABLE_CHECK["pages"] += len(pages)
+        _TABLE_CHECK["ruled"] += len(ruled)
+        _TABLE_CHECK["skipped"] += len(pages) - len(ruled)
+        if pages and not ruled:
+            _TABLE_CHECK["documents_skipped"] += 1
+    return ruled
+
+
+def table_check_summary():
+    """Resumen del filtro de tablas previo a Camelot para el log de fin de corrida."""
+    if not PDF_TABLE_PRECHECK:
+        return "📐 Pre-chequeo de tablas desactivado (PDF_TABLE_PRECHECK=0)"
+    with _TABLE_CHECK_LOCK:
+        s = dict(_TABLE_CHECK)
+    return (f"📐 Pre-chequeo de tablas: {s['pages']} páginas revisadas, {s['ruled']} con tabla, "
+            f"{s['skipped']} omitidas en Camelot ({s['documents_skipped']} documentos sin Camelot)")
+
+
+def _extract_text_chunk(path, indices):
+    """Tarea del pool: abre el PDF una vez y extrae el texto de las páginas pedidas."""
+    with pdfplumber.open(path) as pdf:
+        return [pdf.pages[i].extract_text() or "" for i in indices]
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_process_pool():
+    """
+    ProcessPoolExecutor compartido del proceso (se crea la primera vez que hace falta).
+    Se crea desde los hilos de `map_concurrent` (y del log periódico de GNB), así que los
+    procesos se lanzan con "spawn": un fork con hilos activos puede heredar un lock tomado.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+
+def extract_text_parallel(path, indices, workers=PDF_WORKERS):
+    """
+    Extrae el texto de las páginas `indices` repartiéndolas en bloques contiguos entre
+    `workers` procesos. Devuelve {página: texto}; el orden lo reconstruye quien llama.
+    """
+    indices = list(indices)
+    size = -(-len(indices) // workers)
+    chunks = [indices[k:k + size] for k in range(0, len(indices), size)]
+    pool = get_process_pool()
+    futures = [pool.submit(_extract_text_chunk, str(path), chunk) for chunk in chunks]
+    result = {}
+    for chunk, future in zip(chunks, futures):
+        result.update(zip(chunk, future.result()))
+    return result
+
+
+def iter_section_text(pdf, start=None, stop=None):
+    """
+    Genera (página, texto) de la región de `pdf` (ParsedPdf) entre la primera aparición
+    de la regex `start` (inclusive; desde la primera página si es None) y la primera de
+    `stop` posterior (exclusive; hasta el final si es None). Las páginas se extraen a
+    medida que se consumen: cortar la iteración evita extraer el resto del documento.
+    """
+    started = start is None
+    for i, text in pdf.iter_pages_text():
+        pos = 0
+        if not started:
+            match = start.search(text)
+            if not match:
+                continue
+            started = True
+            text, pos = text[match.start():], match.end() - match.start()
+        if stop is not None:
+            match = stop.search(text, pos)
+            if match:
+                yield i, text[:match.start()]
+                return
+        yield i, text
+
+
+def read_section_text(pdf, start=None, stop=None, max_chars=None, sep="\n", clean=None):
+    """
+    Une con `sep` el texto de la región (ver `iter_section_text`) y deja de extraer
+    páginas en cuanto hay al menos `max_chars` caracteres sin contar el espacio inicial;
+    el recorte exacto lo hace quien consume (`texto[:max_chars]`), así el resultado
+    coincide con el de unir todas las páginas y recortar.
+    `clean` (opcional) se aplica a cada página antes de medir; las que quedan vacías se omiten.
+    """
+    parts = []
+    size = 0
+    for _, text in iter_section_text(pdf, start, stop):
+        if clean is not None:
+            text = clean(text)
+            if not text:
+                continue
+        piece = sep + text if parts else text
+        parts.append(text)
+        size = size + len(piece) if size else len(piece.lstrip())
+        if max_chars is not None and size >= max_chars:
+            break
+    return sep.join(parts)
+
+
+def locate_section(pdf, start_pattern, end_pattern=None):
+    """
+    Rango de páginas (base 0, inclusivo) de una sección: desde la página donde aparece
+    `start_pattern` hasta la que contiene `end_pattern` después del inicio (o hasta la
+    última página). None si el inicio no aparece.
+    Trabaja sobre el texto cacheado de `pdf` (ParsedPdf), sin abrir Camelot.
+    """
+    first = None
+    for i, text in enumerate(pdf.pages_text()):
+        if first is None:
+            match = start_pattern.search(text)
+            if not match:
+                continue
+            first = i
+            text = text[match.end():]
+        if end_pattern is not None and end_pattern.search(text):
+            return first, i
+    if first is None:
+        return None
+    return first, pdf.num_pages - 1
+
+
+def camelot_pages(indices):
+    """Índices de página (base 0) en el formato de `camelot.read_pdf(pages=...)` ("1,3-7", base 1)."""
+    spans = []
+    for i in sorted(set(indices)):
+        if spans and spans[-1][1] == i - 1:
+            spans[-1][1] = i
+        else:
+            spans.append([i, i])
+    return ",".join(str(a + 1) if a == b else f"{a + 1}-{b + 1}" for a, b in spans)
+
+
+class ParsedPdf:
+    """
+    PDF abierto una sola vez, con caché perezosa por página.
+
+    - `num_pages`
+    - `page_text(i)`, `page_words(i)`, `page_tables(i)` (i desde 0)
+    - `page_has_ruled_table(i)` si la página tiene una tabla con bordes (ver `has_ruled_table`)
+    - `pages_text()` texto de todas las páginas, en orden (en paralelo si el PDF es largo)
+    - `iter_pages_text()` generador (página, texto) que extrae a medida que se consume
+    - `full_text()` mismo resultado que el clásico
+      `for page in pdf.pages: text += page.extract_text() + "\\n"` (omitiendo páginas vacías)
+
+    El texto y las palabras se buscan primero en la caché en disco (por SHA-256 del
+    archivo); pdfplumber solo abre el archivo si falta alguna página.
+
+    Se usa como context manager (`with ParsedPdf(ruta) as pdf:`) o llamando a `close()`.
+    """
+
+    def __init__(self, path, cache=None):
+        self.path = Path(path)
+        self.name = self.path.name
+        self.cache = cache if cache is not None else get_page_cache()
+        self._sha = None
+        self._num_pages = None
+        self._pdf = None
+        self._text = {}
+        self._words = {}
+        self._tables = {}
+        self._ruled = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+
+    def _document(self):
+        if self._pdf is None:
+            self._pdf = pdfplumber.open(self.path)
+        return self._pdf
+
+    def _page(self, i):
+        return self._document().pages[i]
+
+    @property
+    def sha256(self):
+        if self._sha is None:
+            self._sha = file_sha256(self.path)
+        return self._sha
+
+    @property
+    def num_pages(self):
+        if self._num_pages is None:
+            if self.cache is not None:
+                self._num_pages = self.cache.num_pages(self.sha256)
+            if self._num_pages is None:
+                self._num_pages = len(self._document().pages)
+                if self.cache is not None:
+                    self.cache.put_num_pages(self.sha256, self._num_pages)
+        return self._num_pages
+
+    def _cached(self, store, kind, i, extract):
+        if i not in store:
+            value = self.cache.get(self.sha256, i, kind) if self.cache is not None else None
+            if value is None:
+                self._store(store, kind, i, extract(self._page(i)))
+            else:
+                store[i] = value
+        return store[i]
+
+    def _store(self, store, kind, i, value):
+        store[i] = value
+        if self.cache is not None:
+            self.cache.put(self.sha256, i, kind, value)
+
+    def page_text(self, i):
+        return self._cached(self._text, "text", i, lambda page: page.extract_text() or "")
+
+    def page_words(self, i):
+        return self._cached(self._words, "words", i, lambda page: page.extract_words())
+
+    def page_tables(self, i):
+        if i not in self._tables:
+            self._tables[i] = self._page(i).extract_tables()
+        return self._tables[i]
+
+    def page_has_ruled_table(self, i):
+        return self._cached(self._ruled, "ruled", i, has_ruled_table)
+
+    def pages_text(self):
+        n = self.num_pages
+        if n >= PDF_PARALLEL_MIN_PAGES and PDF_WORKERS > 1:
+            self._prefetch_text(range(n))
+        return [self.page_text(i) for i in range(n)]
+
+    def iter_pages_text(self):
+        n = self.num_pages
+        window = 2 * PDF_WORKERS if n >= PDF_PARALLEL_MIN_PAGES and PDF_WORKERS > 1 else 1
+        for i in range(n):
+            if window > 1 and i % window == 0:
+                self._prefetch_text(range(i, min(i + window, n)))
+            yield i, self.page_text(i)
+
+    def _prefetch_text(self, pages):
+        """Completa en paralelo el texto de las páginas que no están en memoria ni en la caché."""
+        missing = []
+        for i in pages:
+            if i in self._text:
+                continue
+            value = self.cache.get(self.sha256, i, "text") if self.cache is not None else None
+            if value is None:
+                missing.append(i)
+            else:
+                self._text[i] = value
+        if len(missing) < PDF_PARALLEL_MIN_PAGES:
+            for i in missing:
+                self._store(self._text, "text", i, self._page(i).extract_text() or "")
+            return
+        try:
+            extracted = extract_text_parallel(self.path, missing)
+        except Exception as e:
+            # Pool roto o PDF que no se puede abrir en el worker: page_text sigue en serie
+            print(f"⚠ Extracción paralela fallida en {self.name}, se continúa en serie: {e}")
+            return
+        for i in missing:
+            self._store(self._text, "text", i, extracted[i])
+
+    def full_text(self):
+        return "".join(text + "\n" for text in self.pages_text() if text)
@@ -0,0 +1,134 @@
+"""
+Compactación del texto de los PDFs antes de armarlo dentro de los prompts de Gemini.
+
+El texto de pdfplumber trae, además del contenido, el "mobiliario" de cada página
+(encabezados y pies repetidos, números de página), corridas de espacios y líneas de
+texto fijo del banco. Todo eso cuesta tokens de entrada (latencia y cuota) sin aportar
+nada a la extracción. `PromptCompactor` procesa el documento página por página (sirve
+como `clean=` de `pdf_text.read_section_text`) y:
+
+- descarta los números de página (PAGE_NUMBER_RE) y, fuera de las secciones
+  protegidas, las líneas de borde de página (primeras/últimas EDGE_LINES) idénticas
+  (salvo espacios y mayúsculas) a una del borde de una página anterior;
+- colapsa espacios y descarta líneas vacías;
+- descarta las líneas de texto fijo del perfil del banco (`CompactProfile.boilerplate`).
+
+Las secciones protegidas del perfil (VIGENCIA, MECÁNICA, etc.) se copian tal cual: solo
+se les quita el número de página. Los bordes repetidos no se descartan dentro de ellas:
+una fila de una tabla al pie de una página puede parecerse a la de la página anterior. Una sección
+protegida numerada ("2. VIGENCIA") termina en el siguiente encabezado de primer nivel
+con número mayor ("3. ..."), así los listados numerados internos no la cortan; una
+sin número queda protegida hasta el final del documento.
+
+Los caracteres y tokens (estimados) ahorrados se acumulan por proceso y se informan
+con `compaction_summary()`. PROMPT_COMPACT_ENABLED=0 desactiva la compactación.
+"""
+import os
+import re
+import threading
+
+PROMPT_COMPACT_ENABLED = os.getenv("PROMPT_COMPACT_ENABLED", "1") != "0"
+CHARS_PER_TOKEN = 4  # estimación gruesa para texto en español
+EDGE_LINES = 3  # líneas de cada borde de página donde se buscan encabezados/pies repetidos
+
+PAGE_NUMBER_RE = re.compile(r"(?i)^[-–\s]*(p[aá]g(ina)?\.?\s*)?\d{1,3}(\s*(de|/)\s*\d{1,3})?[-–\s]*$")
+HEADING_RE = re.compile(r"^\s*(\d{1,2})\s*[\.\)-]\s*[A-Za-zÁÉÍÓÚÑáéíóúñ]")
+URL_ONLY_RE = re.compile(r"(?i)^\s*(https?://|www\.)\S+\s*$")
+
+_STATS = {"documents": 0, "before": 0, "after": 0}
+_STATS_LOCK = threading.Lock()
+
+
+class CompactProfile:
+    """
+    Configuración de compactación de un banco.
+
+    - `protect`: regex de encabezados de secciones que no se modifican.
+    - `boilerplate`: regex de líneas de texto fijo que se descartan (fuera de secciones protegidas).
+    """
+
+    def __init__(self, protect=(), boilerplate=()):
+        self.protect = [re.compile(p) for p in protect]
+        self.boilerplate = [re.compile(p) for p in boilerplate] + [URL_ONLY_RE]
+
+
+class PromptCompactor:
+    """
+    Compacta un documento página por página (`page(texto)`), recordando los bordes de
+    página ya vistos y si se está dentro de una sección protegida. Una instancia por documento.
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.before = 0
+        self.after = 0
+        self._seen_edges = set()
+        self._protected = None  # None: fuera; 0: protegida hasta el final; n: hasta el encabezado > n
+
+    @staticmethod
+    def _edge_key(line):
+        # Comparación exacta salvo espacios y mayúsculas: con los dígitos enmascarados se
+        # descartaban filas de datos que solo diferían en números (sucursal, km, altura)
+        return re.sub(r"\s+", " ", line.strip().lower())
+
+    def _update_protection(self, line):
+        """Actualiza la sección protegida en curso; True si `line` es un encabezado protegido."""
+        heading = HEADING_RE.match(line)
+        if any(p.search(line) for p in self.profile.protect):
+            self._protected = int(heading.group(1)) if heading else 0
+            return True
+        if self._protected and heading and int(heading.group(1)) > self._protected:
+            self._protected = None
+        return False
+
+    def page(self, text):
+        if not PROMPT_COMPACT_ENABLED:
+            return text
+        lines = text.split("\n")
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        edges = set(filled[:EDGE_LINES] + filled[-EDGE_LINES:])
+        page_edges = set()
+        kept = []
+        for i, line in enumerate(lines):
+            # La protección se evalúa antes de descartar bordes: un encabezado protegido en la
+            # primera o última línea de la página se conserva y abre su sección igual
+            protected_heading = self._update_protection(line)
+            if i in edges and not protected_heading:
+                if PAGE_NUMBER_RE.match(line):
+                    continue
+                key = self._edge_key(line)
+                page_edges.add(key)
+                if key in self._seen_edges and self._protected is None:
+                    continue
+            if self._protected is not None:
+                kept.append(line)
+                continue
+            line = re.sub(r"[ \t\u00a0]+", " ", line).strip()
+            if not line or any(p.search(line) for p in self.profile.boilerplate):
+                continue
+            kept.append(line)
+        self._seen_edges |= page_edges
+        result = "\n".join(kept)
+        self.before += len(text)
+        self.after += len(result)
+        return result
+
+    def record(self):
+        """Suma el documento al resumen de la corrida y devuelve los tokens estimados ahorrados."""
+        with _STATS_LOCK:
+            _STATS["documents"] += 1
+            _STATS["before"] += self.before
+            _STATS["after"] += self.after
+        return (self.before - self.after) // CHARS_PER_TOKEN
+
+
+def compaction_summary():
+    """Resumen de la compactación de prompts para el log de fin de corrida."""
+    if not PROMPT_COMPACT_ENABLED:
+        return "✂️ Compactación de prompts desactivada (PROMPT_COMPACT_ENABLED=0)"
+    with _STATS_LOCK:
+        s = dict(_STATS)
+    saved = s["before"] - s["after"]
+    pct = 100 * saved / s["before"] if s["before"] else 0
+    return (f"✂️ Compactación de prompts: {s['documents']} textos, {s['before']} → {s['after']} caracteres "
+            f"(~{saved // CHARS_PER_TOKEN} tokens ahorrados, {pct:.0f}%)")
@@ -4,6 +4,8 @@ import re
 import csv
 import json
 import html
+import hashlib
+import shutil
 import threading
 import pandas as pd
 import google.generativeai as genai
@@ -17,13 +19,18 @@ from webdriver_manager.chrome import ChromeDriverManager
 import logging
 from datetime import datetime
 from pathlib import Path
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString, Comment
 import requests
 from urllib.parse import urljoin
 import mysql.connector
 import unicodedata
 import math
-from fuzzywuzzy import fuzz
+from offers_db import get_offer_index, BatchInserter, UpdateAccumulator, apply_offer_update
+from offers_match import get_batch_scorer, best_position
+from gemini_client import generate_text, forget_response, cache_summary, rate_limit_summary, map_concurrent, GEMINI_CONCURRENCY
+from selenium_waits import (
+    enable_network_log, snapshot, wait_changed, wait_gone, wait_network_idle, wait_settled, wait_summary,
+)
 
 
 DB_CONFIG = {
@@ -33,8 +40,11 @@ DB_CONFIG = {
     "database" : "best_deal"
 }
 
-def insert_pdf_mysql(conn, record):
-    """Inserta un registro en la tabla 'web_offers', manejando fechas vacías y evitando errores."""
+def insert_pdf_mysql(conn, record, inserter=None):
+    """
+    Inserta un registro en la tabla 'web_offers', manejando fechas vacías y evitando errores.
+    Devuelve la fila insertada (con su id) para mantener al día el índice en memoria.
+    """
     try:
         cur = conn.cursor()
 
@@ -76,40 +86,38 @@ def insert_pdf_mysql(conn, record):
         print("--- FIN DEBUG ---\n")
 
         # --- Ejecutar INSERT ---
-        cur.execute("""
-            INSERT INTO web_offers (
-                valid_to, valid_from, terms_raw, terms_conditions, source_file,
-                source, bank_name, payment_methods, offer_url, offer_day, merchant_name,
-                merchant_logo_url, merchant_logo_downloaded, merchant_location,
-                merchant_address, details, category_name, card_brand, benefit,
-                ai_response, status
-            ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
-            valid_to,
-            valid_from,
-            record.get("terms_raw"),
-            record.get("terms_conditions"),
-            record.get("source_file"),
-            "CSV",  # <-- source fijo
-            record.get("bank_name"),
-            record.get("payment_methods"),
-            record.get("offer_url") or "",
-            record.get("offer_day"),
-            record.get("merchant_name") or "",
-            record.get("merchant_logo_url"),
-            int(record.get("merchant_logo_downloaded", 0) or 0),
-            record.get("merchant_location") or "",
-            record.get("merchant_address") or "",
-            record.get("details"),
-            record.get("category_name"),
-            record.get("card_brand"),
-            record.get("benefic"),
-            record.get("ai_response"),
-            "P" #-- estado 'Pendiente'
-        ))
-
-
+        row = {
+            "valid_to": valid_to,
+            "valid_from": valid_from,
+            "terms_raw": record.get("terms_raw"),
+            "terms_conditions": record.get("terms_conditions"),
+            "source_file": record.get("source_file"),
+            "source": "CSV",  # <-- source fijo
+            "bank_name": record.get("bank_name"),
+            "payment_methods": record.get("payment_methods"),
+            "offer_url": record.get("offer_url") or "",
+            "offer_day": record.get("offer_day"),
+            "merchant_name": record.get("merchant_name") or "",
+            "merchant_logo_url": record.get("merchant_logo_url"),
+            "merchant_logo_downloaded": int(record.get("merchant_logo_downloaded", 0) or 0),
+            "merchant_location": record.get("merchant_location") or "",
+            "merchant_address": record.get("merchant_address") or "",
+            "details": record.get("details"),
+            "category_name": record.get("category_name"),
+            "card_brand": record.get("card_brand"),
+            "benefit": record.get("benefic"),
+            "ai_response": record.get("ai_response"),
+            "status": "P",  # <-- estado 'Pendiente'
+        }
+        if inserter is not None:
+            # Modo por lotes: la fila queda en el buffer con id temporal
+            return inserter.add(row)
+        cur.execute(
+            f"INSERT INTO web_offers ({', '.join(row)}) VALUES ({', '.join(['%s'] * len(row))})",
+            tuple(row.values())
+        )
         conn.commit()
+        return {"id": cur.lastrowid, **row}
 
     except mysql.connector.Error as e:
         print(f"⚠ Error insertando en MySQL: {e}")
@@ -117,10 +125,60 @@ def insert_pdf_mysql(conn, record):
     finally:
         cur.close()
 
-def upsert_offer_mysql(conn, record):
+def normalize_offer_text(value):
+    """Normalización segura para comparar ofertas: sin acentos, guiones unificados y en formato título."""
+    try:
+        if value is None:
+            return ""
+        value = str(value).strip()
+        if value.lower() in ["nan", "none", "null", ""]:
+            return ""
+        value = unicodedata.normalize("NFD", value)
+        value = value.encode("ascii", "ignore").decode("utf-8")
+        value = re.sub(r"[-–]+", "-", value)
+        value = re.sub(r"\s{2,}", " ", value)
+        return value.strip().title()
+    except Exception:
+        return ""
+
+
+def continental_match_keys(record):
+    """Claves normalizadas (name, address, location) con las que se compara un registro."""
+    merchant_name_norm = normalize_offer_text(record.get("merchant_name"))
+    merchant_address_norm = normalize_offer_text(record.get("merchant_address"))
+    merchant_location_norm = normalize_offer_text(record.get("merchant_location"))
+
+    # --- Formato estandarizado ---
+    if merchant_location_norm and not re.search(
+        rf"\b{re.escape(merchant_location_norm)}\b", merchant_name_norm, flags=re.IGNORECASE
+    ):
+        merchant_name_norm = f"{merchant_name_norm} - {merchant_location_norm}"
+    return {"name": merchant_name_norm, "address": merchant_address_norm, "location": merchant_location_norm}
+
+
+def load_continental_index(conn, bank_name, indices=None):
+    """Índice en memoria de web_offers y su motor de scoring por lotes."""
+    index = get_offer_index(conn, bank_name, indices, normalize=normalize_offer_text)
+    return index, get_batch_scorer(index, fuzzywuzzy_compat=True)
+
+
+def prime_continental_scorer(conn, records, indices):
+    """Puntúa de una vez (cdist por campo) todos los registros de la corrida contra la BD."""
+    by_bank = {}
+    for record in records:
+        by_bank.setdefault((str(record.get("bank_name") or "")).strip(), []).append(continental_match_keys(record))
+    for bank_name, keys in by_bank.items():
+        _, scorer = load_continental_index(conn, bank_name, indices)
+        scorer.prime({field: [k[field] for k in keys] for field in ("name", "address", "location")})
+
+
+def upsert_offer_mysql(conn, record, indices=None, inserter=None, updates=None):
     """
     Inserta o actualiza una oferta en MySQL.
     Lógica especial para BANCO CONTINENTAL (fuzzy matching >= 50%).
+    `indices` (dict banco → OfferIndex) evita releer web_offers en cada llamada.
+    `inserter` (BatchInserter) acumula las filas nuevas para insertarlas por lotes y
+    `updates` (UpdateAccumulator) los cambios, que se aplican juntos al final.
     """
     cur = conn.cursor(dictionary=True)
     bank_name = (str(record.get("bank_name") or "")).strip()
@@ -132,110 +190,61 @@ def upsert_offer_mysql(conn, record):
         if re.match(r'^\s*BANCO\s+CONTINENTAL\b', bank_name, flags=re.IGNORECASE):
             log_event("🏦 Iniciando lógica especial para BANCO CONTINENTAL...")
 
-            # --- Normalización segura ---
-            def normalize_text(value):
-                try:
-                    if value is None:
-                        return ""
-                    value = str(value).strip()
-                    if value.lower() in ["nan", "none", "null", ""]:
-                        return ""
-                    value = unicodedata.normalize("NFD", value)
-                    value = value.encode("ascii", "ignore").decode("utf-8")
-                    value = re.sub(r"[-–]+", "-", value)
-                    value = re.sub(r"\s{2,}", " ", value)
-                    return value.strip().title()
-                except Exception:
-                    return ""
-
-            merchant_name_norm = normalize_text(record.get("merchant_name"))
-            merchant_address_norm = normalize_text(record.get("merchant_address"))
-            merchant_location_norm = normalize_text(record.get("merchant_location"))
-
-            # --- Formato estandarizado ---
-            if merchant_location_norm and not re.search(
-                rf"\b{re.escape(merchant_location_norm)}\b", merchant_name_norm, flags=re.IGNORECASE
-            ):
-                merchant_name_norm = f"{merchant_name_norm} - {merchant_location_norm}"
-
-            # --- Buscar registros existentes del banco ---
-            cur.execute("""
-                SELECT id, merchant_name, merchant_address, merchant_location
-                FROM web_offers
-                WHERE bank_name = %s
-            """, (bank_name,))
-            existing = cur.fetchall()
-
-            best_match = None
-            best_score = 0
-
-            for ex in existing:
-                ex_name = normalize_text(ex.get("merchant_name", ""))
-                ex_address = normalize_text(ex.get("merchant_address", ""))
-                ex_location = normalize_text(ex.get("merchant_location", ""))
-
-                score_name = fuzz.ratio(merchant_name_norm, ex_name)
-                score_addr = fuzz.ratio(merchant_address_norm, ex_address)
-                score_loc = fuzz.ratio(merchant_location_norm, ex_location)
+            # --- Normalización segura y formato estandarizado ---
+            keys = continental_match_keys(record)
 
-                # pondera el nombre
-                combined_score = (score_name * 2 + score_addr + score_loc) / 4
+            # --- Registros existentes del banco (índice en memoria, claves ya normalizadas) ---
+            index, scorer = load_continental_index(conn, bank_name, indices)
+            if inserter is not None:
+                inserter.track_index(index)
+            existing = index.all()
 
+            # --- Similitud contra todas las filas a la vez (vectores de cdist) ---
+            score_name = scorer.scores("name", keys["name"], existing)
+            if not keys["address"] and not keys["location"]:
                 # si no hay dirección ni ubicación, solo comparar nombre
-                if not merchant_address_norm and not merchant_location_norm:
-                    combined_score = score_name
+                combined = score_name
+            else:
+                # pondera el nombre
+                score_addr = scorer.scores("address", keys["address"], existing)
+                score_loc = scorer.scores("location", keys["location"], existing)
+                combined = (score_name * 2 + score_addr + score_loc) / 4
 
-                if combined_score > best_score:
-                    best_score = combined_score
-                    best_match = ex
+            pos = best_position(combined)
+            best_match = existing[pos] if pos is not None else None
+            best_score = float(combined[pos]) if pos is not None else 0
 
             # --- Si hay coincidencia fuerte, actualizar ---
             if best_match and best_score >= 50:
                 log_event(f"🟢 Coincidencia {best_score:.1f}% — actualizando ID={best_match['id']}")
 
-                update_fields = []
-                update_values = []
+                changes = {}
 
                 # Solo actualizar si tienen valor
                 for field in ["benefit", "offer_url", "source_file"]:
                     val = record.get(field)
                     if val and str(val).strip().lower() not in ["", "nan", "none", "null"]:
-                        update_fields.append(f"{field}=%s")
-                        update_values.append(str(val).strip())
+                        changes[field] = str(val).strip()
 
                 # Campos base (siempre actualizables)
-                update_fields += [
-                    "payment_methods=%s",
-                    "card_brand=%s",
-                    "offer_day=%s",
-                    "valid_to=%s",
-                    "category_name=%s",
-                    "updated_at=NOW()",
-                    "status='A'"
-                ]
-                update_values += [
-                    str(record.get("payment_methods") or ""),
-                    str(record.get("card_brand") or ""),
-                    str(record.get("offer_day") or ""),
-                    str(record.get("valid_to") or ""),
-                    (record.get("category_name") or record.get("categoria") or "").strip()
-                ]
-
-                sql = f"""
-                    UPDATE web_offers
-                    SET {', '.join(update_fields)}
-                    WHERE id=%s
-                """
-                update_values.append(best_match["id"])
-                cur.execute(sql, tuple(update_values))
-                conn.commit()
+                changes.update({
+                    "payment_methods": str(record.get("payment_methods") or ""),
+                    "card_brand": str(record.get("card_brand") or ""),
+                    "offer_day": str(record.get("offer_day") or ""),
+                    "valid_to": str(record.get("valid_to") or ""),
+                    "category_name": (record.get("category_name") or record.get("categoria") or "").strip(),
+                })
+                apply_offer_update(conn, cur, best_match["id"], changes, inserter, updates, best_match)
+                index.update(best_match["id"], {**changes, "status": "A"})
 
                 log_event(f"✅ BANCO CONTINENTAL actualizado correctamente (ID={best_match['id']})")
                 return
 
             else:
                 log_event(f"🆕 No se encontró coincidencia fuerte (mejor {best_score:.1f}%) — insertando nuevo registro.")
-                insert_pdf_mysql(conn, record)
+                new_row = insert_pdf_mysql(conn, record, inserter)
+                if new_row:
+                    index.add(new_row)
                 return
 
     except mysql.connector.Error as e:
@@ -260,6 +269,7 @@ LOGOS_DIR = "logos_continental"
 os.makedirs(LOGOS_DIR, exist_ok=True)
 
 LOG_FILE = DATA_DIR / "procesamiento_continental.log"
+MODALES_DIR = DATA_DIR / "modales"  # HTML de los modales de cada corrida, por digest
 #RUBROS_OBJETIVO = {
     #"Farmacias y Perfumerías": []
 #}
@@ -303,9 +313,117 @@ def limpiar_para_json(texto: str) -> str:
 
     return texto
 
+
+MODAL_HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+MODAL_SKIP_TAGS = {"script", "style", "img", "svg", "button", "noscript"}
+MODAL_INLINE_TAGS = {"span", "a", "em", "i", "u", "small", "sup", "sub", "font", "label"}
+
+
+def modal_html_to_text(modal_html):
+    """
+    Convierte el HTML del modal en texto compacto para el prompt, conservando solo la
+    estructura que usa Gemini (sin atributos Angular, clases, estilos ni contenedores):
+    - encabezados → "# Título"
+    - <strong>/<b> → "**Asunción**" (etiquetas de ciudad)
+    - <li> → "- Dirección"
+    - párrafos y demás bloques → una línea de texto cada uno
+    """
+    soup = BeautifulSoup(modal_html or "", "html.parser")
+    lines = []
+    buffer = []
+
+    def flush():
+        text = re.sub(r"\s+", " ", " ".join(buffer)).strip()
+        buffer.clear()
+        if text:
+            lines.append(text)
+
+    def walk(node):
+        for child in node.children:
+            if isinstance(child, Comment):
+                continue
+            if isinstance(child, NavigableString):
+                buffer.append(str(child))
+                continue
+            name = child.name
+            if name in MODAL_SKIP_TAGS:
+                continue
+            if name in ("strong", "b"):
+                text = child.get_text(" ", strip=True)
+                if text:
+                    buffer.append(f"**{text}**")
+            elif name == "br":
+                flush()
+            elif name in MODAL_HEADING_TAGS or name == "li":
+                flush()
+                text = re.sub(r"\s+", " ", child.get_text(" ", strip=True))
+                if text:
+                    lines.append(("# " if name in MODAL_HEADING_TAGS else "- ") + text)
+            elif name in MODAL_INLINE_TAGS:
+                walk(child)
+            else:
+                flush()
+                walk(child)
+                flush()
+
+    walk(soup)
+    flush()
+    return "\n".join(lines)
+
+
+MODAL_NG_ATTR_RE = re.compile(r'\s_ng(?:content|host)-[\w-]+(?:="[^"]*")?')
+
+
+def modal_digest(modal_html):
+    """SHA-256 del cuerpo del modal normalizado (sin atributos _ngcontent/_nghost ni diferencias de espacios)."""
+    normalized = MODAL_NG_ATTR_RE.sub("", modal_html)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ModalStore:
+    """
+    HTML de los modales de una corrida guardado en disco, direccionado por `modal_digest`.
+    En memoria solo queda el conjunto de digests, así el consumo no crece con el catálogo.
+
+    - `digest in store` si el modal ya se scrapeó
+    - `put(digest, html)` / `load(digest)`
+    - `clear()` borra el directorio de la corrida
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.digests = set()
+        self.bytes = 0
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def _path(self, digest):
+        return self.directory / f"{digest}.html"
+
+    def put(self, digest, modal_html):
+        if digest in self.digests:
+            return
+        data = modal_html.encode("utf-8")
+        self._path(digest).write_bytes(data)
+        self.digests.add(digest)
+        self.bytes += len(data)
+
+    def load(self, digest):
+        return self._path(digest).read_text(encoding="utf-8")
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
 # --- Gemini ---
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel("gemini-2.5-flash")
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_LOG_LOCK = threading.Lock()
+MODAL_SIZE_STATS = {}  # rubro -> [modales, caracteres HTML, caracteres enviados]
+MODAL_SIZE_LOCK = threading.Lock()
 
 # --- Logging ---
 logging.basicConfig(
@@ -346,6 +464,7 @@ def setup_driver(headless=False):
     options.add_argument("--disable-notifications")
     options.add_argument("--disable-popup-blocking")
     options.add_argument("--start-maximized")
+    enable_network_log(options)  # para esperar a que terminen las peticiones de la SPA
     service = Service(ChromeDriverManager().install())
     return webdriver.Chrome(service=service, options=options)
 
@@ -421,7 +540,7 @@ def close_modal(driver):
     try:
         btn = driver.find_element(By.CSS_SELECTOR, MODAL_CLOSE_BUTTON)
         driver.execute_script("arguments[0].click();", btn)
-        time.sleep(0.5)
+        wait_gone(driver, MODAL_SELECTOR, replaced=0.5)
         return True
     except Exception as e:
         logging.error(f"Error cerrando modal: {e}")
@@ -474,8 +593,16 @@ def process_with_gemini(modal_html, category_name=None, pdf_file=None):
     """Analiza el HTML del modal con Gemini y devuelve una lista de dicts en formato estandarizado.
        Además guarda el resultado en 'procesamiento_continental.log'."""
 
+    # Al prompt va el texto compacto del modal; el HTML se sigue usando abajo para ciudades/direcciones
+    modal_text = modal_html_to_text(modal_html)
+    with MODAL_SIZE_LOCK:
+        stats = MODAL_SIZE_STATS.setdefault(category_name or "", [0, 0, 0])
+        stats[0] += 1
+        stats[1] += len(modal_html or "")
+        stats[2] += len(modal_text)
+
     prompt = f"""
-    Analiza el siguiente HTML de un comercio adherido del Banco Continental y devuelve un JSON
+    Analiza el siguiente contenido del modal de un comercio adherido del Banco Continental y devuelve un JSON
     con el siguiente formato EXACTO (usa los mismos nombres de campo y estructura):
 
     [
@@ -505,7 +632,7 @@ def process_with_gemini(modal_html, category_name=None, pdf_file=None):
     - Si no hay ciudad o location, entonces dejar solo el nombre del comercio.
     - Si el texto contiene varios beneficios (por ejemplo: '20% los miércoles y 6 cuotas todos los días'),
       separa cada uno en un objeto JSON distinto solo si son días o sucursales distintas.
-    - Si el HTML contiene múltiples direcciones o localidades, genera un registro por cada dirección y ciudad.
+    - Si el contenido tiene múltiples direcciones o localidades, genera un registro por cada dirección y ciudad.
     - Identifica y lista todas las marcas de tarjetas mencionadas (Clásica, Oro, Black, Infinite, Privilege, Mastercard).
     - Excluye marcas en frases como 'No participan las tarjetas Pre-Pagas, Gourmet Card ni Cabal'.
     - Ejemplos de NO ciudades: medicamentos, productos no medicinales, descuentos, promociones
@@ -514,8 +641,8 @@ def process_with_gemini(modal_html, category_name=None, pdf_file=None):
 
     Devuelve SOLO JSON válido, sin explicaciones ni texto adicional.
 
-    HTML:
-    {modal_html}
+    CONTENIDO DEL MODAL (las etiquetas de ciudad van entre ** y cada dirección en una línea con "- "):
+    {modal_text}
     """
 
     def detectar_card_brands(texto):
@@ -592,8 +719,7 @@ def process_with_gemini(modal_html, category_name=None, pdf_file=None):
 
 
     try:
-        response = model.generate_content(prompt)
-        text = response.text.strip()
+        text = generate_text(GEMINI_MODEL, prompt).strip()
         json_clean = (
             text.replace("```json", "")
                 .replace("```", "")
@@ -629,6 +755,7 @@ def process_with_gemini(modal_html, category_name=None, pdf_file=None):
             except Exception as e2:
                 log_event(f"🔎 Texto recibido (inicio): {json_clean[:400]}")
                 log_event(f"❌ No se pudo reparar el JSON: {e2}")
+                forget_response(GEMINI_MODEL, prompt)  # no reutilizar una respuesta inservible
                 return []
 
         enriched = []
@@ -751,8 +878,8 @@ def process_with_gemini(modal_html, category_name=None, pdf_file=None):
 
             enriched = list(agrupados.values())
 
-        # Guardar log
-        with open("procesamiento_continental.log", "a", encoding="utf-8") as log:
+        # Guardar log (con lock: varios modales se procesan en paralelo)
+        with GEMINI_LOG_LOCK, open("procesamiento_continental.log", "a", encoding="utf-8") as log:
             json.dump(enriched, log, ensure_ascii=False, indent=2)
             log.write(",\n")
 
@@ -803,112 +930,145 @@ def main():
 
     resultados = []
     total_scrapeados = 0
+    # Identidad de cada modal por digest; el HTML queda en disco hasta terminar la corrida
+    modal_store = ModalStore(MODALES_DIR / datetime.now().strftime("%Y%m%d_%H%M%S"))
+    try:
+        modales_duplicados = 0
 
-    # --- Iterar solo los rubros filtrados ---
-    for idx_rubro, rubro_elem in enumerate(rubros_filtrados):
-        rubro_text = safe_text(rubro_elem)
-        log_event(f"▶️ Procesando rubro [{idx_rubro + 1}]: {rubro_text}")
-        try:
-            driver.execute_script("arguments[0].click();", rubro_elem)
-            time.sleep(1.5)
+        # --- Iterar solo los rubros filtrados ---
+        for idx_rubro, rubro_elem in enumerate(rubros_filtrados):
+            rubro_text = safe_text(rubro_elem)
+            log_event(f"▶️ Procesando rubro [{idx_rubro + 1}]: {rubro_text}")
+            try:
+                driver.execute_script("arguments[0].click();", rubro_elem)
+                # El listado del rubro llega por XHR: red inactiva y lista estable
+                wait_network_idle(driver, replaced=1.5)
+                wait_settled(driver, COMERCIO_SELECTOR)
 
-            pagina_actual = 1
-            comercios_scrapeados_rubro = 0
+                pagina_actual = 1
+                comercios_scrapeados_rubro = 0
 
-            while True:
-                comercios = driver.find_elements(By.CSS_SELECTOR, COMERCIO_SELECTOR)
-                for idx, com_elem in enumerate(comercios, start=1):
-                    try:
-                        driver.execute_script("arguments[0].style.border='3px solid red'", com_elem)
-                        driver.execute_script("arguments[0].click();", com_elem)
-                        time.sleep(2)
+                while True:
+                    comercios = driver.find_elements(By.CSS_SELECTOR, COMERCIO_SELECTOR)
+                    for idx, com_elem in enumerate(comercios, start=1):
+                        try:
+                            driver.execute_script("arguments[0].style.border='3px solid red'", com_elem)
+                            driver.execute_script("arguments[0].click();", com_elem)
+                            wait_settled(driver, f"{MODAL_SELECTOR} {MODAL_BODY_SELECTOR}", visible=True, replaced=2)
 
-                        modal_html = extract_modal_info(driver)
+                            modal_html = extract_modal_info(driver)
 
-                        if not modal_html:
-                            close_modal(driver)
-                            driver.execute_script("arguments[0].style.border=''", com_elem)
-                            continue
+                            if not modal_html:
+                                close_modal(driver)
+                                driver.execute_script("arguments[0].style.border=''", com_elem)
+                                continue
                         
-                        if any(modal_html == r["modal_html"] for r in resultados):
+                            modal_sha = modal_digest(modal_html)
+                            if modal_sha in modal_store:
+                                modales_duplicados += 1
+                                close_modal(driver)
+                                driver.execute_script("arguments[0].style.border=''", com_elem)
+                                continue
+
+                            # --- Extraer logo ---
+                            logo_url = ""
+                            logo_path = ""
+                            try:
+                                img_elem = com_elem.find_element(By.TAG_NAME, "img")
+                                logo_url = img_elem.get_attribute("src")
+                                if logo_url and logo_url.startswith("/"):
+                                    from urllib.parse import urljoin
+                                    logo_url = urljoin(URL, logo_url)
+
+                                nombre_comercio = safe_text(com_elem)
+                                filename = safe_filename(nombre_comercio) + os.path.splitext(logo_url)[1]
+                                local_path = os.path.join(LOGOS_DIR, filename)
+
+                                if logo_url:
+                                    r = requests.get(logo_url, timeout=10)
+                                    if r.status_code == 200:
+                                        with open(local_path, "wb") as f:
+                                            f.write(r.content)
+                                        logo_path = local_path
+                            except Exception as e:
+                                logging.warning(f"No se pudo extraer o descargar logo de '{nombre_comercio}': {e}")
+                                logo_url = ""
+                                logo_path = ""
+
                             close_modal(driver)
                             driver.execute_script("arguments[0].style.border=''", com_elem)
-                            continue
 
-                        # --- Extraer logo ---
-                        logo_url = ""
-                        logo_path = ""
-                        try:
-                            img_elem = com_elem.find_element(By.TAG_NAME, "img")
-                            logo_url = img_elem.get_attribute("src")
-                            if logo_url and logo_url.startswith("/"):
-                                from urllib.parse import urljoin
-                                logo_url = urljoin(URL, logo_url)
-
-                            nombre_comercio = safe_text(com_elem)
-                            filename = safe_filename(nombre_comercio) + os.path.splitext(logo_url)[1]
-                            local_path = os.path.join(LOGOS_DIR, filename)
-
-                            if logo_url:
-                                r = requests.get(logo_url, timeout=10)
-                                if r.status_code == 200:
-                                    with open(local_path, "wb") as f:
-                                        f.write(r.content)
-                                    logo_path = local_path
+                            modal_store.put(modal_sha, modal_html)
+                            resultados.append({
+                                "rubro": rubro_text,
+                                "modal_sha": modal_sha,
+                                "logo_url": logo_url or "",
+                                "logo_path": logo_path or ""
+                            })
+                            comercios_scrapeados_rubro += 1
+                            total_scrapeados += 1
+
                         except Exception as e:
-                            logging.warning(f"No se pudo extraer o descargar logo de '{nombre_comercio}': {e}")
-                            logo_url = ""
-                            logo_path = ""
+                            logging.error(f"Error procesando comercio {idx} ({rubro_text}): {e}")
+                            continue
 
-                        close_modal(driver)
-                        driver.execute_script("arguments[0].style.border=''", com_elem)
-
-                        resultados.append({
-                            "rubro": rubro_text,
-                            "modal_html": modal_html,
-                            "logo_url": logo_url or "",
-                            "logo_path": logo_path or ""
-                        })
-                        comercios_scrapeados_rubro += 1
-                        total_scrapeados += 1
-
-                    except Exception as e:
-                        logging.error(f"Error procesando comercio {idx} ({rubro_text}): {e}")
-                        continue
-
-                # --- Avanzar página ---
-                try:
-                    siguiente_btn = driver.find_element(By.CSS_SELECTOR, "li.page-item a[aria-label='Next']")
-                    parent_li = siguiente_btn.find_element(By.XPATH, "./parent::li")
-                    if "disabled" in parent_li.get_attribute("class").lower():
+                    # --- Avanzar página ---
+                    try:
+                        siguiente_btn = driver.find_element(By.CSS_SELECTOR, "li.page-item a[aria-label='Next']")
+                        parent_li = siguiente_btn.find_element(By.XPATH, "./parent::li")
+                        if "disabled" in parent_li.get_attribute("class").lower():
+                            break
+                        antes = snapshot(driver, COMERCIO_SELECTOR)
+                        driver.execute_script("arguments[0].click();", siguiente_btn)
+                        wait_changed(driver, COMERCIO_SELECTOR, antes, replaced=2)
+                        wait_settled(driver, COMERCIO_SELECTOR)
+                        pagina_actual += 1
+                    except Exception:
                         break
-                    driver.execute_script("arguments[0].click();", siguiente_btn)
-                    time.sleep(2)
-                    pagina_actual += 1
-                except Exception:
-                    break
 
-        except Exception as e:
-            logging.error(f"Error procesando rubro {rubro_text}: {e}")
-            continue
+            except Exception as e:
+                logging.error(f"Error procesando rubro {rubro_text}: {e}")
+                continue
 
-    # --- Guardar CSV intermedio ---
-    keys = ["rubro", "modal_html", "logo_url", "logo_path"]
-    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=keys)
-        writer.writeheader()
-        writer.writerows(resultados)
-    log_event(f"📄 CSV intermedio generado ({len(resultados)} comercios)")
-
-    # --- Procesar con Gemini ---
-    print("\n🤖 Procesando con Gemini...")
-    processed = []
-    total_beneficios = 0
-    unique_merchants = set()  # Evitar duplicados por merchant_name + location
-
-    for row in resultados:
-        modal_html_clean = limpiar_para_json(row["modal_html"])
-        data = process_with_gemini(modal_html_clean, category_name=row["rubro"])
+        # --- Guardar CSV intermedio ---
+        keys = ["rubro", "modal_html", "logo_url", "logo_path"]
+        with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=keys)
+            writer.writeheader()
+            for row in resultados:
+                writer.writerow({
+                    "rubro": row["rubro"],
+                    "modal_html": modal_store.load(row["modal_sha"]),
+                    "logo_url": row["logo_url"],
+                    "logo_path": row["logo_path"],
+                })
+        log_event(f"📄 CSV intermedio generado ({len(resultados)} comercios)")
+        log_event(wait_summary())
+        log_event(f"🗂️ Modales únicos: {len(modal_store.digests)} ({modal_store.bytes / (1024 * 1024):.1f} MB en disco), "
+                  f"{modales_duplicados} duplicados omitidos")
+
+        # --- Procesar con Gemini ---
+        print("\n🤖 Procesando con Gemini...")
+        processed = []
+        total_beneficios = 0
+        unique_merchants = set()  # Evitar duplicados por merchant_name + location
+
+        # Varios modales en vuelo a la vez (GEMINI_CONCURRENCY), respetando el límite por minuto;
+        # las respuestas se consumen en el mismo orden en que se scrapearon
+        log_event(f"🤖 Enviando {len(resultados)} comercios a Gemini ({GEMINI_CONCURRENCY} en paralelo)")
+        respuestas = map_concurrent(
+            lambda row: process_with_gemini(limpiar_para_json(modal_store.load(row["modal_sha"])), category_name=row["rubro"]),
+            resultados,
+        )
+    finally:
+        # El directorio de la corrida se borra también si el scraping, el CSV o Gemini se cortan
+        modal_store.clear()
+
+    for rubro, (modales, html_chars, text_chars) in MODAL_SIZE_STATS.items():
+        reduccion = html_chars / text_chars if text_chars else 0
+        log_event(f"📉 Rubro {rubro}: {modales} modales, {html_chars} → {text_chars} caracteres enviados a Gemini ({reduccion:.1f}x menos)")
+
+    for row, data in zip(resultados, respuestas):
         # Si la respuesta es un string JSON, intentar parsearla
 
         if isinstance(data, str):
@@ -989,9 +1149,11 @@ def main():
         try:
             conn = mysql.connector.connect(**DB_CONFIG)
             log_event("✅ Conexión a la base de datos establecida correctamente.")
+            indices = {}  # Índice en memoria de web_offers, se carga una sola vez
 
+            records = []
             for entry in processed:
-                record = {
+                records.append({
                     "valid_to": entry.get("valid_to", ""),
                     "valid_from": entry.get("valid_from", ""),
                     "terms_raw": entry.get("terms_raw", ""),
@@ -1011,9 +1173,21 @@ def main():
                     "card_brand": entry.get("card_brand", ""),
                     "benefic": entry.get("benefit", ""),
                     "ai_response": json.dumps(entry, ensure_ascii=False)
-                }
-
-                upsert_offer_mysql(conn, record)
+                })
+
+            # Matriz de similitudes de toda la corrida en una sola pasada
+            prime_continental_scorer(conn, records, indices)
+            # Filas nuevas y cambios se acumulan y se escriben al final en una sola transacción
+            inserter = BatchInserter(conn)
+            updates = UpdateAccumulator(conn)
+            for record in records:
+                upsert_offer_mysql(conn, record, indices, inserter, updates)
+            inserter.flush()
+            updates.apply()
+            conn.commit()
+            log_event(f"💾 Inserción por lotes: {inserter.inserted} registros nuevos "
+                      f"(bloques de {inserter.chunk_size}, {inserter.failed} con error)")
+            log_event(f"💾 Actualización por lotes: {updates.updated} registros en {updates.statements} sentencias")
 
             log_event("💾 Todos los registros fueron insertados en la base de datos correctamente.")
         except Exception as e:
@@ -1024,6 +1198,8 @@ def main():
                 log_event("🔒 Conexión MySQL cerrada correctamente.")
 
 
+    log_event(cache_summary())
+    log_event(rate_limit_summary())
     procesando_activo = False
     driver.quit()
     log_event("🏁 Proceso finalizado correctamente. Navegador cerrado.")
@@ -1,6 +1,5 @@
 import os
 import time
-import requests
 import csv
 import subprocess  # ✅ Agregado para ejecutar el siguiente script
 from selenium import webdriver
@@ -10,12 +9,19 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager  # ✅ Cambiado a Chrome
+from downloads import DownloadQueue, get_download_manifest
+from selenium_waits import snapshot, wait_changed, wait_settled, wait_summary
 
 # Globales para consolidado
 registros_globales = []
 urls_descargadas = set()
 global_pdfs = []
 global_logos = []
+cola_descargas = None  # DownloadQueue: los PDFs se descargan en segundo plano mientras el navegador avanza
+
+# Selectores CSS de la lista de promociones (para las esperas por condición)
+ITEM_CSS = "div[role='listitem'].collection-item"
+NEXT_CSS = "a[class*='next']"
 
 # Verificar que se halla cargado la GEMINI_API_KEY en las variables de entorno
 
@@ -25,7 +31,7 @@ def gemini_api_key_cargada():
 
 def descargar_archivos_categoria(driver, categoria, comercios_permitidos=None):
 
-    global global_pdfs, global_logos, registros_globales, urls_descargadas
+    global global_pdfs, global_logos, registros_globales, urls_descargadas, cola_descargas
 
     print(f"\n=== Procesando categoría: {categoria} ===")
 
@@ -55,7 +61,7 @@ def descargar_archivos_categoria(driver, categoria, comercios_permitidos=None):
         except TimeoutException:
             print(f"⚠ Timeout: no se cargaron elementos para {categoria}")
             driver.execute_script("arguments[0].click();", label)  
-            time.sleep(1)
+            wait_settled(driver, ITEM_CSS, visible=True, replaced=1)
             return
 
         no_items = [el for el in driver.find_elements(By.XPATH, 
@@ -64,10 +70,11 @@ def descargar_archivos_categoria(driver, categoria, comercios_permitidos=None):
         if no_items:
             print(f"⚠ No hay elementos en {categoria}.")
             driver.execute_script("arguments[0].click();", label)  
-            time.sleep(1)
+            wait_settled(driver, ITEM_CSS, visible=True, replaced=1)
             return
 
-        time.sleep(1)
+        # El filtro se aplica con JS: esperar a que la lista visible deje de cambiar
+        wait_settled(driver, ITEM_CSS, visible=True, replaced=1)
 
     except Exception as e:
         print(f"⚠ No se pudo activar {categoria}: {e}")
@@ -139,10 +146,7 @@ def descargar_archivos_categoria(driver, categoria, comercios_permitidos=None):
                 filepath = os.path.join(pdf_folder, filename)
 
                 if pdf_url not in urls_descargadas:
-                    if not os.path.exists(filepath):
-                        resp = requests.get(pdf_url, timeout=10)
-                        with open(filepath, "wb") as f:
-                            f.write(resp.content)
+                    cola_descargas.submit(pdf_url, filepath)  # no bloquea: se descarga en el pool
                     urls_descargadas.add(pdf_url)
 
                 pdf_nombre = filename
@@ -185,15 +189,18 @@ def descargar_archivos_categoria(driver, categoria, comercios_permitidos=None):
             next_btn = driver.find_element(By.XPATH, "//a[contains(@class,'next')]")
             if "disabled" in next_btn.get_attribute("class"):
                 break
+            antes = snapshot(driver, f"{ITEM_CSS}, {NEXT_CSS}", visible=True)
             driver.execute_script("arguments[0].click();", next_btn)
             pagina += 1
-            time.sleep(2)
+            # Página nueva: cambian los items visibles y el estado del botón `next`
+            wait_changed(driver, f"{ITEM_CSS}, {NEXT_CSS}", antes, visible=True, replaced=2)
+            wait_settled(driver, ITEM_CSS, visible=True)
         except NoSuchElementException:
             break
 
     try:
         driver.execute_script("arguments[0].click();", label)
-        time.sleep(1)
+        wait_settled(driver, ITEM_CSS, visible=True, replaced=1)
     except:
         pass
 
@@ -207,7 +214,7 @@ def descargar_archivos_categoria(driver, categoria, comercios_permitidos=None):
         writer.writeheader()
         writer.writerows(lista_logos)
 
-    print(f"📦 PDFs descargados en {categoria}: {len(lista_pdfs)}")
+    print(f"📦 PDFs encolados para descarga en {categoria}: {len(lista_pdfs)}")
     print(f"📦 Logos registrados en {categoria}: {len(lista_logos)}")
 
 def main():
@@ -218,7 +225,8 @@ def main():
         print(f"export GEMINI_API_KEY=......")
         return 
 
-    global global_pdfs, global_logos
+    global global_pdfs, global_logos, cola_descargas
+    cola_descargas = DownloadQueue(manifest=get_download_manifest())  # GET condicional: los PDFs sin cambios cuestan un 304
     # ✅ CAMBIO: usar Chrome en lugar de Firefox
     options = webdriver.ChromeOptions()
     # options.add_argument("--headless")  # opcional si no quieres ver la ventana
@@ -255,6 +263,11 @@ def main():
 
 
     driver.quit()
+    print(wait_summary())
+
+    # Esperar las descargas pendientes antes de consolidar y pasar al OCR
+    cola_descargas.wait()
+    print(cola_descargas.summary())
 
     # ✅ Consolidado global PDFs
     if global_pdfs:
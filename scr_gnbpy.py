@@ -1,8 +1,11 @@
 import os
 import time
-import requests
 import csv
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests
+from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
@@ -10,12 +13,22 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from webdriver_manager.chrome import ChromeDriverManager
+from downloads import download_pdf, make_session
+from selenium_waits import wait_ready, wait_settled, wait_summary
 
 # ===============================
 # CONFIGURACIÓN
 # ===============================
 BASE_URL = "https://www.beneficiosbancognb.com.py"
 OUTPUT_DIR = "data_gnbpy"
+OFERTA_SELECTOR = "div.item"  # contenedores de ofertas de la página de una etiqueta
+PDF_LINK_TEXT = "bases y condiciones"
+# "selenium" (por defecto): todo con el navegador, como antes. "http": el listado de cada
+# etiqueta se sigue leyendo con el navegador (la etiqueta filtra las ofertas con JS) y las
+# páginas de oferta con requests + BeautifulSoup (Selenium solo si el HTML no se puede interpretar)
+SCRAPE_MODE = os.getenv("GNB_SCRAPE_MODE", "selenium")
+HTTP_WORKERS = max(1, int(os.getenv("GNB_HTTP_WORKERS", "6")))  # páginas de oferta en paralelo
+HTTP_TIMEOUT = 20
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 CSV_FILE = os.path.join(OUTPUT_DIR, "beneficios.csv")
@@ -24,27 +37,32 @@ if not os.path.exists(CSV_FILE):
         writer = csv.writer(f)
         writer.writerow(["Categoria", "Titulo", "Descripcion", "Porcentaje", "Link Beneficio", "Link PDF", "Ruta PDF"])
 
+# Ofertas leídas por HTTP y con el navegador (respaldo o modo selenium)
+STATS = {"http": 0, "selenium": 0}
+
 # ===============================
-# INICIAR NAVEGADOR
+# NAVEGADOR (se inicia recién cuando hace falta)
 # ===============================
-print("🚀 Iniciando navegador Google Chrome...")
-options = webdriver.ChromeOptions()
+driver = None
+wait = None
 
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-# Maximizar ventana al iniciar
-options.add_argument("--start-maximized")
 
-service = Service(ChromeDriverManager().install())
-driver = webdriver.Chrome(service=service, options=options)
-wait = WebDriverWait(driver, 15)
+def get_driver():
+    """Inicia Google Chrome la primera vez que se necesita y lo reutiliza."""
+    global driver, wait
+    if driver is None:
+        print("🚀 Iniciando navegador Google Chrome...")
+        options = webdriver.ChromeOptions()
 
-def animar(texto, duracion=2):
-    print(texto, end="", flush=True)
-    for _ in range(duracion * 2):
-        print(".", end="", flush=True)
-        time.sleep(0.5)
-    print(" ✅")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        # Maximizar ventana al iniciar
+        options.add_argument("--start-maximized")
+
+        service = Service(ChromeDriverManager().install())
+        driver = webdriver.Chrome(service=service, options=options)
+        wait = WebDriverWait(driver, 15)
+    return driver
 
 def descargar_pdf(pdf_url, categoria_nombre):
     """Descarga el PDF dentro de una subcarpeta según su categoría"""
@@ -57,24 +75,188 @@ def descargar_pdf(pdf_url, categoria_nombre):
     nombre_pdf = pdf_url.split("/")[-1]
     ruta_pdf = os.path.join(carpeta_categoria, nombre_pdf)
 
-    # Descargar PDF
-    response = requests.get(pdf_url, stream=True)
-    response.raise_for_status()
-    with open(ruta_pdf, "wb") as f:
-        for chunk in response.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-
-    print(f"✅ PDF guardado en: {ruta_pdf}")
+    # Descargar PDF (GET condicional: si no cambió desde la última corrida el servidor responde 304)
+    estado = download_pdf(pdf_url, ruta_pdf)
+
+    print(f"✅ PDF guardado en: {ruta_pdf} ({estado})")
     return ruta_pdf
 
-def procesar_ofertas(categoria_url, categoria_nombre):
-    """Procesa todas las ofertas visibles de una categoría/etiqueta"""
+def guardar_registro(fila):
+    """Agrega una oferta al CSV: [categoría, título, descripción, porcentaje, link, link PDF, ruta PDF]."""
+    with open(CSV_FILE, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(fila)
+
+# ===============================
+# MODO HTTP (requests + BeautifulSoup)
+# ===============================
+def parse_etiquetas_html(html, page_url, categorias):
+    """{categoría: URL de su etiqueta} a partir de los enlaces cuyo texto es el nombre de la categoría."""
+    soup = BeautifulSoup(html, "html.parser")
+    enlaces = {}
+    for a in soup.find_all("a", href=True):
+        texto = a.get_text(strip=True)
+        if texto in categorias and texto not in enlaces:
+            enlaces[texto] = urljoin(page_url, a["href"])
+    return enlaces
+
+def parse_listado_html(html, page_url):
+    """
+    Links de las ofertas del HTML estático de una etiqueta (se omiten los `div.item` con
+    display:none en línea). No refleja el filtro que aplica el JS de la página: solo se usa
+    para comparar con el listado del navegador.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    links = []
+    for item in soup.select(OFERTA_SELECTOR):
+        estilo = (item.get("style") or "").replace(" ", "").lower()
+        if "display:none" in estilo:
+            continue
+        boton = item.select_one("a.button.expand[href]")
+        if boton:
+            links.append(urljoin(page_url, boton["href"]))
+    return links
+
+def parse_oferta_html(html, page_url, idx):
+    """
+    Campos de la página de una oferta: primer h2, primer p, `.circulo` y el enlace a las
+    bases y condiciones. None si falta el título o el enlace (el llamador usa Selenium).
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    titulo = soup.find("h2")
+    enlace_pdf = next((a for a in soup.find_all("a", href=True)
+                       if PDF_LINK_TEXT in a.get_text(" ", strip=True).lower()), None)
+    if not titulo or not enlace_pdf:
+        return None
+    descripcion = soup.find("p")
+    porcentaje = soup.select_one(".circulo")
+    return {
+        "titulo": titulo.get_text(" ", strip=True) or f"Oferta_{idx}",
+        "descripcion": descripcion.get_text(" ", strip=True) if descripcion else "",
+        "porcentaje": porcentaje.get_text(" ", strip=True) if porcentaje else "N/A",
+        "pdf_url": urljoin(page_url, enlace_pdf["href"]),
+    }
+
+def obtener_oferta_http(session, idx, link_oferta, categoria_nombre):
+    """Lee una oferta por HTTP y descarga su PDF. Devuelve la fila del CSV, o None si el HTML no se pudo interpretar."""
+    try:
+        resp = session.get(link_oferta, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        print(f"⚠️ No se pudo leer la oferta {idx} por HTTP: {e}")
+        return None
+    oferta = parse_oferta_html(resp.text, resp.url, idx)
+    if oferta is None:
+        return None
+
+    try:
+        ruta_pdf = descargar_pdf(oferta["pdf_url"], categoria_nombre)
+    except (requests.RequestException, OSError) as e:
+        print(f"⚠️ No se pudo descargar el PDF de {oferta['titulo']}: {e}")
+        ruta_pdf = None
+    return [categoria_nombre, oferta["titulo"], oferta["descripcion"], oferta["porcentaje"],
+            link_oferta, oferta["pdf_url"], ruta_pdf]
+
+def comparar_listado_http(session, categoria_url, categoria_nombre, ofertas):
+    """Registra si el listado del HTML estático coincide con el del navegador (para validar el modo HTTP)."""
+    try:
+        resp = session.get(categoria_url, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        print(f"⚠️ No se pudo leer el listado de {categoria_nombre} por HTTP: {e}")
+        return
+    estaticas = set(parse_listado_html(resp.text, resp.url))
+    if estaticas == set(ofertas):
+        print(f"⚖️ {categoria_nombre}: el HTML estático lista las mismas {len(ofertas)} ofertas que el navegador")
+    else:
+        print(f"⚖️ {categoria_nombre}: el HTML estático difiere del navegador "
+              f"({len(estaticas - set(ofertas))} de más, {len(set(ofertas) - estaticas)} de menos)")
+
+def procesar_ofertas_http(session, categoria_url, categoria_nombre):
+    """
+    Modo HTTP: el listado visible de la etiqueta sale del navegador (el filtro por
+    categoría lo aplica el JS de la página) y las páginas de oferta se leen en paralelo
+    (HTTP_WORKERS) con la Session compartida. Las ofertas cuyo HTML no se pudo
+    interpretar se leen con Selenium.
+    """
+    ofertas = listar_ofertas_selenium(categoria_url)
+    print(f"🔍 Se encontraron {len(ofertas)} ofertas visibles en {categoria_nombre}.")
+    comparar_listado_http(session, categoria_url, categoria_nombre, ofertas)
+    if not ofertas:
+        return
+
+    with ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="oferta") as pool:
+        filas = list(pool.map(lambda item: obtener_oferta_http(session, item[0], item[1], categoria_nombre),
+                              enumerate(ofertas, start=1)))
+
+    # El CSV se escribe en el orden del listado
+    for idx, (link_oferta, fila) in enumerate(zip(ofertas, filas), start=1):
+        if fila is None:
+            print(f"↩️ Oferta {idx}: HTML sin la estructura esperada, se lee con Selenium")
+            fila = procesar_oferta_selenium(link_oferta, idx, categoria_nombre)
+        else:
+            STATS["http"] += 1
+        guardar_registro(fila)
+
+# ===============================
+# MODO SELENIUM (y respaldo del modo HTTP)
+# ===============================
+def url_etiqueta_selenium(categorias_url, categoria_nombre):
+    """Busca con el navegador el enlace de la etiqueta de una categoría en la página de categorías."""
+    get_driver()
+    if driver.current_url != categorias_url:
+        driver.get(categorias_url)
+        wait_ready(driver)
+    etiqueta = wait.until(EC.presence_of_element_located((By.LINK_TEXT, categoria_nombre)))
+    return etiqueta.get_attribute("href")
+
+def procesar_oferta_selenium(link_oferta, idx, categoria_nombre):
+    """Lee una oferta con el navegador y descarga su PDF; devuelve la fila del CSV."""
+    get_driver()
+    driver.get(link_oferta)
+    wait_ready(driver, replaced=2 + 2)  # pausa fija + animación de 2 s que había antes
+    STATS["selenium"] += 1
+
+    # Extraer información de la oferta
+    try:
+        titulo = driver.find_element(By.TAG_NAME, "h2").text.strip()
+    except NoSuchElementException:
+        titulo = f"Oferta_{idx}"
+    try:
+        descripcion = driver.find_element(By.TAG_NAME, "p").text.strip()
+    except NoSuchElementException:
+        descripcion = ""
+    try:
+        porcentaje = driver.find_element(By.CLASS_NAME, "circulo").text.strip()
+    except NoSuchElementException:
+        porcentaje = "N/A"
+
+    # Descargar PDF
+    try:
+        enlace_pdf = wait.until(
+            EC.presence_of_element_located(
+                (By.XPATH, "//a[contains(translate(text(),'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'bases y condiciones')]")
+            )
+        )
+        pdf_url = enlace_pdf.get_attribute("href")
+        ruta_pdf = descargar_pdf(pdf_url, categoria_nombre)
+        print(f"✅ PDF descargado: {ruta_pdf}")
+    except TimeoutException:
+        pdf_url = None
+        ruta_pdf = None
+        print(f"⚠️ PDF no encontrado para {titulo}")
+
+    return [categoria_nombre, titulo, descripcion, porcentaje, link_oferta, pdf_url, ruta_pdf]
+
+def listar_ofertas_selenium(categoria_url):
+    """Links de las ofertas visibles de una etiqueta, según el display calculado por el navegador."""
+    get_driver()
     driver.get(categoria_url)
-    time.sleep(3)
+    # La etiqueta filtra las ofertas con JS: esperar a que la lista visible deje de cambiar
+    wait_settled(driver, OFERTA_SELECTOR, visible=True, replaced=3)
 
     # 🔹 Seleccionar solo los contenedores de ofertas visibles
-    contenedores = driver.find_elements(By.CSS_SELECTOR, "div.item")
+    contenedores = driver.find_elements(By.CSS_SELECTOR, OFERTA_SELECTOR)
     ofertas_visibles = []
     for c in contenedores:
         if c.value_of_css_property("display") != "none":
@@ -84,72 +266,47 @@ def procesar_ofertas(categoria_url, categoria_nombre):
                 ofertas_visibles.append(href)
             except NoSuchElementException:
                 continue
+    return ofertas_visibles
 
+def procesar_ofertas(categoria_url, categoria_nombre):
+    """Procesa todas las ofertas visibles de una categoría/etiqueta con el navegador"""
+    ofertas_visibles = listar_ofertas_selenium(categoria_url)
     print(f"🔍 Se encontraron {len(ofertas_visibles)} ofertas visibles en {categoria_nombre}.")
 
     for idx, link_oferta in enumerate(ofertas_visibles, start=1):
-        animar(f"\n🛍️ Procesando oferta {idx}/{len(ofertas_visibles)}")
-        driver.get(link_oferta)
-        time.sleep(2)
-
-        # Extraer información de la oferta
-        try:
-            titulo = driver.find_element(By.TAG_NAME, "h2").text.strip()
-        except NoSuchElementException:
-            titulo = f"Oferta_{idx}"
-        try:
-            descripcion = driver.find_element(By.TAG_NAME, "p").text.strip()
-        except NoSuchElementException:
-            descripcion = ""
-        try:
-            porcentaje = driver.find_element(By.CLASS_NAME, "circulo").text.strip()
-        except NoSuchElementException:
-            porcentaje = "N/A"
-
-        # Descargar PDF
-        try:
-            enlace_pdf = wait.until(
-                EC.presence_of_element_located(
-                    (By.XPATH, "//a[contains(translate(text(),'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'bases y condiciones')]")
-                )
-            )
-            pdf_url = enlace_pdf.get_attribute("href")
-            ruta_pdf = descargar_pdf(pdf_url, categoria_nombre)
-            print(f"✅ PDF descargado: {ruta_pdf}")
-        except TimeoutException:
-            pdf_url = None
-            ruta_pdf = None
-            print(f"⚠️ PDF no encontrado para {titulo}")
-
-        # Guardar registro CSV
-        with open(CSV_FILE, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow([categoria_nombre, titulo, descripcion, porcentaje, link_oferta, pdf_url, ruta_pdf])
-
-        # Volver a la URL dinámica de la etiqueta para siguiente oferta
-        driver.get(categoria_url)
-        time.sleep(2)
+        print(f"\n🛍️ Procesando oferta {idx}/{len(ofertas_visibles)}")
+        # Guardar registro CSV (los links ya se leyeron: no hace falta volver a la etiqueta)
+        guardar_registro(procesar_oferta_selenium(link_oferta, idx, categoria_nombre))
 
 def main():
     categorias = ["Combustible", "Farmacias", "Supermercados"]
+    session = make_session(pool_size=HTTP_WORKERS) if SCRAPE_MODE == "http" else None
 
     try:
-        # 1️⃣ Entrar a la página de categorías
+        # 1️⃣ Página de categorías: por HTTP se leen todos los enlaces de una vez
         categorias_url = f"{BASE_URL}/beneficios/categorias/1/"
-        driver.get(categorias_url)
-        time.sleep(2)
+        etiquetas = {}
+        if session is not None:
+            try:
+                resp = session.get(categorias_url, timeout=HTTP_TIMEOUT)
+                resp.raise_for_status()
+                etiquetas = parse_etiquetas_html(resp.text, resp.url, categorias)
+            except requests.RequestException as e:
+                print(f"⚠️ No se pudo leer la página de categorías por HTTP: {e}")
 
         for categoria_nombre in categorias:
             try:
-                animar(f"🔍 Buscando etiqueta '{categoria_nombre}'")
+                print(f"🔍 Buscando etiqueta '{categoria_nombre}'")
                 
-                # 2️⃣ Buscar dinámicamente el enlace de la categoría
-                etiqueta = wait.until(EC.presence_of_element_located((By.LINK_TEXT, categoria_nombre)))
-                categoria_url = etiqueta.get_attribute("href")
+                # 2️⃣ Buscar dinámicamente el enlace de la categoría (con el navegador si no vino en el HTML)
+                categoria_url = etiquetas.get(categoria_nombre) or url_etiqueta_selenium(categorias_url, categoria_nombre)
                 print(f"🌐 URL dinámica detectada para {categoria_nombre}: {categoria_url}")
 
                 # 3️⃣ Procesar todas las ofertas visibles de esa categoría
-                procesar_ofertas(categoria_url, categoria_nombre)
+                if session is not None:
+                    procesar_ofertas_http(session, categoria_url, categoria_nombre)
+                else:
+                    procesar_ofertas(categoria_url, categoria_nombre)
 
             except Exception as e:
                 print(f"❌ No se pudo procesar la categoría '{categoria_nombre}': {e}")
@@ -158,9 +315,11 @@ def main():
         print(f"❌ Error inesperado en la carga de la página de categorías: {e}")
 
     finally:
-        print("\n⏳ Cerrando navegador en 3 segundos...")
-        time.sleep(3)
-        driver.quit()
+        if driver is not None:
+            print("\n⏳ Cerrando navegador...")
+            driver.quit()
+            print(wait_summary())
+        print(f"🌐 Ofertas leídas por HTTP: {STATS['http']}, con el navegador: {STATS['selenium']}")
         print("✅ Proceso completado correctamente.")
 
         # === Llamar al siguiente script ocr_gnbpy.py ===
@@ -8,7 +8,6 @@ from pathlib import Path
 from urllib.parse import urljoin, urlparse
 from datetime import datetime, timezone
 import pandas as pd
-import requests
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -16,6 +15,8 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
+from downloads import download_pdf
+from selenium_waits import enable_network_log, wait_network_idle, wait_summary
 from selenium.webdriver.common.action_chains import ActionChains
 
 # -----------------------------
@@ -25,7 +26,8 @@ from selenium.webdriver.common.action_chains import ActionChains
 BASE_URL = "https://www.interfisa.com.py/beneficios#top"
 OUTPUT_DIR = Path("./descargas_interfisa")
 CSV_FILENAME = "interfisa_descargas.csv"
-SCROLL_PAUSE = 2.5
+SCROLL_PAUSE = 2.5  # pausa fija que usaba el scroll (solo para informar el tiempo ahorrado)
+SCROLL_STEP = 400
 MAX_SCROLL_TIMES = 3
 REQUESTS_TIMEOUT = 20
 HEADLESS = False
@@ -50,16 +52,11 @@ def safe_name(s: str) -> str:
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def download_file(url: str, dest: Path) -> bool:
-    """Descarga el archivo PDF ignorando validación SSL."""
+    """Descarga el archivo PDF ignorando validación SSL (GET condicional contra el manifiesto de descargas)."""
     try:
         logger.info(f"Descargando: {url}")
-        resp = requests.get(url, stream=True, timeout=REQUESTS_TIMEOUT, verify=False)
-        resp.raise_for_status()
-        with open(dest, "wb") as fh:
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:
-                    fh.write(chunk)
-        logger.info(f"✅ Archivo descargado correctamente: {dest.name}")
+        estado = download_pdf(url, dest, verify=False, timeout=REQUESTS_TIMEOUT)
+        logger.info(f"✅ Archivo descargado correctamente: {dest.name} ({estado})")
         return True
     except Exception as e:
         logger.warning(f"❌ Fallo descarga {url}: {e}")
@@ -114,19 +111,30 @@ def create_driver(headless: bool = True):
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
     options.add_argument("--window-size=1920,1080")
+    enable_network_log(options)
     driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
     return driver
 
 
-def limited_scroll(driver, pause=SCROLL_PAUSE, max_times=MAX_SCROLL_TIMES):
+def limited_scroll(driver, max_times=MAX_SCROLL_TIMES):
+    """
+    Recorre la página en tramos de SCROLL_STEP px para disparar la carga diferida. Cada
+    tramo espera un cuadro de animación (lo necesario para que la página vea el scroll)
+    y cada pasada espera a que la red quede inactiva, en lugar de pausas fijas.
+    """
     logger.info("Iniciando scroll limitado...")
     last_height = driver.execute_script("return document.body.scrollHeight")
     for scroll_count in range(1, max_times + 1):
         logger.info(f"Scroll número: {scroll_count}")
-        for i in range(0, int(driver.execute_script("return document.body.scrollHeight")), 400):
-            driver.execute_script(f"window.scrollTo(0, {i});")
-            time.sleep(pause / 4)
-        time.sleep(pause)
+        steps = range(0, int(driver.execute_script("return document.body.scrollHeight")), SCROLL_STEP)
+        for i in steps:
+            driver.execute_async_script(
+                "const done = arguments[arguments.length - 1];"
+                "window.scrollTo(0, arguments[0]);"
+                "requestAnimationFrame(() => requestAnimationFrame(done));",
+                i,
+            )
+        wait_network_idle(driver, replaced=len(steps) * SCROLL_PAUSE / 4 + SCROLL_PAUSE)
         new_height = driver.execute_script("return document.body.scrollHeight")
         if new_height == last_height:
             logger.info("No hay más contenido que cargar.")
@@ -230,8 +238,8 @@ def main():
             parsed = urlparse(r["offer_url"])
             fname = os.path.basename(parsed.path) or safe_name(r.get("title") or "oferta") + ".pdf"
             dest_file = dest_dir / fname
-            if not dest_file.exists():
-                download_file(r["offer_url"], dest_file)
+            # Siempre se consulta: si el PDF no cambió, el servidor responde 304 y no se reescribe
+            download_file(r["offer_url"], dest_file)
             r["pdf_filename"] = str(dest_file)
 
         if records:
@@ -243,6 +251,7 @@ def main():
     finally:
         if driver:
             driver.quit()
+            logger.info(wait_summary())
 
 if __name__ == "__main__":
     main()
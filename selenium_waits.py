@@ -0,0 +1,154 @@
+"""
+Esperas por condiciones del DOM compartidas por los scrapers de Selenium.
+
+Reemplazan las pausas fijas (`time.sleep`) después de cada navegación, clic o
+paginación: cada función espera exactamente hasta que se cumple la condición y no más.
+
+- `wait_ready`: `document.readyState == "complete"`.
+- `wait_visible` / `wait_gone`: un modal (u otro elemento) visible / oculto.
+- `wait_settled`: la lista de elementos de un selector dejó de cambiar (cantidad y
+  contenido de los primeros) durante SELENIUM_SETTLE segundos, con al menos `min_count`.
+- `wait_changed`: el contenido de un selector cambió respecto de un `snapshot` previo
+  (página siguiente cargada, botón `next` con otro estado).
+- `wait_network_idle`: ninguna petición de red en curso durante SELENIUM_NETWORK_IDLE
+  segundos, leyendo el Performance log de Chrome (`enable_network_log(options)` al
+  crear el driver); sin ese log se usa la cantidad de entradas de Resource Timing.
+
+Si la condición no se cumple en SELENIUM_WAIT_TIMEOUT segundos la función devuelve
+None y el scraper sigue como antes de la pausa. Cada llamada indica con `replaced` los
+segundos de la pausa fija que reemplaza; `wait_summary()` informa el tiempo ahorrado.
+"""
+import json
+import os
+import threading
+import time
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+SELENIUM_WAIT_TIMEOUT = float(os.getenv("SELENIUM_WAIT_TIMEOUT", "10"))
+SELENIUM_SETTLE = float(os.getenv("SELENIUM_SETTLE", "0.3"))
+SELENIUM_NETWORK_IDLE = float(os.getenv("SELENIUM_NETWORK_IDLE", "0.5"))
+POLL_INTERVAL = 0.1
+LONG_LIVED_TYPES = {"WebSocket", "EventSource"}  # conexiones que nunca "terminan"
+
+_SNAPSHOT_JS = """
+const [selector, visibleOnly] = arguments;
+const els = Array.from(document.querySelectorAll(selector))
+    .filter(e => !visibleOnly || e.getClientRects().length > 0);
+return [els.length, els.slice(0, 5)
+    .map(e => e.className + (e.getAttribute('href') || '') + e.textContent.trim().slice(0, 60))
+    .join('|')];
+"""
+
+_STATS = {"waits": 0, "timeouts": 0, "waited": 0.0, "replaced": 0.0}
+_STATS_LOCK = threading.Lock()
+
+
+def enable_network_log(options):
+    """Activa el Performance log de Chrome en las opciones del driver (para `wait_network_idle`)."""
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    return options
+
+
+def _wait(driver, condition, replaced, timeout):
+    start = time.monotonic()
+    try:
+        result = WebDriverWait(driver, timeout, poll_frequency=POLL_INTERVAL).until(condition)
+    except TimeoutException:
+        result = None
+    with _STATS_LOCK:
+        _STATS["waits"] += 1
+        _STATS["timeouts"] += result is None
+        _STATS["waited"] += time.monotonic() - start
+        _STATS["replaced"] += replaced
+    return result
+
+
+def snapshot(driver, css, visible=False):
+    """(cantidad, firma del contenido) de los elementos de `css`; `visible` cuenta solo los mostrados."""
+    return tuple(driver.execute_script(_SNAPSHOT_JS, css, visible))
+
+
+def wait_ready(driver, replaced=0, timeout=SELENIUM_WAIT_TIMEOUT):
+    return _wait(driver, lambda d: d.execute_script("return document.readyState") == "complete", replaced, timeout)
+
+
+def wait_visible(driver, css, replaced=0, timeout=SELENIUM_WAIT_TIMEOUT):
+    return _wait(driver, EC.visibility_of_element_located((By.CSS_SELECTOR, css)), replaced, timeout)
+
+
+def wait_gone(driver, css, replaced=0, timeout=SELENIUM_WAIT_TIMEOUT):
+    return _wait(driver, EC.invisibility_of_element_located((By.CSS_SELECTOR, css)), replaced, timeout)
+
+
+def wait_settled(driver, css, visible=False, min_count=1, settle=SELENIUM_SETTLE, replaced=0,
+                 timeout=SELENIUM_WAIT_TIMEOUT):
+    """Espera a que la lista de `css` tenga al menos `min_count` elementos y no cambie durante `settle` s."""
+    state = {"last": None, "since": time.monotonic()}
+
+    def settled(d):
+        current = snapshot(d, css, visible)
+        now = time.monotonic()
+        if current != state["last"]:
+            state["last"], state["since"] = current, now
+            return False
+        return current[0] >= min_count and now - state["since"] >= settle
+
+    return _wait(driver, settled, replaced, timeout)
+
+
+def wait_changed(driver, css, before, visible=False, replaced=0, timeout=SELENIUM_WAIT_TIMEOUT):
+    """Espera a que `snapshot(css)` difiera de `before` (por ejemplo, tras pasar de página)."""
+    return _wait(driver, lambda d: snapshot(d, css, visible) != before, replaced, timeout)
+
+
+def _performance_events(driver):
+    """Eventos Network.* pendientes del Performance log; None si el log no está activado."""
+    try:
+        entries = driver.get_log("performance")
+    except WebDriverException:
+        return None
+    events = []
+    for entry in entries:
+        message = json.loads(entry["message"])["message"]
+        if message["method"].startswith("Network."):
+            events.append(message)
+    return events
+
+
+def wait_network_idle(driver, idle=SELENIUM_NETWORK_IDLE, replaced=0, timeout=SELENIUM_WAIT_TIMEOUT):
+    """Espera a que no haya peticiones de red en curso durante `idle` segundos."""
+    state = {"inflight": set(), "last": time.monotonic(), "resources": None}
+
+    def network_idle(d):
+        now = time.monotonic()
+        events = _performance_events(d)
+        if events is None:
+            # Sin Performance log: actividad = nuevas entradas de Resource Timing
+            resources = d.execute_script("return performance.getEntriesByType('resource').length")
+            if resources != state["resources"]:
+                state["resources"], state["last"] = resources, now
+            return now - state["last"] >= idle
+        for event in events:
+            params = event.get("params", {})
+            if event["method"] == "Network.requestWillBeSent" and params.get("type") not in LONG_LIVED_TYPES:
+                state["inflight"].add(params.get("requestId"))
+                state["last"] = now
+            elif event["method"] in ("Network.loadingFinished", "Network.loadingFailed"):
+                state["inflight"].discard(params.get("requestId"))
+                state["last"] = now
+        return not state["inflight"] and now - state["last"] >= idle
+
+    return _wait(driver, network_idle, replaced, timeout)
+
+
+def wait_summary():
+    """Resumen de las esperas del navegador para el log de fin de corrida."""
+    with _STATS_LOCK:
+        s = dict(_STATS)
+    return (f"⏱️ Esperas del navegador: {s['waits']} por condición en {s['waited']:.1f} s "
+            f"(las pausas fijas sumaban {s['replaced']:.1f} s → {s['replaced'] - s['waited']:.1f} s ahorrados), "
+            f"{s['timeouts']} agotaron el tiempo")
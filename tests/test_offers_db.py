@@ -0,0 +1,197 @@
+"""
+Pruebas de la escritura por lotes de offers_db (BatchInserter, UpdateAccumulator,
+touch_offers) con un cursor falso que registra las sentencias, sin MySQL.
+"""
+import pytest
+
+from offers_db import BatchInserter, OfferIndex, UpdateAccumulator, touch_offers
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.lastrowid = None
+        self.rowcount = 0
+        self._result = None
+
+    def execute(self, sql, params=()):
+        self.db.log.append(("execute", sql, tuple(params)))
+        if sql == "SELECT @@auto_increment_increment":
+            self._result = (self.db.increment,)
+            return
+        if sql.startswith("INSERT"):
+            if params in self.db.bad_rows:
+                raise RuntimeError("fila rechazada")
+            self.lastrowid = self.db.next_id
+            self.db.next_id += self.db.increment
+        self.rowcount = len(params) if sql.startswith("UPDATE") and "CASE" not in sql else 0
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        self.db.log.append(("executemany", sql, seq))
+        if self.db.fail_executemany:
+            raise RuntimeError("bloque rechazado")
+        # LAST_INSERT_ID de un INSERT multi-fila: el id de la primera fila
+        self.lastrowid = self.db.next_id
+        self.db.next_id += self.db.increment * len(seq)
+
+    def fetchone(self):
+        return self._result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, next_id=100, increment=1, fail_executemany=False, bad_rows=()):
+        self.next_id = next_id
+        self.increment = increment
+        self.fail_executemany = fail_executemany
+        self.bad_rows = set(bad_rows)
+        self.log = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def statements(self, kind):
+        return [entry for entry in self.log if entry[0] == kind]
+
+
+def make_index():
+    return OfferIndex("BANCO TEST")
+
+
+def test_flush_multirow_chunks_remap_with_auto_increment_step():
+    conn = FakeConnection(next_id=100, increment=2)
+    inserter = BatchInserter(conn, chunk_size=2)
+    index = make_index()
+    inserter.track_index(index)
+    ids = set()
+    inserter.track_ids(ids)
+
+    rows = [inserter.add({"merchant_name": f"Comercio {n}", "bank_name": "BANCO TEST"}) for n in range(3)]
+    for row in rows:
+        index.add(row)
+        ids.add(row["id"])
+    assert [row["id"] for row in rows] == [-1, -2, -3]
+
+    remap = inserter.flush()
+
+    # Dos INSERT multi-fila (2 + 1 filas); ids consecutivos según @@auto_increment_increment
+    inserts = conn.statements("executemany")
+    assert [len(values) for _, _, values in inserts] == [2, 1]
+    assert inserts[0][1] == "INSERT INTO web_offers (merchant_name, bank_name) VALUES (%s, %s)"
+    assert remap == {-1: 100, -2: 102, -3: 104}
+    assert sorted(index.rows) == [100, 102, 104]
+    assert index.get(102)["merchant_name"] == "Comercio 1"
+    assert ids == {100, 102, 104}
+    assert inserter.inserted == 3 and inserter.failed == 0
+    assert not inserter.is_pending(-1)
+    assert conn.commits == 0  # flush no confirma
+
+
+def test_flush_groups_rows_by_column_set():
+    conn = FakeConnection()
+    inserter = BatchInserter(conn)
+    inserter.add({"merchant_name": "A", "bank_name": "B"})
+    inserter.add({"merchant_name": "C"})
+    inserter.add({"merchant_name": "D", "bank_name": "E"})
+
+    remap = inserter.flush()
+
+    inserts = conn.statements("executemany")
+    assert [(sql.split("(")[1].split(")")[0], values) for _, sql, values in inserts] == [
+        ("merchant_name, bank_name", [("A", "B"), ("D", "E")]),
+        ("merchant_name", [("C",)]),
+    ]
+    assert remap == {-1: 100, -3: 101, -2: 102}
+
+
+def test_failed_chunk_is_retried_row_by_row():
+    conn = FakeConnection(next_id=50, fail_executemany=True, bad_rows={("Malo",)})
+    inserter = BatchInserter(conn)
+    index = make_index()
+    inserter.track_index(index)
+    ids = set()
+    inserter.track_ids(ids)
+    for name in ("Bueno", "Malo", "Otro"):
+        row = inserter.add({"merchant_name": name})
+        index.add(row)
+        ids.add(row["id"])
+
+    remap = inserter.flush()
+
+    single = [params for _, sql, params in conn.statements("execute") if sql.startswith("INSERT")]
+    assert single == [("Bueno",), ("Malo",), ("Otro",)]
+    assert remap == {-1: 50, -3: 51}
+    assert inserter.inserted == 2 and inserter.failed == 1
+    # La fila que no llegó a la BD sale del índice y de los sets de ids
+    assert sorted(index.rows) == [50, 51]
+    assert ids == {50, 51}
+
+
+def test_commit_flushes_and_confirms_once():
+    conn = FakeConnection()
+    inserter = BatchInserter(conn)
+    inserter.add({"merchant_name": "A"})
+    inserter.commit()
+    assert conn.commits == 1
+    assert inserter.flush() == {}
+
+
+def test_update_accumulator_groups_by_column_set():
+    conn = FakeConnection()
+    updates = UpdateAccumulator(conn, chunk_size=2)
+    updates.add(1, {"benefic": "10%", "offer_day": "Lunes"})
+    updates.add(2, {"offer_day": "Martes", "benefic": "20%"})
+    updates.add(3, {"benefic": "30%"})
+    updates.add(4, {"benefic": "40%", "offer_day": "Jueves"})
+    # Con `current` solo se guardan las columnas que cambian
+    updates.add(5, {"benefic": "50%", "offer_day": "Viernes"}, current={"offer_day": "Viernes"})
+    assert len(updates) == 5
+
+    assert updates.apply() == 5
+
+    sqls = conn.statements("execute")
+    assert updates.statements == len(sqls) == 3
+    sql, params = sqls[0][1], sqls[0][2]
+    assert sql == (
+        "UPDATE web_offers SET "
+        "benefic = CASE id WHEN %s THEN %s WHEN %s THEN %s END, "
+        "offer_day = CASE id WHEN %s THEN %s WHEN %s THEN %s END, "
+        "updated_at=NOW(), status='A' WHERE id IN (%s, %s)"
+    )
+    assert params == (1, "10%", 2, "20%", 1, "Lunes", 2, "Martes", 1, 2)
+    # Tercera fila del grupo (benefic, offer_day): segundo bloque
+    assert sqls[1][2] == (4, "40%", 4, "Jueves", 4)
+    # Grupo de una sola columna (filas 3 y 5)
+    assert sqls[2][1] == (
+        "UPDATE web_offers SET benefic = CASE id WHEN %s THEN %s WHEN %s THEN %s END, "
+        "updated_at=NOW(), status='A' WHERE id IN (%s, %s)"
+    )
+    assert sqls[2][2] == (3, "30%", 5, "50%", 3, 5)
+    assert len(updates) == 0 and updates.apply() == 0
+
+
+def test_update_accumulator_merges_changes_of_same_row():
+    conn = FakeConnection()
+    updates = UpdateAccumulator(conn)
+    updates.add(7, {"benefic": "10%"})
+    updates.add(7, {"offer_day": "Lunes"})
+    updates.apply()
+    (_, sql, params), = conn.statements("execute")
+    assert "benefic = CASE" in sql and "offer_day = CASE" in sql
+    assert params == (7, "10%", 7, "Lunes", 7)
+
+
+@pytest.mark.parametrize("chunk_size", [0, 1, 500])
+def test_touch_offers_chunks(chunk_size):
+    conn = FakeConnection()
+    assert touch_offers(conn, [3, 1, 2, -4, None, 1], chunk_size=chunk_size) == 3
+    params = [p for _, _, p in conn.statements("execute")]
+    assert [i for chunk in params for i in chunk] == [1, 2, 3]
+    assert all(chunk for chunk in params)
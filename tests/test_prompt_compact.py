@@ -0,0 +1,50 @@
+"""
+Pruebas de PromptCompactor: mobiliario de página y secciones protegidas.
+"""
+from prompt_compact import CompactProfile, PromptCompactor
+
+PROFILE = CompactProfile(protect=[r"(?i)^\s*\d*\.?\s*MEC[AÁ]NICA"], boilerplate=[r"(?i)^banco test$"])
+
+
+def test_protected_table_rows_at_page_edges_are_kept():
+    compactor = PromptCompactor(PROFILE)
+    page1 = compactor.page("\n".join([
+        "BASES Y CONDICIONES",
+        "3. MECÁNICA",
+        "COMERCIO SUCURSAL DIRECCION",
+        "FARMACIA CATEDRAL 2 Av. España 567",
+        "SUPER 3 Ruta 2 km 15",
+        "Página 1 de 2",
+    ]))
+    page2 = compactor.page("\n".join([
+        "FARMACIA CATEDRAL 4 Av. España 890",
+        "SUPER 7 Ruta 2 km 30",
+        "OTRO Calle 5",
+        "Página 2 de 2",
+    ]))
+
+    assert "SUPER 3 Ruta 2 km 15" in page1
+    assert "Página" not in page1 and "Página" not in page2
+    assert page2.split("\n") == [
+        "FARMACIA CATEDRAL 4 Av. España 890",
+        "SUPER 7 Ruta 2 km 30",
+        "OTRO Calle 5",
+    ]
+
+
+def test_repeated_page_edges_are_dropped_outside_protected_sections():
+    compactor = PromptCompactor(PROFILE)
+    header = "Bases y Condiciones   Promoción Verano"
+    compactor.page("\n".join([header, "1. CONDICIONES", "Texto de la página uno", "Banco Test", "- 1 -"]))
+    page2 = compactor.page("\n".join(["bases y condiciones promoción verano", "Texto de la página dos",
+                                      "Fila 2 distinta", "- 2 -"]))
+
+    # El encabezado repetido (salvo espacios y mayúsculas) y el número de página se descartan
+    assert page2.split("\n") == ["Texto de la página dos", "Fila 2 distinta"]
+
+
+def test_edge_lines_that_differ_only_in_numbers_are_kept():
+    compactor = PromptCompactor(PROFILE)
+    compactor.page("\n".join(["Sucursal 1 - Centro", "Contenido", "Pie"]))
+    page2 = compactor.page("\n".join(["Sucursal 2 - Centro", "Contenido nuevo", "Pie"]))
+    assert page2.split("\n") == ["Sucursal 2 - Centro", "Contenido nuevo"]